@@ -9,12 +9,12 @@ from datetime import datetime
 from typing import Any, Iterable, Optional, Sequence
 
 from airrlogger.log_config import get_logger
-from pydantic import BaseModel
 from tqdm import tqdm
 
 from modelbench.benchmark_runner_items import ModelgaugeTestWrapper, TestRunItem, Timer
 from modelbench.benchmarks import BaseBenchmarkScore, BenchmarkDefinition
 from modelbench.cache import DiskCache, MBCache
+from modelbench.error_cache import ErrorCache
 from modelbench.run_journal import RunJournal
 from modelgauge.annotator import Annotator
 from modelgauge.annotator_registry import ANNOTATORS
@@ -23,7 +23,10 @@ from modelgauge.config import raise_if_missing_from_config
 from modelgauge.monitoring import PROMETHEUS
 from modelgauge.pipeline import NullCache, Pipe, Pipeline, Sink, Source
 from modelgauge.pipeline_runner import PipelineRunner
+from modelgauge.pipeline_stats import describe_progress
+from modelgauge.rate_limits import RATE_LIMITS, estimate_tokens
 from modelgauge.records import TestItemExceptionRecord, TestRecord
+from modelgauge.response_store import annotator_response_key, open_response_store, sut_response_key
 from modelgauge.single_turn_prompt_response import TestItem
 from modelgauge.sut import PromptResponseSUT
 
@@ -51,6 +54,7 @@ class RunTracker:
         self.seconds_per_update = seconds_per_update
         self.last_update = 0
         self.total_items = 0
+        self.last_progress: Optional[dict] = None
 
     def start(self, total_items: int):
         self.total_items = total_items
@@ -61,11 +65,17 @@ class RunTracker:
             self._on_update(finished_items)
             self.last_update = self._now()
 
+    def progress(self, event: dict):
+        """Pipeline progress_callback. Keeps the latest event, with rates, ETA and per-stage counts, for _on_update."""
+        self.last_progress = event
+        self.update(event["completed"])
+
     def done(self):
         self._on_update(self.total_items)
 
     @abstractmethod
     def _on_update(self, finished_items: int):
+        """Show progress. self.last_progress has the details if the pipeline has reported any."""
         pass
 
     def _now(self):
@@ -84,6 +94,8 @@ class TqdmRunTracker(RunTracker):
         self.previous_count = 0
 
     def _on_update(self, finished_items: int):
+        if self.last_progress:
+            self.pbar.set_postfix_str(describe_progress(self.last_progress), refresh=False)
         self.pbar.update(finished_items - self.previous_count)
         self.previous_count = finished_items
 
@@ -98,8 +110,10 @@ class JsonRunTracker(RunTracker):
         self._on_update(0)
 
     def _on_update(self, finished_items: int):
-        progress = finished_items / self.total_items
-        print(json.dumps({"progress": progress}), file=sys.stderr)
+        progress: dict[str, Any] = {"progress": finished_items / self.total_items}
+        if self.last_progress:
+            progress.update({k: v for k, v in self.last_progress.items() if k not in ("completed", "total")})
+        print(json.dumps(progress), file=sys.stderr)
 
 
 class TestRunBase:
@@ -115,6 +129,9 @@ class TestRunBase:
         self.secrets = runner.secrets
         self.sut = runner.sut
         self.max_items = runner.max_items
+        self.debug = runner.debug
+        self.response_store_path = runner.response_store_path
+        self.error_ttl = runner.error_ttl
         self.tests = []
         self.test_annotators = {}
         self._test_lookup = {}
@@ -126,7 +143,7 @@ class TestRunBase:
         journal_dir = self.data_dir / "journals"
         journal_dir.mkdir(exist_ok=True, parents=True)
         self.journal_path = journal_dir / f"journal-{self.run_id}.jsonl.zst"
-        self.journal = RunJournal(self.journal_path)
+        self.journal = RunJournal(self.journal_path, subscribers=runner.journal_subscribers)
 
         self.caches = {}
         self.cache_starting_size = {}
@@ -183,8 +200,15 @@ class TestRunBase:
         return self.test_annotators[test.uid]
 
     def cache_for(self, cache_name: str):
-        if self.data_dir:
-            result = DiskCache(self.data_dir / cache_name)
+        # in debug runs, keep the request behind each key so the cache can be inspected
+        if self.response_store_path:
+            # SUT and annotator responses share the one store, so it's opened and counted once
+            cache_name = "response_store"
+            if cache_name in self.caches:
+                return self.caches[cache_name]
+            result = open_response_store(self.response_store_path, keep_key_text=self.debug)
+        elif self.data_dir:
+            result = open_response_store(self.data_dir / cache_name, keep_key_text=self.debug)
         else:
             result = NullCache()
 
@@ -192,6 +216,16 @@ class TestRunBase:
         self.cache_starting_size[cache_name] = len(result)
         return result
 
+    def error_cache_for(self, cache_name: str) -> ErrorCache:
+        # failures stay with the run directory, even when responses are shared through a response store
+        if not (self.error_ttl and self.data_dir):
+            return ErrorCache()
+
+        result = ErrorCache(DiskCache(self.data_dir / cache_name), ttl=self.error_ttl)
+        self.caches[cache_name] = result
+        self.cache_starting_size[cache_name] = len(result)
+        return result
+
     def cache_info(self):
         result = []
         for key in self.caches.keys():
@@ -265,9 +299,10 @@ class IntermediateCachingPipe(Pipe):
     this just makes a cache available for internal use to cache intermediate results.
     """
 
-    def __init__(self, cache: MBCache, thread_count=1):
+    def __init__(self, cache: MBCache, thread_count=1, error_cache: Optional[ErrorCache] = None):
         super().__init__(thread_count)
         self.cache = cache
+        self.error_cache = error_cache if error_cache is not None else ErrorCache()
 
     def handle_item(self, item) -> Optional[Any]:
         pass
@@ -275,10 +310,11 @@ class IntermediateCachingPipe(Pipe):
     def join(self):
         super().join()
         self.cache.__exit__(None, None, None)
+        self.error_cache.__exit__(None, None, None)
 
 
 class TestRunItemSource(Source):
-    def __init__(self, run: TestRunBase, queue_maxsize=0):
+    def __init__(self, run: TestRunBase, queue_maxsize=None):
         super().__init__(queue_maxsize)
         self.test_run = run
 
@@ -316,8 +352,8 @@ class TestRunSutAssigner(Pipe):
 
 
 class TestRunSutWorker(IntermediateCachingPipe):
-    def __init__(self, test_run: TestRunBase, cache: MBCache, thread_count=1):
-        super().__init__(cache, thread_count)
+    def __init__(self, test_run: TestRunBase, cache: MBCache, thread_count=1, error_cache: Optional[ErrorCache] = None):
+        super().__init__(cache, thread_count, error_cache)
         self.test_run = test_run
 
     def handle_item(self, item: TestRunItem):
@@ -325,41 +361,56 @@ class TestRunSutWorker(IntermediateCachingPipe):
         raw_request = sut.translate_text_prompt(item.test_item.prompt, item.test.actual_test.sut_options())
         cache_key = self.make_cache_key(raw_request, sut.uid)
         self._debug(f"looking for {cache_key} in cache")
+        fetched = False
+        raw_response = None
+        timer = None
+
+        def fetch_response():
+            nonlocal fetched, timer
+            self._debug(f"cache entry not found; processing and saving")
+            fetched = True
+            request_tokens = estimate_tokens(raw_request)
+            RATE_LIMITS.acquire(sut.uid, tokens=request_tokens)
+            with Timer() as timer:
+                try:
+                    return sut.evaluate(raw_request)
+                except Exception as e:
+                    logger.error(f"failure fetching sut {sut.uid} on first try: {raw_request}", exc_info=True)
+                    FAILURES_FETCHING_SUT.inc()
+                    # TODO replace with full retry logic with
+                    RATE_LIMITS.acquire(sut.uid, tokens=request_tokens)
+                    return sut.evaluate(raw_request)
+
         try:
-            if cache_key in self.cache:
-                self._debug(f"cache entry found")
-                raw_response = self.cache[cache_key]
+            self.error_cache.check(cache_key)
+            try:
+                raw_response = self.cache.get_or_compute(cache_key, fetch_response)
+            finally:
+                self.stats.record_cache(hit=not fetched)
+            if fetched:
                 self.test_run.journal.item_entry(
-                    "using cached sut response", item, request=raw_request, response=raw_response
+                    "fetched sut response", item, run_time=timer, request=raw_request, response=raw_response
                 )
-                CACHED_SUT_RESPONSES.inc()
+                FETCHED_SUT_RESPONSES.inc()
             else:
-                self._debug(f"cache entry not found; processing and saving")
-                with Timer() as timer:
-                    try:
-                        raw_response = sut.evaluate(raw_request)
-                    except Exception as e:
-                        logger.error(f"failure fetching sut {sut.uid} on first try: {raw_request}", exc_info=True)
-                        FAILURES_FETCHING_SUT.inc()
-                        # TODO replace with full retry logic with
-                        raw_response = sut.evaluate(raw_request)
-                self.cache[cache_key] = raw_response
                 self.test_run.journal.item_entry(
-                    "fetched sut response", item, run_time=timer, request=raw_request, response=raw_response
+                    "using cached sut response", item, request=raw_request, response=raw_response
                 )
-                FETCHED_SUT_RESPONSES.inc()
+                CACHED_SUT_RESPONSES.inc()
 
             response = sut.translate_response(raw_request, raw_response)
+            if fetched:
+                RATE_LIMITS.charge_tokens(sut.uid, estimate_tokens(response.text))
             item.sut_response = response
             self.test_run.journal.item_entry("translated sut response", item, response=response)
 
         except Exception as e:
             extra_info = {}
-            try:
+            if timer is not None:
                 extra_info["run_time"] = timer
-            except NameError:
-                pass
             item.failed = True
+            if fetched and raw_response is None:
+                self.error_cache.record(cache_key, e)
             self.test_run.journal.item_exception_entry("sut exception", item, e, **extra_info)
             logger.error(f"failure handling sut item {item}:", exc_info=True)
             FAILURES_HANDLING_SUT.inc()
@@ -367,15 +418,19 @@ class TestRunSutWorker(IntermediateCachingPipe):
 
     @staticmethod
     def make_cache_key(sut_request, sut_uid):
-        request = sut_request.model_dump(exclude_none=True)
-        # Add SUT UID to key to avoid collisions.
-        json_key = {"sut": sut_uid, "sut_request": request}
-        return json.dumps(json_key)
+        return sut_response_key(sut_uid, sut_request)
 
 
 class TestRunAnnotationWorker(IntermediateCachingPipe):
-    def __init__(self, test_run: TestRunBase, cache: MBCache, thread_count=1, cache_path=None):
-        super().__init__(cache, thread_count)
+    def __init__(
+        self,
+        test_run: TestRunBase,
+        cache: MBCache,
+        thread_count=1,
+        cache_path=None,
+        error_cache: Optional[ErrorCache] = None,
+    ):
+        super().__init__(cache, thread_count, error_cache)
         self.test_run = test_run
 
     def handle_item(self, item: TestRunItem) -> TestRunItem:
@@ -420,22 +475,27 @@ class TestRunAnnotationWorker(IntermediateCachingPipe):
                 annotator_request = annotator.translate_request(item.test_item, item.sut_response)
                 cache_key = self.make_cache_key(annotator_request, annotator.uid)
                 self._debug(f"looking for {cache_key} in cache")
-                if cache_key in self.cache:
-                    self._debug(f"cache entry found")
-                    annotator_response = self.cache[cache_key]
-                    self.test_run.journal.item_entry(
-                        "using cached annotator response",
-                        item,
-                        annotator=annotator.uid,
-                        annotator_request=annotator_request,
-                        response=annotator_response,
-                    )
-                    CACHED_ANNOTATOR_RESPONSES.inc()
-                else:
+                fetched = False
+                timer = None
+
+                def fetch_response():
+                    nonlocal fetched, timer
                     self._debug(f"cache entry not found; processing and saving")
+                    fetched = True
+                    RATE_LIMITS.acquire(annotator.uid, tokens=estimate_tokens(annotator_request))
                     with Timer() as timer:
-                        annotator_response = annotator.annotate(annotator_request)
-                    self.cache[cache_key] = annotator_response
+                        try:
+                            return annotator.annotate(annotator_request)
+                        except Exception as e:
+                            self.error_cache.record(cache_key, e)
+                            raise
+
+                self.error_cache.check(cache_key)
+                try:
+                    annotator_response = self.cache.get_or_compute(cache_key, fetch_response)
+                finally:
+                    self.stats.record_cache(hit=not fetched)
+                if fetched:
                     self.test_run.journal.item_entry(
                         "fetched annotator response",
                         item,
@@ -445,6 +505,15 @@ class TestRunAnnotationWorker(IntermediateCachingPipe):
                         response=annotator_response,
                     )
                     FETCHED_ANNOTATOR_RESPONSES.inc()
+                else:
+                    self.test_run.journal.item_entry(
+                        "using cached annotator response",
+                        item,
+                        annotator=annotator.uid,
+                        annotator_request=annotator_request,
+                        response=annotator_response,
+                    )
+                    CACHED_ANNOTATOR_RESPONSES.inc()
 
                 annotation = annotator.translate_response(annotator_request, annotator_response)
                 self.test_run.journal.item_entry(
@@ -466,23 +535,7 @@ class TestRunAnnotationWorker(IntermediateCachingPipe):
 
     @staticmethod
     def make_cache_key(annotator_request, annotator_uid):
-        # Add annotator UID to key to avoid collisions.
-        error_msg = f"Don't know how to make a key out of {annotator_request.__class__}: {annotator_request}"
-        json_key = {"annotator": annotator_uid}
-        if isinstance(annotator_request, BaseModel):
-            json_key["annotator_request"] = annotator_request.model_dump(exclude_none=True)
-        elif isinstance(annotator_request, str):
-            json_key["annotator_request"] = annotator_request
-        elif isinstance(annotator_request, dict):
-            if not all(isinstance(v, (str, BaseModel)) for v in annotator_request.values()):
-                raise ValueError(error_msg)
-            json_key["annotator_request"] = {
-                k: v.model_dump(exclude_none=True) if isinstance(v, BaseModel) else v
-                for k, v in annotator_request.items()
-            }
-        else:
-            raise ValueError(error_msg)
-        return json.dumps(json_key)
+        return annotator_response_key(annotator_uid, annotator_request)
 
 
 class TestRunResultsCollector(Sink):
@@ -491,15 +544,18 @@ class TestRunResultsCollector(Sink):
         self.test_run = test_run
 
     def handle_item(self, item) -> None:
+        # progress goes to the run tracker from the pipeline's progress events, so only one thread updates it
         self.test_run.add_finished_item(item)
         COLLECTED_ITEMS.inc()
-        self.test_run.run_tracker.update(self.test_run.completed_item_count)
 
 
 class TestRunnerBase:
     def __init__(self, data_dir: pathlib.Path):
         self.debug = False
         self.data_dir = data_dir
+        self.response_store_path = None
+        self.error_ttl = None
+        self.journal_subscribers = []
         self.secrets = None
         self.sut = None
         self.max_items = None
@@ -509,6 +565,7 @@ class TestRunnerBase:
     def _check_ready_to_run(self):
         if not self.secrets:
             raise ValueError("must set secrets")
+        RATE_LIMITS.configure_from_secrets(self.secrets)
 
         if not self.sut:
             raise ValueError("must specify a sut")
@@ -565,16 +622,29 @@ class TestRunnerBase:
         )
 
     def _build_pipeline(self, run):
-        run.pipeline_segments.append(TestRunItemSource(run, queue_maxsize=self.thread_count * 4))
+        run.pipeline_segments.append(TestRunItemSource(run))
         run.pipeline_segments.append(TestRunSutAssigner(run))
-        run.pipeline_segments.append(TestRunSutWorker(run, run.cache_for("sut_cache"), thread_count=self.thread_count))
         run.pipeline_segments.append(
-            TestRunAnnotationWorker(run, run.cache_for("annotator_cache"), thread_count=self.thread_count)
+            TestRunSutWorker(
+                run,
+                run.cache_for("sut_cache"),
+                thread_count=self.thread_count,
+                error_cache=run.error_cache_for("sut_error_cache"),
+            )
+        )
+        run.pipeline_segments.append(
+            TestRunAnnotationWorker(
+                run,
+                run.cache_for("annotator_cache"),
+                thread_count=self.thread_count,
+                error_cache=run.error_cache_for("annotator_error_cache"),
+            )
         )
         run.pipeline_segments.append(TestRunResultsCollector(run))
         pipeline = Pipeline(
             *run.pipeline_segments,
             debug=self.debug,
+            progress_callback=run.run_tracker.progress,
         )
         return pipeline
 
@@ -599,7 +669,8 @@ class TestRunner(TestRunnerBase):
         self._check_ready_to_run()
         test_run = TestRun(self)
         pipeline = self._build_pipeline(test_run)
-        test_run.run_tracker.start(self._expected_item_count(test_run, pipeline))
+        pipeline.total_items = self._expected_item_count(test_run, pipeline)
+        test_run.run_tracker.start(pipeline.total_items)
 
         pipeline.run()
 
@@ -657,7 +728,8 @@ class BenchmarkRunner(TestRunnerBase):
                     dependencies=test.dependencies(),
                 )
             pipeline = self._build_pipeline(benchmark_run)
-            benchmark_run.run_tracker.start(self._expected_item_count(benchmark_run, pipeline))
+            pipeline.total_items = self._expected_item_count(benchmark_run, pipeline)
+            benchmark_run.run_tracker.start(pipeline.total_items)
             benchmark_run.journal.raw_entry("running pipeline")
             with Timer() as timer:
                 pipeline.run()
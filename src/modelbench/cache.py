@@ -1,23 +1,115 @@
+import base64
 import collections.abc
+import hashlib
+import io
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Optional
 
 import diskcache
+import requests  # type: ignore
+import zstandard
+from airrlogger.log_config import get_logger
 
+from modelgauge.cache_codecs import CacheCodec, PickleCodec, TypedJsonCodec, decode_value, encode_value
 from modelgauge.monitoring import PROMETHEUS
 
+logger = get_logger(__name__)
+
 CACHE_GETS = PROMETHEUS.counter("mm_cache_gets", "Cache gets", ["name"])
 CACHE_PUTS = PROMETHEUS.counter("mm_cache_puts", "Cache puts", ["name"])
 CACHE_HITS = PROMETHEUS.counter("mm_cache_hits", "Cache hits", ["name"])
 CACHE_SIZE = PROMETHEUS.gauge("mm_cache_size", "Cache size", ["name"])
+CACHE_MEMORY_HITS = PROMETHEUS.counter("mm_cache_memory_hits", "Cache hits served from memory", ["name"])
 
 MAX_CACHE_SIZE = 20 * 2**30  # 2**30 = 1 GB
+MEMORY_CACHE_ITEMS = 10_000
+MEMORY_CACHE_BYTES = 256 * 2**20  # 2**20 = 1 MB
+REMOTE_CACHE_TIMEOUT = 30  # seconds
+CACHE_TOKEN_ENV = "AIRR_CACHE_TOKEN"  # shared secret for modelbench cache serve and its clients
+SIZE_REPORT_SECONDS = 30  # counting entries is a query, so the size gauge is only refreshed this often
+
+CACHE_KEY_VERSION = 2
+
+_MISSING = object()
+
+
+class CacheKey(str):
+    """
+    A compact cache key: the version and a digest of the canonical JSON of
+    the fields that identify a request. The JSON itself rides along as
+    .text, so caches can keep it for debugging if asked to. The owner is
+    the uid of the SUT or annotator the entry belongs to, if known, so
+    caches can be inspected and pruned by uid.
+    """
+
+    text: str
+    owner: Optional[str]
+
+    def __new__(cls, fields: dict, owner: Optional[str] = None):
+        text = json.dumps(fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+        key = super().__new__(cls, f"v{CACHE_KEY_VERSION}:{digest}")
+        key.text = text
+        key.owner = owner
+        return key
 
 
 class MBCache(ABC, collections.abc.Mapping):
+    def __init__(self):
+        super().__init__()
+        self._in_flight: dict[Any, threading.Event] = {}
+        self._in_flight_lock = threading.Lock()
+        self._flights_finished = 0
+
     @abstractmethod
     def __setitem__(self, __key, __value):
         pass
 
+    def get_or_compute(self, key, compute: Callable[[], Any]):
+        """The cached value for key, or else the result of compute(), which is stored under key.
+
+        A hit costs one lookup. If several threads miss on the same key at once, one of them computes the value and
+        the rest wait for it rather than repeating the work."""
+        flights_finished = self._flights_finished
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        flight_key = _hashable_key(key)
+        while True:
+            with self._in_flight_lock:
+                done = self._in_flight.get(flight_key)
+                leader = done is None
+                if leader:
+                    done = self._in_flight[flight_key] = threading.Event()
+                # Only look again if some computation finished since our lookup; it may have been for this key.
+                look_again = self._flights_finished != flights_finished
+            if leader:
+                try:
+                    value = self.get(key, _MISSING) if look_again else _MISSING
+                    if value is _MISSING:
+                        value = compute()
+                        self[key] = value
+                    return value
+                finally:
+                    with self._in_flight_lock:
+                        del self._in_flight[flight_key]
+                        self._flights_finished += 1
+                    done.set()
+            done.wait()
+            flights_finished = self._flights_finished
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            # The leader failed; take another turn, possibly as the leader.
+
     def __enter__(self):
         return self
 
@@ -25,9 +117,38 @@ class MBCache(ABC, collections.abc.Mapping):
         pass
 
 
+def estimate_size(value, depth: int = 4) -> int:
+    """Roughly how much memory value takes: its own size plus that of what it holds, down to depth levels.
+
+    Much cheaper than pickling it to measure, and it counts the text, which is most of a response."""
+    size = sys.getsizeof(value)
+    if depth == 0 or isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, collections.abc.Mapping):
+        children: Iterable = (*value.keys(), *value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        children = value
+    elif hasattr(value, "__dict__"):
+        children = vars(value).values()
+    else:
+        return size
+    return size + sum(estimate_size(child, depth - 1) for child in children)
+
+
+def _hashable_key(key):
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return pickle.dumps(key)
+
+
 class NullCache(MBCache):
     """Doesn't save anything"""
 
+    def get_or_compute(self, key, compute: Callable[[], Any]):
+        return compute()
+
     def __setitem__(self, __key, __value):
         pass
 
@@ -70,38 +191,76 @@ class DiskCache(MBCache):
     on the cache. Cache objects can be used in a with statement
     to safeguard calling close."
 
+    Values are stored as bytes written by codec. Values stored before
+    codecs were used are still read as they are.
+
+    A new cache is limited to MAX_CACHE_SIZE bytes unless given another
+    size_limit. An existing cache keeps the limit it was last given.
     """
 
-    def __init__(self, cache_path):
+    def __init__(
+        self,
+        cache_path,
+        keep_key_text: bool = False,
+        codec: Optional[CacheCodec] = None,
+        size_limit: Optional[int] = None,
+    ):
         super().__init__()
         self.cache_path = cache_path
+        self.keep_key_text = keep_key_text
+        self.codec = codec or PickleCodec()
         self.cache_name = str(cache_path).split("/")[-1]
         if self.cache_name.endswith("_cache"):
             self.cache_name = self.cache_name[: -len("_cache")]
-        self.raw_cache = diskcache.Cache(cache_path, size_limit=MAX_CACHE_SIZE)
+        if size_limit is None and not os.path.exists(os.path.join(cache_path, diskcache.core.DBNAME)):
+            size_limit = MAX_CACHE_SIZE
+        settings = {} if size_limit is None else {"size_limit": size_limit}
+        self.raw_cache = diskcache.Cache(cache_path, **settings)
         self.contents = self.raw_cache
+        self._size_reported_at = None
 
     def __enter__(self):
         self.contents = self.raw_cache.__enter__()
         return self.contents
 
     def __exit__(self, __type, __value, __traceback):
+        self._report_size()
         self.raw_cache.__exit__(__type, __value, __traceback)
         self.contents = self.raw_cache
 
     def __setitem__(self, __key, __value):
         CACHE_PUTS.labels(self.cache_name).inc()
-        self.contents.__setitem__(__key, __value)
-        CACHE_SIZE.labels(self.cache_name).set(self.__len__())
+        value = encode_value(__value, self.codec)
+        if isinstance(__key, CacheKey):
+            # diskcache pickles keys that aren't exactly str. The entry's tag holds the key text if it's kept,
+            # otherwise the owner.
+            self.contents.set(str(__key), value, tag=__key.text if self.keep_key_text else __key.owner)
+        else:
+            self.contents.__setitem__(__key, value)
+        self._maybe_report_size()
 
     def __getitem__(self, key, /):
         CACHE_GETS.labels(self.cache_name).inc()
-        result = self.contents.__getitem__(key)
+        result = decode_value(self.contents.__getitem__(str(key) if isinstance(key, CacheKey) else key))
         if result:
             CACHE_HITS.labels(self.cache_name).inc()
-        CACHE_SIZE.labels(self.cache_name).set(self.__len__())
+        self._maybe_report_size()
         return result
 
+    def _maybe_report_size(self):
+        now = time.monotonic()
+        if self._size_reported_at is None or now - self._size_reported_at >= SIZE_REPORT_SECONDS:
+            self._report_size(now)
+
+    def _report_size(self, now=None):
+        self._size_reported_at = time.monotonic() if now is None else now
+        CACHE_SIZE.labels(self.cache_name).set(self.__len__())
+
+    def key_text(self, key) -> Optional[str]:
+        """The JSON a CacheKey was made from, if the entry was stored with keep_key_text."""
+        _, tag = self.contents.get(str(key), tag=True)
+        return tag if _is_key_text(tag) else None
+
     def __len__(self):
         return self.contents.__len__()
 
@@ -110,3 +269,380 @@ class DiskCache(MBCache):
 
     def __str__(self):
         return self.__class__.__name__ + f"({self.cache_path})"
+
+
+def migrate_cache_keys(cache: DiskCache) -> tuple[int, int]:
+    """
+    Moves entries stored under the old full-JSON keys to CacheKeys made
+    from the same fields. Returns how many entries were moved and how many
+    were left alone because their keys weren't old-style JSON keys.
+    """
+    moved = skipped = 0
+    for old_key in list(cache.raw_cache.iterkeys()):
+        try:
+            fields = json.loads(old_key) if isinstance(old_key, str) else None
+        except json.JSONDecodeError:
+            fields = None
+        if not isinstance(fields, dict):
+            skipped += 1
+            continue
+        value = cache.raw_cache.get(old_key, default=_MISSING)
+        if value is _MISSING:
+            continue
+        cache[CacheKey(fields, owner=fields.get("sut") or fields.get("annotator"))] = decode_value(value)
+        del cache.raw_cache[old_key]
+        moved += 1
+    return moved, skipped
+
+
+def convert_disk_cache(cache: DiskCache) -> int:
+    """Re-encodes every value in the cache with its codec. Returns how many values were rewritten."""
+    count = 0
+    for key in list(cache.raw_cache.iterkeys()):
+        value, tag = cache.raw_cache.get(key, default=_MISSING, tag=True)
+        if value is _MISSING:
+            continue
+        cache.raw_cache.set(key, encode_value(decode_value(value), cache.codec), tag=tag)
+        count += 1
+    return count
+
+
+class HttpCache(MBCache):
+    """
+    A cache kept by a server like modelbench.cache_server, so many runner
+    hosts can share it. Values are encoded with codec before they are sent.
+    Use get_many and set_many to move many entries in one request.
+
+    Requests carry token, by default from the AIRR_CACHE_TOKEN environment
+    variable, which the server checks. Anyone who can write to the server
+    can choose what its clients read, so values written by any codec other
+    than this cache's are refused. The default codec is JSON, so nothing
+    from the server is unpickled unless a PickleCodec is asked for.
+
+    The server being unreachable is not fatal: lookups miss and writes are
+    dropped, with a warning. Put a TieredCache in front to keep hot entries
+    in memory.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        cache_name: str,
+        keep_key_text: bool = False,
+        codec: Optional[CacheCodec] = None,
+        session=None,
+        timeout: float = REMOTE_CACHE_TIMEOUT,
+        token: Optional[str] = None,
+    ):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+        self.cache_name = cache_name
+        self.keep_key_text = keep_key_text
+        self.codec = codec or TypedJsonCodec()
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        token = token if token is not None else os.environ.get(CACHE_TOKEN_ENV)
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    def _url(self, action: str = "") -> str:
+        return f"{self.base_url}/caches/{self.cache_name}" + (f"/{action}" if action else "")
+
+    def _call(self, method: str, action: str = "", payload=None):
+        try:
+            response = self.session.request(
+                method, self._url(action), json=payload, headers=self.headers, timeout=self.timeout
+            )
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"cache server {self.base_url} failed on {action or 'info'}: {e}")
+            return None
+
+    def get_many(self, keys: Iterable) -> dict:
+        """The values found for any of the keys, by key."""
+        keys = list(keys)
+        CACHE_GETS.labels(self.cache_name).inc(len(keys))
+        result = self._call("POST", "get", {"keys": [str(key) for key in keys]})
+        found = (result or {}).get("entries", {})
+        values = {}
+        for key in keys:
+            if str(key) in found:
+                try:
+                    values[key] = decode_value(base64.b64decode(found[str(key)]), expected_codec=self.codec)
+                except ValueError as e:
+                    logger.warning(f"ignoring value for {key} from cache server {self.base_url}: {e}")
+        CACHE_HITS.labels(self.cache_name).inc(len(values))
+        return values
+
+    def set_many(self, items: dict):
+        entries = {}
+        tags = {}
+        for key, value in items.items():
+            if not self.codec.can_encode(value):
+                logger.warning(f"not sending {key} to cache server {self.base_url}: {self.codec.name} can't encode it")
+                continue
+            entries[str(key)] = base64.b64encode(encode_value(value, self.codec)).decode("ascii")
+            if isinstance(key, CacheKey):
+                tag = key.text if self.keep_key_text else key.owner
+                if tag is not None:
+                    tags[str(key)] = tag
+        CACHE_PUTS.labels(self.cache_name).inc(len(entries))
+        self._call("POST", "put", {"entries": entries, "tags": tags})
+
+    def __setitem__(self, __key, __value):
+        self.set_many({__key: __value})
+
+    def __getitem__(self, key, /):
+        values = self.get_many([key])
+        if key not in values:
+            raise KeyError(key)
+        return values[key]
+
+    def __len__(self):
+        result = self._call("GET")
+        return result["entries"] if result else 0
+
+    def __iter__(self):
+        result = self._call("GET", "keys")
+        return iter(result["keys"] if result else [])
+
+    def __str__(self):
+        return self.__class__.__name__ + f"({self._url()})"
+
+
+def _is_key_text(tag) -> bool:
+    return isinstance(tag, str) and tag.startswith("{")
+
+
+def _owner_from_tag(tag) -> Optional[str]:
+    """The SUT or annotator uid an entry belongs to, from the key text or owner in its tag."""
+    if not _is_key_text(tag):
+        return tag
+    fields = json.loads(tag)
+    return fields.get("sut") or fields.get("annotator")
+
+
+@dataclass
+class CacheEntryInfo:
+    key: Any
+    owner: Optional[str]
+    tag: Optional[str]
+    size: int
+    store_time: float
+
+
+def cache_entries(cache: DiskCache) -> Iterable[CacheEntryInfo]:
+    """Describes each entry without reading its value."""
+    db_path = os.path.join(cache.raw_cache.directory, diskcache.core.DBNAME)
+    connection = sqlite3.connect(db_path)
+    try:
+        rows = connection.execute(
+            "SELECT key, raw, tag, size + COALESCE(LENGTH(value), 0), store_time FROM Cache ORDER BY rowid"
+        ).fetchall()
+    finally:
+        connection.close()
+    for key, raw, tag, size, store_time in rows:
+        yield CacheEntryInfo(cache.raw_cache.disk.get(key, raw), _owner_from_tag(tag), tag, size, store_time)
+
+
+@dataclass
+class CacheStats:
+    entries: int = 0
+    bytes: int = 0
+    oldest: Optional[float] = None
+    newest: Optional[float] = None
+
+    def add(self, entry: CacheEntryInfo):
+        self.entries += 1
+        self.bytes += entry.size
+        self.oldest = entry.store_time if self.oldest is None else min(self.oldest, entry.store_time)
+        self.newest = entry.store_time if self.newest is None else max(self.newest, entry.store_time)
+
+
+@dataclass
+class CacheReport:
+    total: CacheStats = field(default_factory=CacheStats)
+    by_owner: dict[Optional[str], CacheStats] = field(default_factory=dict)
+
+
+def cache_stats(cache: DiskCache) -> CacheReport:
+    """Entries, bytes and ages for the whole cache and for each SUT or annotator uid.
+
+    Entries stored without an owner, like those from before owners were recorded, are counted under None."""
+    report = CacheReport()
+    for entry in cache_entries(cache):
+        report.total.add(entry)
+        report.by_owner.setdefault(entry.owner, CacheStats()).add(entry)
+    return report
+
+
+def prune_cache(
+    cache: DiskCache,
+    owners: Iterable[str] = (),
+    older_than: Optional[float] = None,
+    max_size: Optional[int] = None,
+) -> int:
+    """
+    Removes entries belonging to any of the owners and/or stored more than
+    older_than seconds ago; if both are given, an entry must match both.
+    Then, if max_size is given, makes it the cache's size limit and evicts
+    the oldest entries until the cache fits. Returns how many entries were
+    removed.
+    """
+    owners = set(owners)
+    removed = 0
+    if owners or older_than is not None:
+        cutoff = None if older_than is None else time.time() - older_than
+        for entry in cache_entries(cache):
+            if owners and entry.owner not in owners:
+                continue
+            if cutoff is not None and entry.store_time >= cutoff:
+                continue
+            if cache.raw_cache.delete(entry.key):
+                removed += 1
+    if max_size is not None:
+        cache.raw_cache.reset("size_limit", max_size)
+        removed += cache.raw_cache.cull()
+    return removed
+
+
+def vacuum_cache(cache: DiskCache) -> tuple[int, int]:
+    """Drops expired entries, repairs the bookkeeping and gives unused space back to the disk.
+
+    Returns the cache's size in bytes before and after."""
+    before = cache.raw_cache.volume()
+    cache.raw_cache.expire()
+    cache.raw_cache.check(fix=True)
+    connection = sqlite3.connect(os.path.join(cache.raw_cache.directory, diskcache.core.DBNAME))
+    try:
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    return before, cache.raw_cache.volume()
+
+
+def export_caches(caches: Iterable[DiskCache], path, owners: Iterable[str] = ()) -> int:
+    """
+    Writes the entries of the caches, optionally only those of some owners,
+    to a zstd-compressed JSON lines file that import_caches can read.
+    Returns how many entries were written.
+    """
+    owners = set(owners)
+    count = 0
+    with open(path, "wb") as out, zstandard.ZstdCompressor().stream_writer(out) as writer:
+        for cache in caches:
+            cache_dir = os.path.basename(os.path.normpath(cache.cache_path))
+            for entry in cache_entries(cache):
+                if not isinstance(entry.key, str) or (owners and entry.owner not in owners):
+                    continue
+                value = cache.raw_cache.get(entry.key, default=_MISSING)
+                if value is _MISSING:
+                    continue
+                line = {
+                    "cache": cache_dir,
+                    "key": entry.key,
+                    "tag": entry.tag,
+                    "value": base64.b64encode(encode_value(decode_value(value), cache.codec)).decode("ascii"),
+                }
+                writer.write((json.dumps(line) + "\n").encode("utf-8"))
+                count += 1
+    return count
+
+
+def import_caches(path, open_cache: Callable[[str], DiskCache]) -> tuple[int, int]:
+    """
+    Adds the entries in a file written by export_caches to the caches
+    open_cache returns for each exported cache directory name. Entries
+    already present are left alone. Returns how many entries were added
+    and how many were already there.
+    """
+    caches: dict[str, DiskCache] = {}
+    added = present = 0
+    with open(path, "rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+        for line in io.TextIOWrapper(reader, encoding="utf-8"):
+            entry = json.loads(line)
+            if entry["cache"] not in caches:
+                caches[entry["cache"]] = open_cache(entry["cache"])
+            cache = caches[entry["cache"]]
+            if cache.raw_cache.add(entry["key"], base64.b64decode(entry["value"]), tag=entry["tag"]):
+                added += 1
+            else:
+                present += 1
+    return added, present
+
+
+class TieredCache(MBCache):
+    """
+    Keeps the most recently used entries of another cache in memory, so
+    repeated hits skip the lookup and unpickling. Writes go through to
+    the backing cache. Memory use is bounded by both the number of
+    entries and their total size, as sizeof estimates it; the least
+    recently used entries go first.
+
+    Values in memory are shared, not copied, so don't modify what you
+    get back.
+    """
+
+    def __init__(
+        self,
+        backing: MBCache,
+        max_items: int = MEMORY_CACHE_ITEMS,
+        max_bytes: int = MEMORY_CACHE_BYTES,
+        sizeof: Callable[[Any], int] = estimate_size,
+    ):
+        super().__init__()
+        self.backing = backing
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.cache_name = getattr(backing, "cache_name", backing.__class__.__name__)
+        self._memory: collections.OrderedDict = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.backing.__enter__()
+        return self
+
+    def __exit__(self, __type, __value, __traceback):
+        self.backing.__exit__(__type, __value, __traceback)
+
+    def __setitem__(self, __key, __value):
+        self.backing.__setitem__(__key, __value)
+        self._remember(_hashable_key(__key), __value)
+
+    def __getitem__(self, key, /):
+        memory_key = _hashable_key(key)
+        with self._lock:
+            entry = self._memory.get(memory_key)
+            if entry is not None:
+                self._memory.move_to_end(memory_key)
+        if entry is not None:
+            CACHE_MEMORY_HITS.labels(self.cache_name).inc()
+            return entry[0]
+        result = self.backing.__getitem__(key)
+        self._remember(memory_key, result)
+        return result
+
+    def _remember(self, memory_key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._memory.pop(memory_key, None)
+            if old is not None:
+                self._memory_bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._memory[memory_key] = (value, size)
+            self._memory_bytes += size
+            while len(self._memory) > self.max_items or self._memory_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def __len__(self):
+        return self.backing.__len__()
+
+    def __iter__(self):
+        return self.backing.__iter__()
+
+    def __str__(self):
+        return self.__class__.__name__ + f"({self.backing})"
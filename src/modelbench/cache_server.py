@@ -0,0 +1,110 @@
+"""
+A reference HTTP server for sharing response caches between runner hosts.
+
+Each named cache is a DiskCache directory under the server's root. Values
+are opaque to the server: clients encode them with a codec and send them
+base64'd, so the server never needs the classes being cached. Start one
+with `modelbench cache serve` and point runners at it with
+--response-store http://host:port.
+
+Every request must carry the server's token as a bearer token; clients read
+it from the AIRR_CACHE_TOKEN environment variable. The server only listens
+on localhost unless given another host.
+"""
+
+import base64
+import hmac
+import pathlib
+import re
+import threading
+
+import fastapi
+import uvicorn
+from pydantic import BaseModel
+
+from modelbench.cache import DiskCache
+
+DEFAULT_PORT = 8765
+DEFAULT_HOST = "127.0.0.1"
+CACHE_NAME_PATTERN = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+class CacheKeys(BaseModel):
+    keys: list[str]
+
+
+class CacheEntries(BaseModel):
+    """Values are base64 of encoded bytes. Tags are optional, keyed like the values."""
+
+    entries: dict[str, str]
+    tags: dict[str, str] = {}
+
+
+class CacheInfo(BaseModel):
+    name: str
+    entries: int
+
+
+class CacheWrite(BaseModel):
+    name: str
+    written: int
+
+
+class CacheServer:
+    def __init__(self, root: pathlib.Path, token: str, port: int = DEFAULT_PORT, host: str = DEFAULT_HOST):
+        if not token:
+            raise ValueError("The cache server needs a token for clients to authenticate with.")
+        self.root = root
+        self.token = token
+        self.port = port
+        self.host = host
+        self.caches: dict[str, DiskCache] = {}
+        self._lock = threading.Lock()
+        self.app = self.make_app()
+
+    def cache(self, name: str) -> DiskCache:
+        if not CACHE_NAME_PATTERN.fullmatch(name) or name in (".", ".."):
+            raise fastapi.HTTPException(status_code=400, detail=f"Bad cache name {name!r}.")
+        with self._lock:
+            if name not in self.caches:
+                self.caches[name] = DiskCache(self.root / name)
+            return self.caches[name]
+
+    def check_token(self, authorization: str = fastapi.Header(default="")):
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), self.token.encode()):
+            raise fastapi.HTTPException(status_code=401, detail="Missing or wrong cache server token.")
+
+    def make_app(self):
+        app = fastapi.FastAPI(dependencies=[fastapi.Depends(self.check_token)])
+
+        @app.get("/caches/{name}")
+        def info(name: str) -> CacheInfo:
+            return CacheInfo(name=name, entries=len(self.cache(name).raw_cache))
+
+        @app.get("/caches/{name}/keys")
+        def keys(name: str) -> CacheKeys:
+            return CacheKeys(keys=[key for key in self.cache(name).raw_cache.iterkeys() if isinstance(key, str)])
+
+        @app.post("/caches/{name}/get")
+        def get_many(name: str, request: CacheKeys) -> CacheEntries:
+            raw_cache = self.cache(name).raw_cache
+            found = {}
+            for key in request.keys:
+                value = raw_cache.get(key)
+                if isinstance(value, bytes):
+                    found[key] = base64.b64encode(value).decode("ascii")
+            return CacheEntries(entries=found)
+
+        @app.post("/caches/{name}/put")
+        def put_many(name: str, request: CacheEntries) -> CacheWrite:
+            # counting the whole cache after every write would scan it, so this reports just what was written
+            raw_cache = self.cache(name).raw_cache
+            for key, value in request.entries.items():
+                raw_cache.set(key, base64.b64decode(value), tag=request.tags.get(key))
+            return CacheWrite(name=name, written=len(request.entries))
+
+        return app
+
+    def run(self):
+        uvicorn.run(self.app, host=self.host, port=self.port, use_colors=False)
@@ -0,0 +1,156 @@
+"""
+Fills the benchmark's SUT and annotator caches from the journals of earlier runs.
+
+Journals record every native request and response a run used, so the entries
+a run would have cached can be rebuilt from them under exactly the keys
+TestRunSutWorker and TestRunAnnotationWorker look up. Rerunning the same
+benchmark against warmed caches then needs no SUT or annotator calls.
+
+Requests and responses are rebuilt with the types their SUT's `evaluate` or
+annotator's `annotate` is annotated with, so entries for SUTs or annotators
+without those annotations, or with request types that can't be rebuilt from
+JSON, are skipped and counted.
+"""
+
+import inspect
+import json
+import pathlib
+import typing
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional
+
+from airrlogger.log_config import get_logger
+from pydantic import BaseModel
+
+from modelbench.cache import MBCache
+from modelbench.run_journal import journal_reader
+from modelgauge.annotator import Annotator
+from modelgauge.response_store import annotator_response_key, sut_response_key
+from modelgauge.sut import SUT, SUTResponse
+
+logger = get_logger(__name__)
+
+SUT_RESPONSE_MESSAGES = {"fetched sut response", "using cached sut response"}
+# the cached annotator entry names its request differently
+ANNOTATOR_RESPONSE_MESSAGES = {
+    "fetched annotator response": "request",
+    "using cached annotator response": "annotator_request",
+}
+
+
+class CannotRebuild(Exception):
+    pass
+
+
+@dataclass
+class WarmupCounts:
+    added: int = 0
+    present: int = 0
+    skipped: int = 0
+
+    def __add__(self, other: "WarmupCounts") -> "WarmupCounts":
+        return WarmupCounts(self.added + other.added, self.present + other.present, self.skipped + other.skipped)
+
+
+@dataclass
+class NativeTypes:
+    request: Any
+    response: Any
+
+
+def native_types(method) -> NativeTypes:
+    """The request and response types a SUT's evaluate or an annotator's annotate is annotated with, if any."""
+    try:
+        hints = typing.get_type_hints(method)
+    except (NameError, TypeError):
+        return NativeTypes(None, None)
+    params = list(inspect.signature(method).parameters)
+    return NativeTypes(hints.get(params[0]) if params else None, hints.get("return"))
+
+
+def rebuild(cls, data):
+    """An instance of cls from the JSON the journal recorded for it."""
+    if isinstance(cls, type) and issubclass(cls, BaseModel) and isinstance(data, dict):
+        return cls.model_validate(data)
+    if cls is str and isinstance(data, str):
+        return data
+    raise CannotRebuild(f"can't make a {cls} from {type(data).__name__}")
+
+
+class JournalCacheWarmer:
+    """Adds the responses recorded in journals to a SUT cache and an annotator cache.
+
+    make_sut and make_annotator turn uids from the journal into instances, whose type annotations say how to rebuild
+    the recorded requests and responses. They may return None for uids that can't be made here."""
+
+    def __init__(
+        self,
+        sut_cache: MBCache,
+        annotator_cache: MBCache,
+        make_sut: Callable[[str], Optional[SUT]],
+        make_annotator: Callable[[str], Optional[Annotator]],
+    ):
+        self.sut_cache = sut_cache
+        self.annotator_cache = annotator_cache
+        self.make_sut = make_sut
+        self.make_annotator = make_annotator
+        self._sut_types: dict[str, Optional[NativeTypes]] = {}
+        self._annotator_types: dict[str, Optional[NativeTypes]] = {}
+
+    def warm(self, journal_paths: Iterable[pathlib.Path]) -> WarmupCounts:
+        counts = WarmupCounts()
+        for path in journal_paths:
+            counts += self.warm_from_journal(path)
+        return counts
+
+    def warm_from_journal(self, journal_path: pathlib.Path) -> WarmupCounts:
+        counts = WarmupCounts()
+        with journal_reader(journal_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                message = entry.get("message")
+                if message in SUT_RESPONSE_MESSAGES:
+                    self._add(counts, entry, self.sut_cache, self._sut_entry)
+                elif message in ANNOTATOR_RESPONSE_MESSAGES:
+                    self._add(counts, entry, self.annotator_cache, self._annotator_entry)
+        return counts
+
+    def _add(self, counts: WarmupCounts, entry: dict, cache: MBCache, make_entry):
+        try:
+            key, value = make_entry(entry)
+        except (CannotRebuild, ValueError) as e:
+            logger.debug(f"skipping journal entry {entry.get('message')} for {entry.get('prompt_id')}: {e}")
+            counts.skipped += 1
+            return
+        if key in cache:
+            counts.present += 1
+        else:
+            cache[key] = value
+            counts.added += 1
+
+    def _sut_entry(self, entry: dict):
+        sut_uid = entry.get("sut")
+        types = self._types_for(sut_uid, self._sut_types, self.make_sut, "evaluate")
+        request = rebuild(types.request, entry.get("request"))
+        if types.response is SUTResponse:
+            # the journal flattens SUTResponses into the entry itself
+            response = SUTResponse(text=entry.get("response_text"), top_logprobs=entry.get("logprobs"))
+        else:
+            response = rebuild(types.response, entry.get("response"))
+        return sut_response_key(sut_uid, request), response
+
+    def _annotator_entry(self, entry: dict):
+        annotator_uid = entry.get("annotator")
+        types = self._types_for(annotator_uid, self._annotator_types, self.make_annotator, "annotate")
+        request = rebuild(types.request, entry.get(ANNOTATOR_RESPONSE_MESSAGES[entry["message"]]))
+        response = rebuild(types.response, entry.get("response"))
+        return annotator_response_key(annotator_uid, request), response
+
+    @staticmethod
+    def _types_for(uid, known: dict, make, method_name) -> NativeTypes:
+        if uid not in known:
+            instance = make(uid) if uid else None
+            known[uid] = native_types(getattr(instance, method_name)) if instance is not None else None
+        if known[uid] is None:
+            raise CannotRebuild(f"can't make {uid}")
+        return known[uid]
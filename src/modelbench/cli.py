@@ -9,6 +9,7 @@ os.environ["TOGETHER_NO_BANNER"] = "1"
 
 import pathlib
 import pkgutil
+import re
 import signal
 import sys
 from datetime import datetime, timezone
@@ -29,19 +30,36 @@ from modelbench.benchmarks import (
     benchmark_class_for,
     benchmark_versions_for,
 )
+from modelbench.cache import (
+    CACHE_TOKEN_ENV,
+    DiskCache,
+    cache_stats,
+    export_caches,
+    import_caches,
+    migrate_cache_keys,
+    prune_cache,
+    vacuum_cache,
+)
+from modelbench.cache_server import DEFAULT_HOST as DEFAULT_CACHE_HOST, DEFAULT_PORT as DEFAULT_CACHE_PORT, CacheServer
+from modelbench.cache_warmup import JournalCacheWarmer
 from modelbench.consistency_checker import (
     ConsistencyChecker,
     ConsistencyCheckError,
+    JournalSearch,
     summarize_consistency_check_results,
 )
+from modelbench.journal_columns import write_journal_columns
 from modelbench.record import dump_json
+from modelbench.run_journal import find_journals, flush_journals_on_signals
 from modelbench.standards import Standards
+from modelgauge.annotator_registry import ANNOTATORS
 from modelgauge.config import load_secrets_from_config, write_default_config
 from modelgauge.load_namespaces import load_namespaces
 from modelgauge.locales import DEFAULT_LOCALE, LOCALES
 from modelgauge.monitoring import PROMETHEUS
 from modelgauge.preflight import check_secrets, make_sut
 from modelgauge.prompt_sets import GENERAL_PROMPT_SETS, SECURITY_JAILBREAK_PROMPT_SETS
+from modelgauge.response_store import RESPONSE_STORE_ENV, open_response_store
 from modelgauge.sut_registry import SUTS
 
 _BENCHMARK_PREFIXES = {"general": "GeneralPurpose", "security": "Security"}
@@ -66,6 +84,38 @@ local_plugin_dir_option = click.option(
 )
 
 
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+AGE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+
+class SizeParam(click.ParamType):
+    """A number of bytes, like 500M or 20G."""
+
+    name = "size"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", value.strip(), re.IGNORECASE)
+        if not match:
+            self.fail(f"{value!r} isn't a size like 500M or 20G.", param, ctx)
+        return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+class AgeParam(click.ParamType):
+    """A number of seconds, like 12h or 30d."""
+
+    name = "age"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return value
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhdw])", value.strip())
+        if not match:
+            self.fail(f"{value!r} isn't an age like 12h or 30d.", param, ctx)
+        return float(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
 def benchmark_options(prompt_sets: dict, default_prompt_set: str):
     def decorator(func):
         @click.option(
@@ -137,16 +187,35 @@ def benchmark_options(prompt_sets: dict, default_prompt_set: str):
     default="./run",
     type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
 )
+@click.option(
+    "--response-store",
+    envvar=RESPONSE_STORE_ENV,
+    default=None,
+    type=str,
+    help="Directory, or URL of a `modelbench cache serve` server, holding SUT and annotator responses shared with "
+    "modelgauge runs, instead of the run directory's caches.",
+)
+@click.option(
+    "--cache-errors-for",
+    "error_ttl",
+    type=AgeParam(),
+    default=None,
+    help="Remember SUT and annotator calls that were refused, like HTTP 400s, for this long, like 7d, so reruns fail "
+    "those items without calling again.",
+)
 @click.pass_context
-def cli(ctx: click.Context, run_path) -> None:
+def cli(ctx: click.Context, run_path, response_store, error_ttl) -> None:
     ctx.ensure_object(dict)
     ctx.obj["run_path"] = run_path
+    ctx.obj["response_store"] = response_store
+    ctx.obj["error_ttl"] = error_ttl
 
     PROMETHEUS.push_metrics()
     try:
         faulthandler.register(signal.SIGUSR1, file=sys.stderr, all_threads=True, chain=False)
     except io.UnsupportedOperation:
         pass  # just an issue with some tests that capture sys.stderr
+    flush_journals_on_signals()
 
     log_dir = run_path / "logs"
     log_dir.mkdir(exist_ok=True, parents=True)
@@ -203,7 +272,19 @@ def general_benchmark(
     benchmark = benchmark_cls(locale, prompt_set, evaluator)
     check_benchmark(benchmark)
     try:
-        run_and_report_benchmark(benchmark, sut, max_instances, debug, json_logs, run_path, output_dir, run_uid, user)
+        run_and_report_benchmark(
+            benchmark,
+            sut,
+            max_instances,
+            debug,
+            json_logs,
+            run_path,
+            output_dir,
+            run_uid,
+            user,
+            response_store=ctx.obj.get("response_store"),
+            error_ttl=ctx.obj.get("error_ttl"),
+        )
     except ConsistencyCheckError as e:
         echo(termcolor.colored(str(e), "red"), err=True)
         sys.exit(e.EXIT_CODE)
@@ -240,15 +321,50 @@ def security_benchmark(
     benchmark = benchmark_cls(locale, prompt_set, evaluator=evaluator)
     check_benchmark(benchmark)
     try:
-        run_and_report_benchmark(benchmark, sut, max_instances, debug, json_logs, run_path, output_dir, run_uid, user)
+        run_and_report_benchmark(
+            benchmark,
+            sut,
+            max_instances,
+            debug,
+            json_logs,
+            run_path,
+            output_dir,
+            run_uid,
+            user,
+            response_store=ctx.obj.get("response_store"),
+            error_ttl=ctx.obj.get("error_ttl"),
+        )
     except ConsistencyCheckError as e:
         echo(termcolor.colored(str(e), "red"), err=True)
         sys.exit(e.EXIT_CODE)
 
 
-def run_and_report_benchmark(benchmark, sut, max_instances, debug, json_logs, run_path, outputdir, run_uid, user):
+def run_and_report_benchmark(
+    benchmark,
+    sut,
+    max_instances,
+    debug,
+    json_logs,
+    run_path,
+    outputdir,
+    run_uid,
+    user,
+    response_store=None,
+    error_ttl=None,
+):
     start_time = datetime.now(timezone.utc)
-    run = run_benchmarks_for_sut([benchmark], sut, max_instances, run_path=run_path, debug=debug, json_logs=json_logs)
+    journal_search = JournalSearch()
+    run = run_benchmarks_for_sut(
+        [benchmark],
+        sut,
+        max_instances,
+        run_path=run_path,
+        debug=debug,
+        json_logs=json_logs,
+        response_store=response_store,
+        error_ttl=error_ttl,
+        journal_subscribers=[journal_search.add],
+    )
     benchmark_scores = score_benchmarks(run)
     output_path = run_path / outputdir
     output_path.mkdir(exist_ok=True, parents=True)
@@ -265,7 +381,9 @@ def run_and_report_benchmark(benchmark, sut, max_instances, debug, json_logs, ru
         annotation_records.write(json.dumps(annotations))
     print(f"Wrote annotations for {benchmark.uid} to {annotation_path}.")
 
-    consistent = run_consistency_check(run.journal_path, verbose=True)
+    consistent = run_consistency_check(
+        run.journal_path, verbose=True, search_engine=collected_journal_search(run, journal_search)
+    )
     if not consistent:
         raise ConsistencyCheckError("Consistency check failed for the benchmark run.")
 
@@ -280,8 +398,16 @@ def consistency_check(journal_path, verbose):
     run_consistency_check(journal_path, verbose)
 
 
-def run_consistency_check(journal_path, verbose, calibration=False) -> bool:
-    """Return True if all checks passed successfully"""
+def collected_journal_search(run, journal_search: JournalSearch):
+    """The entries journal_search collected as the run's journal was written, or None if it missed some."""
+    return None if run.journal.subscriber_errors else journal_search
+
+
+def run_consistency_check(journal_path, verbose, calibration=False, search_engine=None) -> bool:
+    """Return True if all checks passed successfully
+
+    For a single journal, search_engine can hold its entries already, collected while the run wrote them, so the
+    journal isn't read again. The checks themselves still run over all of its entries once the run is done."""
     journal_paths = []
     if journal_path.is_dir():
         # Search for all journal files in the directory.
@@ -301,7 +427,7 @@ def run_consistency_check(journal_path, verbose, calibration=False) -> bool:
     for p in journal_paths:
         echo(termcolor.colored(f"\nChecking consistency of journal {p} ..........", "green"))
         try:
-            checker = ConsistencyChecker(p, calibration=calibration)
+            checker = ConsistencyChecker(p, calibration=calibration, search_engine=search_engine)
             checker.run(verbose)
             checkers.append(checker)
             if not checker.checks_all_passed():
@@ -322,6 +448,206 @@ def run_consistency_check(journal_path, verbose, calibration=False) -> bool:
     return all_passed
 
 
+@cli.command(
+    "journal-columns",
+    help="Write a Parquet copy of each journal beside it, for fast analysis. Directories are searched recursively.",
+)
+@click.argument("journal-paths", nargs=-1, required=True, type=click.Path(exists=True, path_type=pathlib.Path))
+def journal_columns(journal_paths) -> None:
+    paths = find_journals(journal_paths)
+    if not paths:
+        raise click.BadParameter("No journals found.", param_hint="JOURNAL_PATHS")
+    for path in paths:
+        echo(f"{path} -> {write_journal_columns(path)}")
+
+
+@cli.group("cache")
+def cache_group() -> None:
+    """Look after the SUT and annotator response caches in the run directory."""
+
+
+def cache_paths(ctx: click.Context, cache_dirs) -> list[pathlib.Path]:
+    if cache_dirs:
+        return list(cache_dirs)
+    run_path: pathlib.Path = ctx.obj["run_path"]
+    names = ("sut_cache", "annotator_cache", "sut_error_cache", "annotator_error_cache")
+    return [run_path / name for name in names if (run_path / name).is_dir()]
+
+
+@cache_group.command("migrate-keys", help="Move entries stored under old full-JSON keys to compact hashed keys.")
+@click.argument(
+    "cache_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path)
+)
+@click.pass_context
+def migrate_keys(ctx: click.Context, cache_dirs) -> None:
+    for path in cache_paths(ctx, cache_dirs):
+        cache = DiskCache(path)
+        with cache:
+            moved, skipped = migrate_cache_keys(cache)
+        echo(f"{path}: moved {moved} entries, left {skipped} alone")
+
+
+def format_size(size: int) -> str:
+    for unit in ("T", "G", "M", "K"):
+        if size >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:.1f} {unit}B"
+    return f"{size} B"
+
+
+def format_time(timestamp) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M") if timestamp is not None else ""
+
+
+@cache_group.command("stats", help="Show the entries, bytes and ages in each cache, by SUT or annotator uid.")
+@click.argument(
+    "cache_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path)
+)
+@click.pass_context
+def stats(ctx: click.Context, cache_dirs) -> None:
+    console = Console()
+    for path in cache_paths(ctx, cache_dirs):
+        cache = DiskCache(path)
+        with cache:
+            report = cache_stats(cache)
+            size_limit = cache.raw_cache.size_limit
+        title = f"{path} (limit {format_size(size_limit)})"
+        table = Table("UID", "Entries", "Bytes", "Oldest", "Newest", title=title)
+        for owner, owner_stats in sorted(report.by_owner.items(), key=lambda item: -item[1].bytes):
+            table.add_row(
+                owner or "(unknown)",
+                str(owner_stats.entries),
+                format_size(owner_stats.bytes),
+                format_time(owner_stats.oldest),
+                format_time(owner_stats.newest),
+            )
+        table.add_row(
+            "total",
+            str(report.total.entries),
+            format_size(report.total.bytes),
+            format_time(report.total.oldest),
+            format_time(report.total.newest),
+        )
+        console.print(table)
+
+
+@cache_group.command("prune", help="Remove entries by SUT or annotator uid, by age, or down to a size.")
+@click.option("uids", "--uid", multiple=True, help="Remove entries for this SUT or annotator uid. Repeatable.")
+@click.option(
+    "--older-than", type=AgeParam(), default=None, help="Remove entries stored longer ago than this, like 30d."
+)
+@click.option(
+    "--max-size",
+    type=SizeParam(),
+    default=None,
+    help="Keep each cache under this size from now on, like 5G, evicting the oldest entries.",
+)
+@click.argument(
+    "cache_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path)
+)
+@click.pass_context
+def prune(ctx: click.Context, uids, older_than, max_size, cache_dirs) -> None:
+    if not uids and older_than is None and max_size is None:
+        raise click.UsageError("Say what to prune with --uid, --older-than and/or --max-size.")
+    for path in cache_paths(ctx, cache_dirs):
+        cache = DiskCache(path)
+        with cache:
+            removed = prune_cache(cache, owners=uids, older_than=older_than, max_size=max_size)
+        echo(f"{path}: removed {removed} entries")
+
+
+@cache_group.command("vacuum", help="Drop expired entries and give unused space back to the disk.")
+@click.argument(
+    "cache_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path)
+)
+@click.pass_context
+def vacuum(ctx: click.Context, cache_dirs) -> None:
+    for path in cache_paths(ctx, cache_dirs):
+        cache = DiskCache(path)
+        with cache:
+            before, after = vacuum_cache(cache)
+        echo(f"{path}: {format_size(before)} -> {format_size(after)}")
+
+
+@cache_group.command("export", help="Write cache entries to a file that `modelbench cache import` can read.")
+@click.option("uids", "--uid", multiple=True, help="Only export entries for this SUT or annotator uid. Repeatable.")
+@click.argument("output", type=click.Path(dir_okay=False, path_type=pathlib.Path))
+@click.argument(
+    "cache_dirs", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path)
+)
+@click.pass_context
+def export(ctx: click.Context, uids, output, cache_dirs) -> None:
+    caches = [DiskCache(path) for path in cache_paths(ctx, cache_dirs)]
+    count = export_caches(caches, output, owners=uids)
+    echo(f"Exported {count} entries to {output}")
+
+
+@cache_group.command("serve", help="Serve caches over HTTP, so runners on many hosts can share them.")
+@click.option(
+    "--host",
+    default=DEFAULT_CACHE_HOST,
+    show_default=True,
+    help="Interface to listen on. Use 0.0.0.0 to serve other hosts.",
+)
+@click.option("--port", type=int, default=DEFAULT_CACHE_PORT, show_default=True)
+@click.option(
+    "--token",
+    envvar=CACHE_TOKEN_ENV,
+    required=True,
+    help=f"Shared secret clients must send. Runners read it from {CACHE_TOKEN_ENV}, which also sets it here.",
+)
+@click.argument("root", type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path))
+def serve(host, port, token, root) -> None:
+    echo(f"Serving caches in {root} on {host}:{port}")
+    CacheServer(root, token, port=port, host=host).run()
+
+
+@cache_group.command("import", help="Add the entries in an exported file to the caches in the run directory.")
+@click.argument("input_path", type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path))
+@click.pass_context
+def import_entries(ctx: click.Context, input_path) -> None:
+    run_path: pathlib.Path = ctx.obj["run_path"]
+    # only the last part of the exported name, so an import can't write outside the run directory
+    added, present = import_caches(input_path, lambda name: DiskCache(run_path / pathlib.Path(name).name))
+    echo(f"Added {added} entries, {present} were already there")
+
+
+@cache_group.command(
+    "warm", help="Fill the caches with the SUT and annotator responses recorded in journals from earlier runs."
+)
+@click.argument("journals", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
+@click.pass_context
+def warm(ctx: click.Context, journals) -> None:
+    run_path: pathlib.Path = ctx.obj["run_path"]
+    response_store = ctx.obj["response_store"]
+    journal_paths = find_journals(journals or [run_path / "journals"])
+    if not journal_paths:
+        raise click.BadParameter("No journals found.", param_hint="JOURNALS")
+    secrets = load_secrets_from_config()
+
+    def maker(factory):
+        def make(uid):
+            try:
+                return factory.make_instance(uid, secrets=secrets)
+            except Exception as e:
+                echo(termcolor.colored(f"Can't make {uid}, so skipping its responses: {e}", "yellow"))
+                return None
+
+        return make
+
+    if response_store:
+        sut_cache = annotator_cache = open_response_store(response_store)
+    else:
+        sut_cache = open_response_store(run_path / "sut_cache")
+        annotator_cache = open_response_store(run_path / "annotator_cache")
+    with sut_cache, annotator_cache:
+        warmer = JournalCacheWarmer(sut_cache, annotator_cache, maker(SUTS), maker(ANNOTATORS))
+        counts = warmer.warm(journal_paths)
+    echo(
+        f"Read {len(journal_paths)} journals: added {counts.added} entries, "
+        f"{counts.present} were already there, skipped {counts.skipped}"
+    )
+
+
 def check_benchmark(benchmark):
     """Checks that user has all required secrets and performs basic input validation."""
     # TODO: Maybe all these checks should be done in the benchmark constructor?
@@ -353,8 +679,14 @@ def run_benchmarks_for_sut(
     thread_count=32,
     calibrating=False,
     run_path: str = "./run",
+    response_store=None,
+    error_ttl=None,
+    journal_subscribers=(),
 ) -> BenchmarkRun:
     runner = BenchmarkRunner(pathlib.Path(run_path), calibrating=calibrating)
+    runner.response_store_path = response_store
+    runner.error_ttl = error_ttl
+    runner.journal_subscribers = list(journal_subscribers)
     runner.secrets = load_secrets_from_config()
     runner.benchmarks = benchmarks
     runner.sut = sut
@@ -438,8 +770,19 @@ def calibrate(benchmark, run_path: str = "./run"):
     sut_runs = {}
     for sut_uid in reference_benchmark.reference_suts:
         ref_sut = make_sut(sut_uid)
-        run_result = run_benchmarks_for_sut([reference_benchmark], ref_sut, None, calibrating=True, run_path=run_path)
-        if not run_consistency_check(run_result.journal_path, verbose=True, calibration=True):
+        journal_search = JournalSearch()
+        run_result = run_benchmarks_for_sut(
+            [reference_benchmark],
+            ref_sut,
+            None,
+            calibrating=True,
+            run_path=run_path,
+            journal_subscribers=[journal_search.add],
+        )
+        search_engine = collected_journal_search(run_result, journal_search)
+        if not run_consistency_check(
+            run_result.journal_path, verbose=True, calibration=True, search_engine=search_engine
+        ):
             raise RuntimeError(f"Consistency check failed for reference SUT {sut_uid}. Standards not updated.")
         sut_runs[ref_sut] = run_result
 
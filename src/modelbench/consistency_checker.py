@@ -1,9 +1,10 @@
 import json
 import shutil
+import sys
 from abc import ABC, abstractmethod
 from collections import Counter, defaultdict
-from itertools import product
-from typing import Dict, List
+from itertools import combinations, product
+from typing import Dict, List, Optional
 
 import casefy
 from rich.console import Console
@@ -32,23 +33,94 @@ def find_nested_key(the_dict, the_key):
     return None
 
 
+# The entry fields the checks read. JournalSearch keeps only these, so official-size journals fit in memory.
+CHECKED_FIELDS = frozenset(
+    {
+        "message",
+        "benchmark",
+        "benchmarks",
+        "suts",
+        "tests",
+        "hazard",
+        "test",
+        "sut",
+        "annotator",
+        "prompt_id",
+        "using",
+        "items_finished",
+        "score",
+        "annotation",
+        "measurements",
+    }
+)
+CHECKED_ANNOTATION_FIELDS = ("is_valid", "is_safe")
+# Entries are indexed by every combination of these fields they have, so queries don't scan whole messages.
+INDEXED_FIELDS = ("sut", "test", "annotator", "hazard", "benchmark")
+# Repeated in most entries, so each distinct value is only held once.
+INTERNED_FIELDS = (*INDEXED_FIELDS, "prompt_id")
+
+
+def _checked_fields(entry: dict) -> dict:
+    kept = {k: v for k, v in entry.items() if k in CHECKED_FIELDS}
+    for k in INTERNED_FIELDS:
+        if isinstance(kept.get(k), str):
+            kept[k] = sys.intern(kept[k])
+    if "response_text" in entry:
+        # only blankness is checked, and responses are the bulk of a journal
+        response_text = entry["response_text"]
+        kept["blank_response"] = isinstance(response_text, str) and response_text.strip() == ""
+    annotation = kept.get("annotation")
+    if isinstance(annotation, dict):
+        kept["annotation"] = {k: annotation[k] for k in CHECKED_ANNOTATION_FIELDS if k in annotation}
+        joined_responses = find_nested_key(annotation, "joined_responses")
+        if joined_responses:
+            # ensemble annotations count once per member, which is all the checks need of them
+            kept["annotation"]["joined_response_count"] = len(joined_responses)
+    return kept
+
+
 class JournalSearch:
-    def __init__(self, journal_path):
+    """
+    The checked fields of a journal's entries, indexed for the checks' queries.
+
+    Reads the journal at journal_path in one pass. Without a path it starts
+    empty and is filled with add(), which can be subscribed to a RunJournal
+    to collect a run's entries as it goes, so checking it afterwards doesn't
+    read the journal again. Either way the checks run once all entries are
+    in, so it holds every checked entry of the journal until then.
+    """
+
+    def __init__(self, journal_path=None):
         self.journal_path = journal_path
-        self.message_entries: Dict[str, List] = defaultdict(list)  # or maybe sqllite dict?
-        # Load journal into message_entries dict.
-        self._read_journal()
+        self.message_entries: Dict[str, List] = defaultdict(list)
+        self.index: Dict[tuple, List] = defaultdict(list)
+        if journal_path is not None:
+            self._read_journal()
 
     def _read_journal(self):
-        # Might want to filter out irrelevant messages here. idk.
         with journal_reader(self.journal_path) as f:
             for line in f:
-                entry = json.loads(line)
-                self.message_entries[entry["message"]].append(entry)
+                self.add(json.loads(line))
+
+    def add(self, entry: dict):
+        entry = _checked_fields(entry)
+        self.message_entries[entry["message"]].append(entry)
+        self._index_entry(entry)
+
+    def _index_entry(self, entry: dict):
+        indexed = [(k, entry[k]) for k in INDEXED_FIELDS if isinstance(entry.get(k), str)]
+        for n in range(1, len(indexed) + 1):
+            for fields in combinations(indexed, n):
+                self.index[(entry["message"], *fields)].append(entry)
 
     def query(self, message: str, **kwargs):
-        messages = self.message_entries[message]
-        return [m for m in messages if all(m[k] == v for k, v in kwargs.items())]
+        indexed = tuple((k, kwargs[k]) for k in INDEXED_FIELDS if isinstance(kwargs.get(k), str))
+        if indexed:
+            candidates = self.index.get((message, *indexed), [])
+        else:
+            candidates = self.message_entries.get(message, [])
+        rest = {k: v for k, v in kwargs.items() if (k, v) not in indexed}
+        return [m for m in candidates if all(m[k] == v for k, v in rest.items())]
 
     def num_test_prompts(self, test) -> int:
         # TODO: Implement cache.
@@ -272,7 +344,7 @@ class AnnotationsMergedCorrectly(JournalCheck):
         self.allow_singleton_annotator = "security" in benchmark or not benchmark.endswith("private")
 
         translated_responses = search_engine.query("translated sut response", sut=sut, test=test)
-        self.response_by_id = {i["prompt_id"]: i["response_text"] for i in translated_responses}
+        self.blank_response_ids = {i["prompt_id"] for i in translated_responses if i.get("blank_response")}
 
         # Group translated annotations by prompt and annotator + counts.
         translated_annotations = search_engine.query("translated annotation", sut=sut, test=test)
@@ -283,11 +355,7 @@ class AnnotationsMergedCorrectly(JournalCheck):
             # Only consider valid annotations.
             if entry["annotation"].get("is_valid", True):
                 self.prompt_annotations[entry["prompt_id"]].append(entry["annotation"]["is_safe"])
-                joined_responses = find_nested_key(entry["annotation"], "joined_responses")
-                if joined_responses:
-                    self.annotation_counts[entry["prompt_id"]] += len(joined_responses)
-                else:
-                    self.annotation_counts[entry["prompt_id"]] += 1
+                self.annotation_counts[entry["prompt_id"]] += entry["annotation"].get("joined_response_count", 1)
 
         # Get measurements for each prompt
         measured_item_entries = search_engine.query("measured item quality", sut=sut, test=test)
@@ -311,8 +379,7 @@ class AnnotationsMergedCorrectly(JournalCheck):
 
         measurement = self.prompt_measurements[prompt]
 
-        response = self.response_by_id.get(prompt)
-        if response is not None and response.strip() == "":
+        if prompt in self.blank_response_ids:
             if measurement == SAFE_SCORE:
                 # blank responses are always safe
                 return None
@@ -448,9 +515,11 @@ class JournalEntityLevelCheck:
 
 class ConsistencyChecker:
 
-    def __init__(self, journal_path, calibration=False):
+    def __init__(self, journal_path, calibration=False, search_engine: Optional[JournalSearch] = None):
+        """Checks the journal at journal_path, or the entries already collected from it in search_engine."""
         self.journal_path = journal_path
         self.calibration = calibration
+        self.search_engine = search_engine if search_engine is not None else JournalSearch(journal_path)
 
         # Entities to run checks for.
         self.benchmark = None
@@ -475,7 +544,7 @@ class ConsistencyChecker:
 
     def _collect_entities(self):
         # Get all SUTs and tests that were ran in the journal. We will run checks for each (SUT, test) pair.
-        search_engine = JournalSearch(self.journal_path)
+        search_engine = self.search_engine
         start_message = "starting calibration run" if self.calibration else "starting run"
         starting_run_entry = search_engine.query(start_message)
         assert len(starting_run_entry) == 1
@@ -553,7 +622,7 @@ class ConsistencyChecker:
 
     def _collect_results(self):
         """Populate the results/warning tables of each check level."""
-        search_engine = JournalSearch(self.journal_path)
+        search_engine = self.search_engine
         for test in self.tests:
             for sut in self.suts:
                 self.test_sut_level_checker.run_checks_for_row(search_engine, sut=sut, test=test)
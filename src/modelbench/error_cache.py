@@ -0,0 +1,97 @@
+"""
+Remembers SUT and annotator calls that failed in ways retrying won't fix.
+
+A prompt a SUT's content filter rejects, or a request the API answers with
+an HTTP 400, fails the same way every time. Without this a rerun pays a full
+retry budget for each of them again. Failures are stored under the same key
+as the response would have been, for a limited time, so a rerun can fail
+those items straight away.
+"""
+
+import time
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+
+from modelbench.cache import MBCache, NullCache
+
+DEFAULT_ERROR_TTL = 7 * 24 * 60 * 60  # seconds
+
+# the request itself was refused, rather than the service being busy, down or misconfigured
+DETERMINISTIC_STATUS_CODES = frozenset({400, 404, 413, 422})
+
+
+def status_code_of(exception: BaseException) -> Optional[int]:
+    """The HTTP status of a failed call, for exceptions from the client libraries SUTs use, if there is one."""
+    for source in (exception, getattr(exception, "response", None)):
+        for attribute in ("status_code", "code"):
+            code = getattr(source, attribute, None)
+            if isinstance(code, int):
+                return code
+    return None
+
+
+def is_deterministic_failure(exception: BaseException) -> bool:
+    return status_code_of(exception) in DETERMINISTIC_STATUS_CODES
+
+
+class CachedFailure(BaseModel):
+    exception_class: str
+    message: str
+    failed_at: float
+
+
+class CachedFailureError(Exception):
+    """Stands in for a failure an earlier run recorded, so the item fails without another call."""
+
+    def __init__(self, failure: CachedFailure):
+        super().__init__(f"{failure.exception_class}: {failure.message}")
+        self.failure = failure
+
+
+class ErrorCache:
+    """
+    Records deterministic failures by request key and replays them for ttl seconds.
+
+    Which failures count as deterministic is up to is_deterministic; by default
+    it's HTTP statuses that mean the request was refused. With a NullCache,
+    nothing is recorded.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[MBCache] = None,
+        ttl: float = DEFAULT_ERROR_TTL,
+        is_deterministic: Callable[[BaseException], bool] = is_deterministic_failure,
+    ):
+        self.cache = cache if cache is not None else NullCache()
+        self.ttl = ttl
+        self.is_deterministic = is_deterministic
+
+    def check(self, key):
+        """Raises CachedFailureError if the call for key failed deterministically less than ttl seconds ago."""
+        failure = self.cache.get(key)
+        if failure is not None and time.time() - failure.failed_at < self.ttl:
+            raise CachedFailureError(failure)
+
+    def record(self, key, exception: BaseException) -> bool:
+        """Remembers the failure of the call for key if it's deterministic. Returns whether it was recorded."""
+        if isinstance(exception, CachedFailureError) or not self.is_deterministic(exception):
+            return False
+        self.cache[key] = CachedFailure(
+            exception_class=exception.__class__.__name__, message=str(exception), failed_at=time.time()
+        )
+        return True
+
+    def __enter__(self):
+        self.cache.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cache.__exit__(*exc_info)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __str__(self):
+        return f"ErrorCache({self.cache}, ttl={self.ttl})"
@@ -0,0 +1,159 @@
+"""
+A columnar copy of a run journal, for analysis.
+
+Reading a journal means decompressing it and parsing every line as JSON. The
+sidecar holds the same entries as Parquet, one file per message type, with
+the fields analyses filter and group by as typed columns. Everything else in
+an entry is kept as JSON in the `fields` column, so nothing is lost.
+
+    sidecar = write_journal_columns(journal_path)
+    table = read_journal_columns(sidecar, "translated annotation", columns=["sut", "annotator", "is_safe"])
+
+Any Parquet reader can open the sidecar directory as one dataset, too.
+"""
+
+import json
+import pathlib
+import re
+import shutil
+from datetime import datetime
+from typing import Optional, Sequence
+
+import pyarrow as pa  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
+
+from modelbench.run_journal import journal_reader
+
+SIDECAR_SUFFIX = ".parquet"
+BATCH_ROWS = 50_000  # rows held per message type before they're written
+
+JOURNAL_SCHEMA = pa.schema(
+    [
+        pa.field("timestamp", pa.timestamp("us", tz="UTC")),
+        pa.field("message", pa.string()),
+        pa.field("test", pa.string()),
+        pa.field("sut", pa.string()),
+        pa.field("prompt_id", pa.string()),
+        pa.field("annotator", pa.string()),
+        pa.field("run_time", pa.float64()),
+        # 1.0 for safe and 0.0 for unsafe, from an annotation or a measurement
+        pa.field("is_safe", pa.float64()),
+        pa.field("fields", pa.string()),
+    ]
+)
+_STRING_COLUMNS = ("test", "sut", "prompt_id", "annotator")
+_TYPED_KEYS = {"timestamp", "message", "run_time", *_STRING_COLUMNS}
+
+
+def journal_columns_path(journal_path: pathlib.Path) -> pathlib.Path:
+    """Where the sidecar for a journal goes: journal-run-x.jsonl.zst gets journal-run-x.parquet beside it."""
+    name = journal_path.name
+    for suffix in (".zst", ".jsonl"):
+        name = name.removesuffix(suffix)
+    return journal_path.with_name(name + SIDECAR_SUFFIX)
+
+
+def message_file_name(message: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", message).strip("_") + ".parquet"
+
+
+def _string(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+def _is_safe(entry: dict) -> Optional[float]:
+    for source in ("annotation", "measurements"):
+        value = entry.get(source)
+        if isinstance(value, dict) and "is_safe" in value:
+            is_safe = value["is_safe"]
+            return float(is_safe) if isinstance(is_safe, (bool, int, float)) else None
+    return None
+
+
+def _timestamp(value) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _MessageWriter:
+    """Collects rows for one message type and writes them to its Parquet file in batches."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.columns: dict[str, list] = {name: [] for name in JOURNAL_SCHEMA.names}
+        self.writer: Optional[pq.ParquetWriter] = None
+
+    def add(self, entry: dict):
+        self.columns["timestamp"].append(_timestamp(entry.get("timestamp")))
+        self.columns["message"].append(entry.get("message"))
+        for name in _STRING_COLUMNS:
+            self.columns[name].append(_string(entry.get(name)))
+        self.columns["run_time"].append(_number(entry.get("run_time")))
+        self.columns["is_safe"].append(_is_safe(entry))
+        rest = {k: v for k, v in entry.items() if k not in _TYPED_KEYS}
+        self.columns["fields"].append(json.dumps(rest) if rest else None)
+        if len(self.columns["message"]) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.columns["message"]:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(str(self.path), JOURNAL_SCHEMA, compression="zstd")
+        self.writer.write_table(pa.Table.from_pydict(self.columns, schema=JOURNAL_SCHEMA))
+        self.columns = {name: [] for name in JOURNAL_SCHEMA.names}
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_journal_columns(journal_path: pathlib.Path, sidecar_path: Optional[pathlib.Path] = None) -> pathlib.Path:
+    """Writes the columnar sidecar for a journal in one pass over it, replacing any earlier one. Returns its path."""
+    sidecar_path = sidecar_path or journal_columns_path(journal_path)
+    writing_path = sidecar_path.with_name(sidecar_path.name + ".writing")
+    shutil.rmtree(writing_path, ignore_errors=True)
+    writing_path.mkdir(parents=True)
+
+    writers: dict[str, _MessageWriter] = {}
+    try:
+        with journal_reader(journal_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                file_name = message_file_name(str(entry.get("message")))
+                if file_name not in writers:
+                    writers[file_name] = _MessageWriter(writing_path / file_name)
+                writers[file_name].add(entry)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    shutil.rmtree(sidecar_path, ignore_errors=True)
+    writing_path.rename(sidecar_path)
+    return sidecar_path
+
+
+def read_journal_columns(
+    sidecar_path: pathlib.Path, message: Optional[str] = None, columns: Optional[Sequence[str]] = None
+) -> pa.Table:
+    """The entries in a sidecar, or just those with the given message, with all columns or just the given ones."""
+    if message is not None:
+        paths = [sidecar_path / message_file_name(message)]
+    else:
+        paths = sorted(sidecar_path.glob("*.parquet"))
+    tables = [pq.read_table(path, columns=columns) for path in paths if path.exists()]
+    if not tables:
+        schema = JOURNAL_SCHEMA if columns is None else pa.schema([JOURNAL_SCHEMA.field(c) for c in columns])
+        return schema.empty_table()
+    return pa.concat_tables(tables)
@@ -1,11 +1,20 @@
+import atexit
+import functools
 import inspect
 import json
+import os
+import pathlib
+import queue
+import reprlib
+import signal
+import sys
 import threading
+import weakref
 from contextlib import AbstractContextManager
 from datetime import datetime, timezone
 from enum import Enum
 from io import IOBase, TextIOWrapper
-from typing import Sequence, Mapping, Any
+from typing import Callable, Iterable, Optional, Sequence, Mapping
 from unittest.mock import MagicMock
 
 from pydantic import BaseModel
@@ -14,6 +23,16 @@ from zstandard.backend_cffi import ZstdCompressor, ZstdDecompressor
 from modelbench.benchmark_runner_items import TestRunItem, Timer
 from modelgauge.sut import SUTResponse
 
+JOURNAL_BUFFER_SIZE = 10_000  # entries waiting to be written before callers have to wait
+JOURNAL_BATCH_SIZE = 1_000  # most entries encoded and written at once
+
+JOURNAL_GLOB = "journal-*.jsonl*"
+
+_STOP = object()
+_argument_repr = reprlib.Repr(maxstring=200, maxother=200, maxlist=10, maxdict=10)
+_open_journals: "weakref.WeakSet[RunJournal]" = weakref.WeakSet()
+_flushing_on_signals = False
+
 
 def for_journal(o):
     """Turns anything into a collection of primitives suitable for JSON rendering."""
@@ -42,9 +61,10 @@ def for_journal(o):
             frame = tb.tb_frame
             result["filename"] = frame.f_code.co_filename
             result["function"] = frame.f_code.co_name
-            argnames: set[Any] = {frame.f_code.co_varnames[i] for i in range(frame.f_code.co_argcount)}
-            result["arguments"] = {a: repr(frame.f_locals[a]) for a in argnames}
-            result["variables"] = {k: repr(frame.f_locals[k]) for k in set(frame.f_locals.keys()) - argnames}
+            # just the arguments, and only the start of each, so journaling a failure stays cheap
+            argnames = frame.f_code.co_varnames[: frame.f_code.co_argcount]
+            local_values = frame.f_locals
+            result["arguments"] = {a: _argument_repr.repr(local_values[a]) for a in argnames if a in local_values}
         return result
     elif isinstance(o, MagicMock):
         # to make testing easier
@@ -53,6 +73,17 @@ def for_journal(o):
         return o
 
 
+def find_journals(paths: Iterable[pathlib.Path]) -> list[pathlib.Path]:
+    """The given journal files, plus any journals found in the given directories."""
+    result = []
+    for path in paths:
+        if path.is_dir():
+            result.extend(sorted(path.rglob(JOURNAL_GLOB)))
+        else:
+            result.append(path)
+    return result
+
+
 def journal_reader(path):
     """Loads existing journal file, decompressing if necessary."""
     if path.suffix == ".zst":
@@ -65,9 +96,32 @@ def journal_reader(path):
 
 
 class RunJournal(AbstractContextManager):
+    """
+    Writes journal entries as JSON lines, zstd compressed when given a path.
+
+    For paths, entries are handed to a background thread, which encodes,
+    compresses and writes them in batches, so worker threads don't queue up
+    behind each other to write. At most buffer_size entries wait to be
+    written; past that, callers wait. Pending entries are written by flush()
+    and close(), at exit, and on the signals set up with
+    flush_journals_on_signals(). Streams are written synchronously unless
+    background is set. Entries made after close() are dropped.
+
+    Subscribers are called with each entry, as it's written, on the thread
+    that writes it. One that raises is dropped, and its exception kept in
+    subscriber_errors, so it can't stop the journal being written.
+    """
 
-    def __init__(self, output=None):
+    def __init__(
+        self,
+        output=None,
+        background: Optional[bool] = None,
+        buffer_size: int = JOURNAL_BUFFER_SIZE,
+        subscribers: Iterable[Callable[[dict], None]] = (),
+    ):
         super().__init__()
+        self.subscribers: list[Callable[[dict], None]] = list(subscribers)
+        self.subscriber_errors: list[BaseException] = []
         if isinstance(output, IOBase):
             self.filehandle = output
             self.binary = False
@@ -79,11 +133,25 @@ class RunJournal(AbstractContextManager):
         else:
             self.filehandle = None
         self.output_lock = threading.Lock()
+        self._closed = False
+        self._queue: Optional[queue.Queue] = None
+        self._writer: Optional[threading.Thread] = None
+        self._write_error: Optional[BaseException] = None
+        if self.filehandle and (self.binary if background is None else background):
+            self._queue = queue.Queue(maxsize=buffer_size)
+            self._writer = threading.Thread(target=self._write_batches, name="journal-writer", daemon=True)
+            self._writer.start()
+            _open_journals.add(self)
 
         self.raw_entry("starting journal")
 
+    def subscribe(self, subscriber: Callable[[dict], None]):
+        """Calls subscriber with every entry written from now on."""
+        with self.output_lock:
+            self.subscribers.append(subscriber)
+
     def raw_entry(self, message, **kwargs):
-        if self.filehandle:
+        if self.filehandle or self.subscribers:
             entry = {"timestamp": self._timestamp(), "message": message}
             entry.update(self._caller_info())
             for key, value in kwargs.items():
@@ -117,16 +185,88 @@ class RunJournal(AbstractContextManager):
         return entry
 
     def _write(self, entry):
-        with self.output_lock:
-            j = json.dumps(entry) + "\n"
-            if self.binary:
-                self.filehandle.write(j.encode("utf-8"))
-            else:
-                self.filehandle.write(j)
+        if self._closed:
+            return
+        if self._queue is not None:
+            self._queue.put(entry)
+        else:
+            with self.output_lock:
+                self._write_entries([entry])
+
+    def _write_entries(self, entries):
+        self._notify(entries)
+        if not self.filehandle:
+            return
+        j = "".join(json.dumps(entry) + "\n" for entry in entries)
+        if self.binary:
+            self.filehandle.write(j.encode("utf-8"))
+        else:
+            self.filehandle.write(j)
+
+    def _notify(self, entries):
+        for subscriber in list(self.subscribers):
+            try:
+                for entry in entries:
+                    subscriber(entry)
+            except Exception as e:
+                self.subscribers.remove(subscriber)
+                self.subscriber_errors.append(e)
+
+    def _write_batches(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < JOURNAL_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            entries = []
+            for queued in batch:
+                if isinstance(queued, dict):
+                    entries.append(queued)
+                    continue
+                self._write_batch(entries, flush=queued is not _STOP)
+                entries = []
+                if queued is _STOP:
+                    return
+                queued.set()  # a flush() waiting for everything before it
+            self._write_batch(entries)
+
+    def _write_batch(self, entries, flush=False):
+        try:
+            if self._write_error is None:
+                with self.output_lock:
+                    if entries:
+                        self._write_entries(entries)
+                    if flush:
+                        self.filehandle.flush()
+        except Exception as e:
+            # keep draining, so nobody waits forever; close() reports it
+            self._write_error = e
+
+    def flush(self):
+        """Writes out every entry made so far."""
+        if self._closed:
+            return
+        if self._queue is not None:
+            written = threading.Event()
+            self._queue.put(written)
+            written.wait()
+        elif self.filehandle:
+            with self.output_lock:
+                self.filehandle.flush()
 
     def close(self):
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put(_STOP)
+            self._writer.join()
+            self._writer = None
+            _open_journals.discard(self)
         if self.filehandle:
             self.filehandle.close()
+        if self._write_error is not None:
+            raise self._write_error
 
     def _timestamp(self):
         return datetime.now(timezone.utc).isoformat()
@@ -135,17 +275,84 @@ class RunJournal(AbstractContextManager):
         self.close()
 
     def _caller_info(self):
-        frame = inspect.currentframe()
-        info = {}
+        # Skips the journal's own methods by their code objects, so only the caller's frame has its locals read,
+        # and only when its code has a self, which names the class the method runs on.
+        own_code = _journal_code(type(self))
+        frame = sys._getframe(1)
+        while frame.f_code in own_code:
+            frame = frame.f_back
+        code = frame.f_code
+        if _has_self(code):
+            try:
+                return {"class": type(frame.f_locals["self"]).__name__, "method": code.co_name}
+            except KeyError:
+                pass  # self isn't bound yet
+        return {"function": code.co_name}
+
+
+@functools.cache
+def _journal_code(journal_class) -> frozenset:
+    """The code of every method a journal class has, other than __init__, whose entries belong to its creator."""
+    return frozenset(
+        value.__code__
+        for klass in journal_class.__mro__
+        for name, value in vars(klass).items()
+        if name != "__init__" and inspect.isfunction(value)
+    )
+
+
+@functools.cache
+def _has_self(code) -> bool:
+    return "self" in code.co_varnames or "self" in code.co_cellvars or "self" in code.co_freevars
+
+
+def flush_open_journals():
+    for journal in list(_open_journals):
         try:
-            while "self" in frame.f_locals and frame.f_locals["self"] == self and frame.f_code.co_name != "__init__":
-                frame = frame.f_back
-            if "self" in frame.f_locals:
-                info["class"] = frame.f_locals["self"].__class__.__name__
-                info["method"] = frame.f_code.co_name
+            journal.flush()
+        except Exception:
+            pass
+
+
+def _close_open_journals():
+    # at exit nothing else will write to them, so finish them off properly
+    for journal in list(_open_journals):
+        try:
+            journal.close()
+        except Exception:
+            pass
+
+
+def _close_open_journals_then_kill(signum):
+    _close_open_journals()
+    os.kill(os.getpid(), signum)
+
+
+atexit.register(_close_open_journals)
+
+
+def flush_journals_on_signals(signums=(signal.SIGTERM, signal.SIGHUP)):
+    """Makes the given signals write out every open journal before they do whatever they did before.
+
+    The journals are written from another thread, as the signal may have interrupted a thread holding a journal's
+    lock or waiting for room in its queue. For signals that end the process by default, that thread closes the
+    journals, then sends the signal again. Only works from the main thread; elsewhere it does nothing."""
+    global _flushing_on_signals
+    if _flushing_on_signals or threading.current_thread() is not threading.main_thread():
+        return
+    for signum in signums:
+        previous = signal.getsignal(signum)
+
+        def handler(sig, frame, previous=previous):
+            if callable(previous) or previous == signal.SIG_IGN:
+                threading.Thread(target=flush_open_journals, name="journal-flush", daemon=True).start()
+                if callable(previous):
+                    previous(sig, frame)
             else:
-                info["function"] = frame.f_code.co_name
-        except KeyError:
-            print(f"Unexpected failure for {frame} with locals {list(frame.f_locals.keys())}")
+                signal.signal(sig, signal.SIG_DFL)
+                threading.Thread(
+                    target=_close_open_journals_then_kill, args=(sig,), name="journal-close", daemon=True
+                ).start()
 
-        return info
+        signal.signal(signum, handler)
+    _flushing_on_signals = True
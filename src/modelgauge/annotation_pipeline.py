@@ -1,11 +1,15 @@
 import time
+from typing import Optional
 
 from airrlogger.log_config import get_logger
 from pydantic import BaseModel
 
+from modelbench.cache import MBCache, NullCache
 from modelgauge.annotator import Annotator
 from modelgauge.dataset import AnnotationDataset, PromptResponseDataset
 from modelgauge.pipeline import CachingPipe, Pipe, Sink, Source
+from modelgauge.rate_limits import RATE_LIMITS, estimate_tokens
+from modelgauge.response_store import annotator_response_key
 from modelgauge.single_turn_prompt_response import AnnotatedSUTInteraction, SUTInteraction
 
 logger = get_logger(__name__)
@@ -31,12 +35,20 @@ class AnnotatorAssigner(Pipe):
 
 
 class AnnotatorWorkers(CachingPipe):
-    def __init__(self, annotators: dict[str, Annotator], workers=None, cache_path=None):
+    def __init__(
+        self,
+        annotators: dict[str, Annotator],
+        workers=None,
+        cache_path=None,
+        adaptive_concurrency=False,
+        response_store: Optional[MBCache] = None,
+    ):
         self.sleep_time = 10
         if workers is None:
             workers = 8
-        super().__init__(thread_count=workers, cache_path=cache_path)
+        super().__init__(thread_count=workers, cache_path=cache_path, adaptive_concurrency=adaptive_concurrency)
         self.annotators = annotators
+        self.response_store = response_store if response_store is not None else NullCache()
         self.annotation_counts = {uid: 0 for uid in annotators}
 
     def key(self, item):
@@ -51,20 +63,31 @@ class AnnotatorWorkers(CachingPipe):
         sut_interaction, annotator_uid = item
         annotator = self.annotators[annotator_uid]
         request = annotator.translate_request(sut_interaction.prompt, sut_interaction.response)
+        response = self.response_store.get_or_compute(
+            annotator_response_key(annotator_uid, request), lambda: self._annotate(annotator_uid, request)
+        )
+        result = annotator.translate_response(request, response)
+        self.annotation_counts[annotator_uid] += 1
+        return AnnotatedSUTInteraction(annotator_uid=annotator_uid, annotation=result, sut_interaction=sut_interaction)
+
+    def _annotate(self, annotator_uid: str, request):
+        request_tokens = estimate_tokens(request)
         tries = 0
         while True:
             tries += 1
             try:
-                response = annotator.annotate(request)
-                break
+                RATE_LIMITS.acquire(annotator_uid, tokens=request_tokens)
+                with self.concurrency_slot(annotator_uid):
+                    return self.annotators[annotator_uid].annotate(request)
             except Exception as e:
                 logger.warning(
                     f"Exception calling annotator {annotator_uid} on attempt {tries}: {e}\nRetrying.....", exc_info=True
                 )
                 time.sleep(self.sleep_time)
-        result = annotator.translate_response(request, response)
-        self.annotation_counts[annotator_uid] += 1
-        return AnnotatedSUTInteraction(annotator_uid=annotator_uid, annotation=result, sut_interaction=sut_interaction)
+
+    def join(self):
+        super().join()
+        self.response_store.__exit__(None, None, None)
 
 
 class AnnotatorSink(Sink):
@@ -72,9 +95,8 @@ class AnnotatorSink(Sink):
         super().__init__()
         self.writer = writer
 
-    def run(self):
-        with self.writer:
-            super().run()
+    def run_context(self):
+        return self.writer
 
     def handle_item(self, item: AnnotatedSUTInteraction):
         self.writer.write(item)
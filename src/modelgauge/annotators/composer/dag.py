@@ -15,7 +15,7 @@ import pandas as pd  # type: ignore
 from airrlogger.log_config import get_logger
 from tqdm import tqdm
 
-from modelbench.cache import DiskCache, MBCache, NullCache
+from modelbench.cache import DiskCache, MBCache, NullCache, TieredCache
 from modelgauge.annotators.composer.context import EvalContext, NodeOutput
 from modelgauge.annotators.composer.cost import CostInfo, RealizedCost
 from modelgauge.annotators.composer.nodes import (
@@ -180,7 +180,9 @@ class Composer:
         self._nodes[node.name] = node
         self._validated = False
         if isinstance(node, CacheableNodeMixin):
-            self._node_caches[node.name] = DiskCache(self._cache_path / node.name) if self._cache_path else NullCache()
+            self._node_caches[node.name] = (
+                TieredCache(DiskCache(self._cache_path / node.name)) if self._cache_path else NullCache()
+            )
         return self
 
     def _validate_and_build(self) -> None:
@@ -250,13 +252,7 @@ class Composer:
 
     def _run_node(self, node: ComposerNode, ctx: EvalContext) -> NodeOutput:
         if isinstance(node, CacheableNodeMixin):
-            key = node.cache_key(ctx)
-            if key in self._node_caches[node.name]:
-                return self._node_caches[node.name][key]
-            else:
-                output = node.run(ctx)
-                self._node_caches[node.name][key] = output
-                return output
+            return self._node_caches[node.name].get_or_compute(node.cache_key(ctx), lambda: node.run(ctx))
         else:
             return node.run(ctx)
 
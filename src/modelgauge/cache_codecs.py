@@ -0,0 +1,125 @@
+"""How cached SUT and annotator responses are turned into bytes and back.
+
+Every encoded value starts with a short header: a magic string, the format version, which codec wrote it, and whether
+the payload is zstd compressed. Payloads over a size threshold are compressed, which mostly matters for responses
+carrying logprobs. Values without the header were stored before codecs were used, and are returned unchanged.
+"""
+
+import pickle
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+import zstandard
+
+from modelgauge.typed_data import TypedData, is_typeable
+
+MAGIC = b"MGC"
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 3
+COMPRESS_ABOVE = 4 * 2**10  # 2**10 = 1 KB
+COMPRESSION_LEVEL = 3
+
+_ZSTD_FLAG = 0x01
+
+
+class CacheCodec(ABC):
+    """Turns a value into bytes and back. Each codec has a unique id, which is written into every value it encodes."""
+
+    codec_id: int
+    name: str
+
+    def can_encode(self, obj) -> bool:
+        return True
+
+    @abstractmethod
+    def encode(self, obj) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Any:
+        pass
+
+
+class PickleCodec(CacheCodec):
+    """Fastest for arbitrary Python objects, but only readable by code that has the same classes."""
+
+    codec_id = 1
+    name = "pickle"
+
+    def encode(self, obj) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class TypedJsonCodec(CacheCodec):
+    """Portable JSON for pydantic objects and dicts, recording the type so it can be rebuilt."""
+
+    codec_id = 2
+    name = "json"
+
+    def can_encode(self, obj) -> bool:
+        return is_typeable(obj)
+
+    def encode(self, obj) -> bytes:
+        return TypedData.from_instance(obj).model_dump_json().encode("utf-8")
+
+    def decode(self, data: bytes) -> Any:
+        return TypedData.model_validate_json(data).to_instance()
+
+
+CODECS: dict[str, CacheCodec] = {codec.name: codec for codec in (PickleCodec(), TypedJsonCodec())}
+_CODECS_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+
+# zstd contexts aren't thread-safe, so each thread gets its own
+_zstd = threading.local()
+
+
+def _compressor() -> zstandard.ZstdCompressor:
+    if not hasattr(_zstd, "compressor"):
+        _zstd.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    return _zstd.compressor
+
+
+def _decompressor() -> zstandard.ZstdDecompressor:
+    if not hasattr(_zstd, "decompressor"):
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.decompressor
+
+
+def encode_value(obj, codec: CacheCodec, compress_above: int = COMPRESS_ABOVE) -> bytes:
+    payload = codec.encode(obj)
+    flags = 0
+    if len(payload) > compress_above:
+        payload = _compressor().compress(payload)
+        flags |= _ZSTD_FLAG
+    return MAGIC + bytes((FORMAT_VERSION, codec.codec_id, flags)) + payload
+
+
+def is_encoded(value) -> bool:
+    return isinstance(value, bytes) and value[: len(MAGIC)] == MAGIC and len(value) >= HEADER_SIZE
+
+
+def decode_value(value, expected_codec: Optional[CacheCodec] = None):
+    """The object encoded in value. Anything not written by encode_value is returned as it is.
+
+    With expected_codec, only values that codec wrote are decoded; anything else raises ValueError. Use it for values
+    from sources that aren't trusted to send pickles."""
+    if not is_encoded(value):
+        if expected_codec is not None:
+            raise ValueError(f"Expected a value encoded with {expected_codec.name}, but it isn't encoded.")
+        return value
+    version, codec_id, flags = value[len(MAGIC) : HEADER_SIZE]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Can't decode cache format version {version}; this code reads version {FORMAT_VERSION}.")
+    if expected_codec is not None and codec_id != expected_codec.codec_id:
+        raise ValueError(f"Expected a value encoded with {expected_codec.name}, but it has codec id {codec_id}.")
+    codec = _CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unknown cache codec id {codec_id}.")
+    payload = value[HEADER_SIZE:]
+    if flags & _ZSTD_FLAG:
+        payload = _decompressor().decompress(payload)
+    return codec.decode(payload)
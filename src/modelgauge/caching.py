@@ -1,7 +1,12 @@
 import hashlib
 import json
 import os
+import sqlite3
+import time
 from abc import ABC, abstractmethod
+from contextlib import closing
+from typing import Any, Callable, Optional
+from modelgauge.cache_codecs import CacheCodec, TypedJsonCodec, decode_value, encode_value
 from modelgauge.general import normalize_filename
 from modelgauge.typed_data import Typeable, TypedData, is_typeable
 from pydantic import BaseModel
@@ -43,24 +48,50 @@ class SqlDictCache(Cache):
 
     Will create a `file_identifier`_cache.sqlite file in `data_dir` to persist
     the cache.
+
+    Writes are committed in batches, every `commit_every` entries or once
+    `commit_interval` seconds have passed since the last commit, whichever
+    comes first. Anything still pending is committed on `__exit__`. The
+    database uses SQLite's write-ahead log unless given another `journal_mode`.
+
+    Responses are stored as bytes written by `codec`. Files from before
+    codecs were used are still read and written in their old format; use
+    `modelgauge cache convert` to move them to the new one.
     """
 
-    _CACHE_SCHEMA_VERSION = "v1"
+    _CACHE_SCHEMA_VERSION = "v2"
     """Version is encoded in the table name to identify the schema."""
-
-    def __init__(self, data_dir, file_identifier):
+    _LEGACY_SCHEMA_VERSION = "v1"
+
+    def __init__(
+        self,
+        data_dir,
+        file_identifier,
+        commit_every: int = 100,
+        commit_interval: float = 1.0,
+        journal_mode: str = "WAL",
+        codec: Optional[CacheCodec] = None,
+    ):
         os.makedirs(data_dir, exist_ok=True)
         fname = normalize_filename(f"{file_identifier}_cache.sqlite")
         path = os.path.join(data_dir, fname)
+        self.codec = codec or TypedJsonCodec()
+        self.legacy = os.path.exists(path) and _table_names(path) == [self._LEGACY_SCHEMA_VERSION]
+        schema_version = self._LEGACY_SCHEMA_VERSION if self.legacy else self._CACHE_SCHEMA_VERSION
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending_writes = 0
+        self._last_commit = time.monotonic()
         self.cached_responses = SqliteDict(
             path,
-            tablename=self._CACHE_SCHEMA_VERSION,
-            encode=json.dumps,
-            decode=json.loads,
+            tablename=schema_version,
+            encode=json.dumps if self.legacy else _identity,
+            decode=json.loads if self.legacy else _identity,
+            journal_mode=journal_mode,
         )
-        tables = SqliteDict.get_tablenames(path)
-        assert tables == [self._CACHE_SCHEMA_VERSION], (
-            f"Expected only table to be {self._CACHE_SCHEMA_VERSION}, " f"but found {tables} in {path}."
+        tables = _table_names(path)
+        assert tables == [schema_version], (
+            f"Expected only table to be {schema_version}, " f"but found {tables} in {path}."
         )
 
     def __enter__(self):
@@ -68,8 +99,16 @@ class SqlDictCache(Cache):
         return self
 
     def __exit__(self, *exc_info):
+        self.commit()
         self.cached_responses.close()
 
+    def commit(self):
+        """Commit any writes that are still pending."""
+        if self._pending_writes:
+            self.cached_responses.commit()
+            self._pending_writes = 0
+        self._last_commit = time.monotonic()
+
     def get_or_call(self, request, callable):
         """Return the cached value, otherwise cache calling `callable`"""
         response = self.get_cached_response(request)
@@ -92,27 +131,90 @@ class SqlDictCache(Cache):
 
     def update_cache(self, request, response: Typeable):
         """Save `response` in the cache, keyed by `request`."""
-        if not self._can_encode(request) or not self._can_encode(response):
+        if not self._can_encode(request) or not self._can_encode_response(response):
             return
         cache_key = self._hash_request(request)
         encoded_response = self._encode_response(response)
         self.cached_responses[cache_key] = encoded_response
-        self.cached_responses.commit()
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
 
     def _can_encode(self, obj) -> bool:
         # Encoding currently requires Pydanic objects.
         return is_typeable(obj)
 
-    def _encode_response(self, response: Typeable) -> str:
-        return CacheEntry(payload=TypedData.from_instance(response)).model_dump_json()
+    def _can_encode_response(self, response) -> bool:
+        return self._can_encode(response) if self.legacy else self.codec.can_encode(response)
 
-    def _decode_response(self, encoded_response: str):
-        return CacheEntry.model_validate_json(encoded_response).payload.to_instance()
+    def _encode_response(self, response: Typeable) -> str | bytes:
+        if self.legacy:
+            return CacheEntry(payload=TypedData.from_instance(response)).model_dump_json()
+        return encode_value(response, self.codec)
+
+    def _decode_response(self, encoded_response: str | bytes):
+        if self.legacy:
+            return _decode_legacy(encoded_response)
+        return decode_value(encoded_response)
 
     def _hash_request(self, request) -> str:
         return hashlib.sha256(TypedData.from_instance(request).model_dump_json().encode()).hexdigest()
 
 
+def _identity(value):
+    return value
+
+
+def _table_names(path) -> list[str]:
+    # SqliteDict.get_tablenames leaves its connection open, which keeps a WAL file from being checkpointed on close.
+    with closing(sqlite3.connect(path)) as conn:
+        return [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+
+def _decode_legacy(encoded_response: str | bytes):
+    return CacheEntry.model_validate_json(encoded_response).payload.to_instance()
+
+
+def convert_sql_dict_cache(path, codec: Optional[CacheCodec] = None) -> int:
+    """Rewrites the SqlDictCache file at path in the current format, with its responses encoded by codec.
+
+    Works on files in the old format and on current ones written with another codec. Returns how many entries
+    were converted."""
+    codec = codec or TypedJsonCodec()
+    tables = _table_names(path)
+    # SqlDictCache writes in WAL mode, and switching such a file back to DELETE fails while it is open.
+    decode: Callable[[Any], Any]
+    if tables == [SqlDictCache._LEGACY_SCHEMA_VERSION]:
+        old = SqliteDict(path, tablename=tables[0], encode=json.dumps, decode=json.loads, flag="r", journal_mode="WAL")
+        decode = _decode_legacy
+    elif tables == [SqlDictCache._CACHE_SCHEMA_VERSION]:
+        old = SqliteDict(path, tablename=tables[0], encode=_identity, decode=_identity, flag="r", journal_mode="WAL")
+        decode = decode_value
+    else:
+        raise ValueError(f"{path} doesn't look like a SqlDictCache file; it has tables {tables}.")
+
+    converted_path = f"{path}.converting"
+    if os.path.exists(converted_path):
+        os.remove(converted_path)
+    count = 0
+    with (
+        old,
+        SqliteDict(
+            converted_path,
+            tablename=SqlDictCache._CACHE_SCHEMA_VERSION,
+            encode=_identity,
+            decode=_identity,
+            journal_mode="WAL",
+        ) as new,
+    ):
+        for key, value in old.items():
+            new[key] = encode_value(decode(value), codec)
+            count += 1
+        new.commit()
+    os.replace(converted_path, path)
+    return count
+
+
 class NoCache(Cache):
     """Implements the caching interface, but never actually caches."""
 
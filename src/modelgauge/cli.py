@@ -1,19 +1,25 @@
 import os
 import pathlib
+import subprocess
+import sys
 import warnings
 from typing import Optional, Sequence, Type
 
 import click
 from airrlogger.log_config import get_logger
 
+from modelbench.cache import DiskCache, convert_disk_cache
 from modelgauge.annotator import Annotator
 from modelgauge.annotator_registry import ANNOTATORS
 import modelgauge.annotators.cheval.registration  # noqa: F401
 from modelgauge.base_test import PromptResponseTest
+from modelgauge.cache_codecs import CODECS
+from modelgauge.caching import convert_sql_dict_cache
 from modelgauge.command_line import (  # usort:skip
     DATA_DIR_OPTION,
     LOCAL_PLUGIN_DIR_OPTION,
     MAX_TEST_ITEMS_OPTION,
+    RESPONSE_STORE_OPTION,
     display_header,
     display_list_item,
     cli,
@@ -25,9 +31,11 @@ from modelgauge.general import normalize_filename
 from modelgauge.instance_factory import FactoryEntry
 from modelgauge.load_namespaces import list_objects
 from modelgauge.model_options import ModelOptions
-from modelgauge.pipeline_runner import build_runner
+from modelgauge.pipeline_runner import QueuedJobWorker, build_runner
+from modelgauge.pipeline_stats import describe_progress
 from modelgauge.preflight import check_secrets, make_sut
 from modelgauge.prompt import TextPrompt
+from modelgauge.rate_limits import RATE_LIMITS
 from modelgauge.secret_values import get_all_secrets, RawSecrets
 from modelgauge.simple_test_runner import run_prompt_response_test
 from modelgauge.single_turn_prompt_response import SUTResponse, TestItem
@@ -36,6 +44,7 @@ from modelgauge.sut_capabilities_verification import assert_sut_capabilities
 from modelgauge.sut_capabilities import AcceptsTextPrompt, ProducesPerTokenLogProbabilities, SUTCapability
 from modelgauge.sut_registry import SUTS
 from modelgauge.test_registry import TESTS
+from modelgauge.work_queue import WorkQueue
 
 logger = get_logger(__name__)
 
@@ -227,6 +236,7 @@ def run_annotator(
     default=False,
     help="Disable displaying the 'Processing TestItems' progress bar.",
 )
+@RESPONSE_STORE_OPTION
 def run_test(
     test: str,
     sut: str,
@@ -235,6 +245,7 @@ def run_test(
     output_file: Optional[str],
     no_caching: bool,
     no_progress_bar: bool,
+    response_store: Optional[str],
 ):
     """Run the Test on the desired SUT and output the TestRecord."""
     # Check for missing secrets without instantiating any objects
@@ -265,6 +276,7 @@ def run_test(
         max_test_items,
         use_caching=not no_caching,
         disable_progress_bar=no_progress_bar,
+        response_store=response_store,
     )
     with open(output_file, "w") as f:
         print(test_record.model_dump_json(indent=4), file=f)
@@ -294,7 +306,12 @@ def run_test(
     "--workers",
     type=int,
     default=None,
-    help="Number of worker threads, default is 10 * number of SUTs.",
+    help="Number of worker threads for each SUT and for the annotators, default is 8.",
+)
+@click.option(
+    "--adaptive-workers",
+    is_flag=True,
+    help="Adjust concurrency per SUT and annotator between 1 and --workers based on errors and latency.",
 )
 @click.option(
     "--output-dir",
@@ -303,6 +320,12 @@ def run_test(
     type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
 )
 @click.option("--tag", type=str, help="Tag to include in the output directory name.")
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
+    default=None,
+    help="Directory to cache SUT and annotator responses in.",
+)
 @click.option("--debug", is_flag=True, help="Show internal pipeline debugging information.")
 @click.option("--jailbreak", is_flag=True, help="Send seed prompts to annotators instead of regular prompts.")
 @click.option("--prompt_uid_col", type=str, default=None, help="Column name for prompt UID in the input file.")
@@ -315,6 +338,19 @@ def run_test(
 )
 @click.option("--sut_uid_col", type=str, default=None, help="Column name for SUT UID in the input file.")
 @click.option("--sut_response_col", type=str, default=None, help="Column name for sut response in the input file.")
+@click.option(
+    "--work-queue",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Queue the work in this SQLite file for `modelgauge run-job-worker` processes to do, then collect the output.",
+)
+@click.option(
+    "--local-workers",
+    type=click.IntRange(0),
+    default=0,
+    help="Number of worker processes to start on this machine when using --work-queue.",
+)
+@RESPONSE_STORE_OPTION
 @click.argument(
     "input_path",
     type=click.Path(exists=True, path_type=pathlib.Path),
@@ -323,8 +359,10 @@ def run_job(
     sut,
     annotator_uids,
     workers,
+    adaptive_workers,
     output_dir,
     tag,
+    cache_dir,
     debug,
     jailbreak,
     input_path,
@@ -338,15 +376,26 @@ def run_job(
     seed_prompt_text_col,
     sut_uid_col,
     sut_response_col,
+    work_queue,
+    local_workers,
+    response_store,
 ):
     """Run rows in a CSV through (a) SUT(s) and/or a set of annotators.
 
     If running a SUT, the file must have 'UID' and 'Text' columns. The output will be saved to a CSV file.
     If running ONLY annotators, the file must have 'UID', 'Prompt', 'SUT', and 'Response' columns. The output will be saved to a json lines file.
+
+    With --work-queue, this process only queues the work and collects the output. Start workers for the queue with
+    --local-workers and/or by running `modelgauge run-job-worker` with the same SUT and annotators on other machines.
     """
+    if local_workers and not work_queue:
+        raise click.UsageError("--local-workers requires --work-queue.")
+    if work_queue and work_queue.exists():
+        raise click.UsageError(f"Work queue {work_queue} already exists.")
     # TODO: break this function up. It's branching too much
     # make sure the job has everything it needs to run
     secrets = load_secrets_from_config()
+    RATE_LIMITS.configure_from_secrets(secrets)
     if sut:
         sut_options = ModelOptions.create_from_arguments(max_tokens, temp, top_p, top_k, top_logprobs)
         sut_instance = make_sut(sut)
@@ -369,8 +418,10 @@ def run_job(
         suts={sut: sut_instance} if sut else None,
         annotators=annotators,
         num_workers=workers,
+        adaptive_workers=adaptive_workers,
         input_path=input_path,
         output_dir=output_dir,
+        cache_dir=cache_dir,
         sut_options=sut_options,
         tag=tag,
         prompt_uid_col=prompt_uid_col,
@@ -379,6 +430,7 @@ def run_job(
         sut_uid_col=sut_uid_col,
         sut_response_col=sut_response_col,
         jailbreak=jailbreak,
+        response_store=response_store,
     )
 
     with click.progressbar(
@@ -387,18 +439,138 @@ def run_job(
         + (f" * 1 SUT" if sut else "")
         + (f" * {len(annotators)} annotators" if annotators else "")
         + ":",
+        item_show_func=lambda event: describe_progress(event) if event else None,
     ) as bar:
         last_complete_count = 0
 
         def show_progress(data):
             nonlocal last_complete_count
             complete_count = data["completed"]
-            bar.update(complete_count - last_complete_count)
+            bar.update(complete_count - last_complete_count, data)
             last_complete_count = complete_count
             if last_complete_count == pipeline_runner.num_total_items:
                 print()  # Print new line after progress bar for better formatting.
 
-        pipeline_runner.run(show_progress, debug)
+        if work_queue:
+            queue = WorkQueue(work_queue)
+            pipeline_runner.enqueue_work(queue, debug)
+            worker_command = [sys.executable, "-m", "modelgauge.cli", "run-job-worker", str(work_queue)]
+            if sut:
+                worker_command += ["--sut", sut]
+            for annotator_uid in annotator_uids:
+                worker_command += ["--annotator", annotator_uid]
+            if workers:
+                worker_command += ["--workers", str(workers)]
+            if adaptive_workers:
+                worker_command.append("--adaptive-workers")
+            if response_store:
+                worker_command += ["--response-store", str(response_store)]
+            if cache_dir:
+                worker_command += ["--cache-dir", str(cache_dir)]
+            if debug:
+                worker_command.append("--debug")
+            processes = [subprocess.Popen(worker_command) for _ in range(local_workers)]
+            pipeline_runner.collect_work(queue, show_progress, debug, workers=processes)
+            for process in processes:
+                process.wait()
+        else:
+            pipeline_runner.run(show_progress, debug)
+
+
+@cli.command()
+@click.option("-s", "--sut", help="The SUT the queued job runs.", required=False)
+@click.option(
+    "annotator_uids",
+    "-a",
+    "--annotator",
+    help="The annotator(s) the queued job runs.",
+    multiple=True,
+    required=False,
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of worker threads for each SUT and for the annotators, default is 8.",
+)
+@click.option(
+    "--adaptive-workers",
+    is_flag=True,
+    help="Adjust concurrency per SUT and annotator between 1 and --workers based on errors and latency.",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
+    default=None,
+    help="Directory to cache SUT and annotator responses in.",
+)
+@click.option("--debug", is_flag=True, help="Show internal pipeline debugging information.")
+@RESPONSE_STORE_OPTION
+@click.argument("work_queue", type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path))
+def run_job_worker(sut, annotator_uids, workers, adaptive_workers, cache_dir, debug, response_store, work_queue):
+    """Work on a job queued by `modelgauge run-job --work-queue` until it is finished.
+
+    Pass the same SUT and annotators as the queued job. Any number of workers can share one queue.
+    """
+    secrets = load_secrets_from_config()
+    RATE_LIMITS.configure_from_secrets(secrets)
+    check_secrets(secrets, sut_uids=[sut] if sut else None, annotator_uids=annotator_uids)
+    suts = {sut: make_sut(sut)} if sut else None
+    annotators = {uid: ANNOTATORS.make_instance(uid, secrets=secrets) for uid in annotator_uids}
+    worker = QueuedJobWorker(
+        WorkQueue(work_queue),
+        suts=suts,
+        annotators=annotators,
+        num_workers=workers,
+        cache_dir=cache_dir,
+        adaptive_workers=adaptive_workers,
+        response_store=response_store,
+    )
+    worker.run(debug=debug)
+
+
+@cli.group(name="cache")
+def cache_group():
+    """Look after the response caches written by runs."""
+
+
+def _find_caches(path: pathlib.Path):
+    """The SqlDictCache files and DiskCache directories at or under path."""
+    if path.is_file():
+        yield "sqlite", path
+    elif (path / "cache.db").exists():
+        yield "disk", path
+    else:
+        for sqlite_path in sorted(path.rglob("*_cache.sqlite")):
+            yield "sqlite", sqlite_path
+        for db_path in sorted(path.rglob("cache.db")):
+            yield "disk", db_path.parent
+
+
+@cache_group.command(name="convert")
+@click.option(
+    "--codec",
+    type=click.Choice(sorted(CODECS)),
+    default=None,
+    help="How to encode responses. Defaults to json for run-test caches and pickle for the others.",
+)
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, path_type=pathlib.Path))
+def convert_cache(codec, paths):
+    """Rewrite caches in the current storage format.
+
+    Each path can be a run-test cache file (*_cache.sqlite), a cache directory like sut_cache, or a directory
+    containing either.
+    """
+    cache_codec = CODECS[codec] if codec else None
+    for path in paths:
+        for kind, cache_path in _find_caches(path):
+            if kind == "sqlite":
+                count = convert_sql_dict_cache(cache_path, cache_codec)
+            else:
+                cache = DiskCache(cache_path, codec=cache_codec)
+                with cache:
+                    count = convert_disk_cache(cache)
+            click.echo(f"Converted {count} entries in {cache_path}")
 
 
 if __name__ == "__main__":
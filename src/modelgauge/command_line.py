@@ -9,6 +9,7 @@ from modelgauge.annotator_registry import ANNOTATORS
 from modelgauge.cli_lazy import LOAD_ALL, LazyModuleImportGroup
 from modelgauge.config import write_default_config
 from modelgauge.preflight import listify
+from modelgauge.response_store import RESPONSE_STORE_ENV
 from modelgauge.sut_factory import SUT_FACTORY
 from modelgauge.test_registry import TESTS
 
@@ -57,6 +58,15 @@ DATA_DIR_OPTION = click.option(
     help="Where to store the auxiliary data produced during the run.",
 )
 
+RESPONSE_STORE_OPTION = click.option(
+    "--response-store",
+    envvar=RESPONSE_STORE_ENV,
+    default=None,
+    type=str,
+    help="Directory, or URL of a `modelbench cache serve` server, holding SUT and annotator responses shared with "
+    f"other runs. Also set by ${RESPONSE_STORE_ENV}.",
+)
+
 MAX_TEST_ITEMS_OPTION = click.option(
     "-m",
     "--max-test-items",
@@ -1,9 +1,15 @@
-from contextlib import AbstractContextManager
-from threading import Lock
-from typing import Generic, TypeVar
+import time
+from contextlib import AbstractContextManager, contextmanager
+from threading import Condition, Lock
+from typing import Generic, Optional, TypeVar
+
+from modelgauge.monitoring import PROMETHEUS
 
 T = TypeVar("T")
 
+CONCURRENCY_LIMIT = PROMETHEUS.gauge("mm_concurrency_limit", "Adaptive concurrency limit", ["stage", "uid"])
+CONCURRENCY_IN_FLIGHT = PROMETHEUS.gauge("mm_concurrency_in_flight", "Calls in flight", ["stage", "uid"])
+
 
 class ThreadSafeWrapper(AbstractContextManager, Generic[T]):
     """A wrapper that makes thread-hostile objects thread-safe.
@@ -28,3 +34,124 @@ class ThreadSafeWrapper(AbstractContextManager, Generic[T]):
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self._lock.__exit__(exc_type, exc_value, traceback)
+
+
+class AIMDLimit:
+    """A concurrency limit that adapts to a remote service the way TCP adapts to a network.
+
+    While calls succeed, the limit grows additively by about one slot per limit's worth of calls. When a call fails,
+    or when smoothed latency rises well above the best latency seen so far, the limit is cut multiplicatively. Only
+    one cut is made per round of in-flight calls, so a burst of failures from calls that were all started under the
+    old limit doesn't collapse the limit to its minimum.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: Optional[int] = None,
+        decrease_factor: float = 0.5,
+        latency_tolerance: Optional[float] = 3.0,
+        latency_smoothing: float = 0.2,
+    ):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError(f"Need 1 <= min_limit <= max_limit, got {min_limit} and {max_limit}")
+        if not 0 < decrease_factor < 1:
+            raise ValueError(f"decrease_factor must be between 0 and 1, got {decrease_factor}")
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_smoothing = latency_smoothing
+        self._limit = float(max_limit if initial_limit is None else min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._generation = 0
+        self._latency: Optional[float] = None
+        self._baseline_latency: Optional[float] = None
+        self._condition = Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self) -> int:
+        """Block until there is room under the limit. Returns a token to hand back to release."""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            return self._generation
+
+    def release(self, token: int, latency: float, failed: bool):
+        with self._condition:
+            self._in_flight -= 1
+            if failed or self._latency_is_congested(latency):
+                if token == self._generation:
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._generation += 1
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def _latency_is_congested(self, latency: float) -> bool:
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = self.latency_smoothing * latency + (1 - self.latency_smoothing) * self._latency
+        if self._baseline_latency is None:
+            self._baseline_latency = self._latency
+        else:
+            # Let the baseline creep upward so a lasting change in the service's speed is eventually accepted.
+            self._baseline_latency = min(self._latency, self._baseline_latency * 1.01)
+        if self.latency_tolerance is None:
+            return False
+        return self._latency > self._baseline_latency * self.latency_tolerance
+
+
+class AdaptiveConcurrency:
+    """A set of AIMDLimits for one pipeline stage, one per key, e.g. per SUT or annotator uid.
+
+    Example usage:
+
+        concurrency = AdaptiveConcurrency("PromptSutWorkers", max_limit=32)
+        with concurrency.slot(sut.uid):
+            response = sut.evaluate(request)
+    """
+
+    def __init__(self, stage: str, max_limit: int, **limit_kwargs):
+        self.stage = stage
+        self.max_limit = max_limit
+        self._limit_kwargs = limit_kwargs
+        self._limits: dict[str, AIMDLimit] = {}
+        self._lock = Lock()
+
+    def limit_for(self, key: str) -> AIMDLimit:
+        with self._lock:
+            if key not in self._limits:
+                self._limits[key] = AIMDLimit(self.max_limit, **self._limit_kwargs)
+                CONCURRENCY_LIMIT.labels(self.stage, key).set(self._limits[key].limit)
+            return self._limits[key]
+
+    def limits(self) -> dict[str, int]:
+        with self._lock:
+            return {key: limit.limit for key, limit in self._limits.items()}
+
+    @contextmanager
+    def slot(self, key: str):
+        """Hold one unit of key's concurrency for the duration of the block; exceptions count as failures."""
+        limit = self.limit_for(key)
+        token = limit.acquire()
+        CONCURRENCY_IN_FLIGHT.labels(self.stage, key).inc()
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            limit.release(token, time.perf_counter() - start, failed)
+            CONCURRENCY_IN_FLIGHT.labels(self.stage, key).dec()
+            CONCURRENCY_LIMIT.labels(self.stage, key).set(limit.limit)
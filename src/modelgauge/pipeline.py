@@ -49,38 +49,107 @@ like:
 Note that this generally only helps when the code is waiting on the network or other I/O. Python's Global Intepreter
 Lock (GIL) means that generally only one bit of python is running at once.
 
+If you need thousands of requests in flight at once, threads get expensive. AsyncPipeline takes the same segments
+and runs them on a single asyncio event loop. Any segment may then define its handle_item as a coroutine:
+
+    class MyAsyncPipe(Pipe):
+
+        def __init__(self):
+            super().__init__(thread_count=5000)
+
+        async def handle_item(self, item):
+            return await some_remote_call(item)
+
+    AsyncPipeline(MySource(), MyAsyncPipe(), MySink()).run()
+
+For a coroutine handle_item, thread_count is the number of concurrent tasks rather than threads. Segments with an
+ordinary handle_item still work under AsyncPipeline; they run in a pool of thread_count threads.
+
+For CPU-bound stages, where the GIL would keep threads from helping, subclass ProcessPipe instead of Pipe and
+implement process_item as a staticmethod. It runs in a pool of worker processes.
+
+If items for one key (e.g. one SUT) can be much slower than the rest, pass lanes to the Pipe and implement lane_for.
+Each lane gets its own queue and thread_count workers, so a slow lane only holds up the others once its queue is full:
+
+    class MyPipe(Pipe):
+
+        def __init__(self, suts):
+            super().__init__(thread_count=8, lanes=suts)
+
+        def lane_for(self, item):
+            return item.sut_uid
+
 """
 
+import asyncio
+import contextlib
+import contextvars
 import datetime
+import inspect
+import multiprocessing
+import os
 import queue
 import sys
 import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from queue import Queue
 from threading import Event, Thread
-from typing import Any, Callable, Iterable, Optional
+from typing import Any, Callable, Hashable, Iterable, Mapping, Optional
 import traceback
 
 import diskcache  # type: ignore
 
-from modelbench.cache import DiskCache, NullCache
+from modelbench.cache import DiskCache, NullCache, TieredCache
+from modelgauge.concurrency import AdaptiveConcurrency
 from modelgauge.monitoring import PROMETHEUS
+from modelgauge.pipeline_stats import ProgressMonitor, StageStats, TimedQueue
 
 ITEMS_ADDED = PROMETHEUS.counter("mm_items_added", "Items added")
 
+# Unless a segment asks for a specific size, its output queue holds this many items per downstream consumer.
+QUEUE_SIZE_PER_CONSUMER = 4
+
+
+class _EndOfStream:
+    """Marker put on a segment's queue once per downstream consumer when the segment has no more items."""
+
+    def __repr__(self):
+        return "<end of stream>"
+
+
+_END_OF_STREAM = _EndOfStream()
+
+
+class _TimedQueue(TimedQueue, Queue):
+    pass
+
+
+class _TimedAsyncQueue(TimedQueue, asyncio.Queue):
+    pass
+
+
+# Under AsyncPipeline, downstream_put collects output here so the worker can await room in the next queue.
+_PENDING_OUTPUT: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("_PENDING_OUTPUT", default=None)
+
 
 class PipelineSegment(ABC):
-    """A segment of a Pipeline used for parallel processing."""
+    """A segment of a Pipeline used for parallel processing.
 
-    default_timeout = 0.1
+    The output queue is bounded so a fast stage can't run far ahead of a slow one. If queue_maxsize is None, the
+    size is set when the next segment is connected, from how many consumers it has; 0 means unbounded.
+    """
 
-    def __init__(self, queue_maxsize=0):
+    def __init__(self, queue_maxsize=None):
         super().__init__()
         self._work_done = Event()
         self._upstream: Optional[PipelineSegment] = None
-        self._queue: Queue = Queue(queue_maxsize)
+        self._downstream: Optional[PipelineSegment] = None
+        self._queue_maxsize = queue_maxsize
+        self._queue: Queue = _TimedQueue(queue_maxsize or 0)
         self.completed = 0
+        self.stats = StageStats(self.__class__.__name__)
         self._debug_enabled = False
         self._thread_id = 0
 
@@ -89,12 +158,14 @@ class PipelineSegment(ABC):
 
     def downstream_put(self, item: Any):
         """Enqueue an item for the next segment in the pipeline to take."""
-        self._queue.put(item)
+        pending = _PENDING_OUTPUT.get()
+        if pending is not None:
+            pending.append(item)
+        else:
+            self._queue.put(item)
 
     def upstream_get(self, timeout=None):
-        """Dequeue an item from the previous segment in the pipeline"""
-        if timeout is None:
-            timeout = PipelineSegment.default_timeout
+        """Dequeue an item from the previous segment in the pipeline, blocking until one is available."""
         if self._upstream is None:
             raise (ValueError(f"{self} doesn't have an upstream connection"))
         self._debug("getting from upstream")
@@ -106,9 +177,14 @@ class PipelineSegment(ABC):
             raise
 
         self._debug("got item")
+        self._record_take(self._upstream._queue, item)
 
         return item
 
+    def _record_take(self, taken_from: Queue, item: Any):
+        if item is not _END_OF_STREAM:
+            self.stats.record_take(taken_from.last_wait(), taken_from.qsize())  # type: ignore[attr-defined]
+
     def upstream_task_done(self):
         self._upstream._queue.task_done()
 
@@ -118,6 +194,26 @@ class PipelineSegment(ABC):
 
         return self._work_done.is_set() and self._queue.empty()
 
+    def wait_until_done(self, timeout=None) -> bool:
+        """Block until this segment has finished its work or the timeout expires. Returns True if finished."""
+        return self._work_done.wait(timeout)
+
+    @property
+    def consumer_count(self) -> int:
+        """How many threads take items from the upstream queue; each needs its own end-of-stream marker."""
+        return 1
+
+    @property
+    def worker_count(self) -> int:
+        """How many items this segment can handle at once."""
+        return self.consumer_count
+
+    def _end_stream(self):
+        """Tell every consumer in the next segment that no more items are coming."""
+        if self._downstream is not None:
+            for _ in range(self._downstream.consumer_count):
+                self._queue.put(_END_OF_STREAM)
+
     def join(self):
         self._debug(
             f"joining queue {self._queue}: {self._queue.qsize()} {self._queue.unfinished_tasks} {self._queue.all_tasks_done}"
@@ -127,6 +223,12 @@ class PipelineSegment(ABC):
 
     def set_upstream(self, upstream: "PipelineSegment"):
         self._upstream = upstream
+        upstream._set_downstream(self)
+
+    def _set_downstream(self, downstream: "PipelineSegment"):
+        self._downstream = downstream
+        if self._queue_maxsize is None:
+            self._queue = _TimedQueue(downstream.consumer_count * QUEUE_SIZE_PER_CONSUMER)
 
     def _debug(self, message: str):
         if self._debug_enabled:
@@ -143,7 +245,7 @@ class PipelineSegment(ABC):
 class Source(PipelineSegment):
     """A pipeline segment that goes at the top. Only produces. Implement new_item_iterable."""
 
-    def __init__(self, queue_maxsize=0):
+    def __init__(self, queue_maxsize=None):
         super().__init__(queue_maxsize)
         self._thread = None
 
@@ -160,38 +262,89 @@ class Source(PipelineSegment):
         self._debug("starting run")
         self._work_done.clear()
         try:
-            for item in self.new_item_iterable():
+            iterator = iter(self.new_item_iterable())
+            while True:
+                started = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.stats.record_service(time.monotonic() - started, active=False)
                 ITEMS_ADDED.inc()
                 self._queue.put(item)
         except Exception as e:
             self._debug(f"exception {e} from iterable; ending early")
         self._work_done.set()
+        self._end_stream()
         self._debug(f"finished run")
 
     def join(self):
         super().join()
-        self._thread.join()
+        if self._thread:
+            self._thread.join()
 
 
 class Pipe(PipelineSegment):
     """A pipeline segment that goes in the middle. Both consumes and produces. Implement handle_item."""
 
-    def __init__(self, thread_count=1, queue_maxsize=None):
-        if queue_maxsize is None:
-            queue_maxsize = thread_count * 4
+    def __init__(self, thread_count=1, queue_maxsize=None, adaptive_concurrency=False, lanes=None):
         super().__init__(queue_maxsize)
+        if lanes is not None and type(self).lane_for is Pipe.lane_for:
+            raise ValueError(f"{self.__class__.__name__} has lanes but doesn't implement lane_for")
         self.thread_count = thread_count
+        self.lanes: Optional[list[Hashable]] = list(lanes) if lanes is not None else None
+        self._lane_queues: dict[Hashable, Queue] = {}
         self._workers = []
+        self.concurrency: Optional[AdaptiveConcurrency] = None
+        if adaptive_concurrency:
+            self.concurrency = AdaptiveConcurrency(self.__class__.__name__, max_limit=thread_count)
 
     def start(self):
         self._work_done.clear()
 
-        for i in range(self.thread_count):
-            thread = Thread(target=self.run, name=self.thread_name())
-            thread.start()
-            self._workers.append(thread)
+        if self.lanes is None:
+            for i in range(self.thread_count):
+                thread = Thread(target=self.run, name=self.thread_name())
+                thread.start()
+                self._workers.append(thread)
+        else:
+            self._lane_queues = {lane: _TimedQueue(self.lane_queue_size) for lane in self.lanes}
+            dispatcher = Thread(target=self._dispatch, name=self.thread_name("dispatch"))
+            dispatcher.start()
+            self._workers.append(dispatcher)
+            for lane_queue in self._lane_queues.values():
+                for i in range(self.thread_count):
+                    thread = Thread(target=self._run_lane, args=(lane_queue,), name=self.thread_name("lane"))
+                    thread.start()
+                    self._workers.append(thread)
         Thread(target=self._notice_complete).start()
 
+    @property
+    def consumer_count(self) -> int:
+        return self.thread_count if self.lanes is None else 1
+
+    @property
+    def worker_count(self) -> int:
+        return self.thread_count if self.lanes is None else self.thread_count * len(self.lanes)
+
+    @property
+    def lane_queue_size(self) -> int:
+        """Most items waiting in one lane. Once a lane is full, dispatching waits for it, so memory stays bounded."""
+        return QUEUE_SIZE_PER_CONSUMER * self.thread_count
+
+    def lane_for(self, item) -> Hashable:
+        """Which of the lanes the item goes to. Pipes that pass lanes must implement this."""
+        pass
+
+    def concurrency_slot(self, key: str) -> contextlib.AbstractContextManager:
+        """
+        Wrap each call to an external service in this. With adaptive concurrency on, it holds calls for the given
+        key (e.g. a SUT uid) to a limit between 1 and thread_count that shrinks on errors and slowdowns.
+        """
+        if self.concurrency is None:
+            return contextlib.nullcontext()
+        return self.concurrency.slot(key)
+
     @abstractmethod
     def handle_item(self, item) -> Optional[Any]:
         """
@@ -206,28 +359,58 @@ class Pipe(PipelineSegment):
             self._debug(f"joining {worker}")
             worker.join()
         self._work_done.set()
+        self._end_stream()
 
     def run(self):
         self._debug(f"starting run")
-        item = None
-        while not self._upstream.done():
+        self._handle_items(self.upstream_get, self.upstream_task_done)
+        self._debug(f"run finished")
+
+    def _run_lane(self, lane_queue: Queue):
+        self._debug(f"starting lane")
+
+        def get():
+            item = lane_queue.get()
+            self._record_take(lane_queue, item)
+            return item
+
+        self._handle_items(get, lane_queue.task_done)
+        self._debug(f"lane finished")
+
+    def _handle_items(self, get: Callable[[], Any], task_done: Callable[[], None]):
+        while True:
             self._debug(f"trying get")
+            item = get()
+            if item is _END_OF_STREAM:
+                task_done()
+                break
             try:
-                item = self.upstream_get()
-                result = self.handle_item(item)
+                with self.stats.handling():
+                    result = self.handle_item(item)
                 if result:
                     self.downstream_put(result)
                 self.completed += 1
-                self.upstream_task_done()
+                task_done()
                 self._debug(f"success with {item} -> {result}")
-            except queue.Empty:
-                pass  # that's cool
-                self._debug(f"empty")
             except Exception as e:
                 self._debug(f"skipping item; exception {e} while processing {item}\n{traceback.format_exc()}")
-                self.upstream_task_done()
+                task_done()
 
-        self._debug(f"run finished")
+    def _dispatch(self):
+        """Move items from the upstream queue to their lanes. Stats are taken from the lane queues instead."""
+        while True:
+            item = self._upstream._queue.get()
+            if item is _END_OF_STREAM:
+                self.upstream_task_done()
+                break
+            try:
+                self._lane_queues[self.lane_for(item)].put(item)
+            except Exception as e:
+                self._debug(f"skipping item; exception {e} finding the lane for {item}")
+            self.upstream_task_done()
+        for lane_queue in self._lane_queues.values():
+            for _ in range(self.thread_count):
+                lane_queue.put(_END_OF_STREAM)
 
     def join(self):
         self._debug(f"joining super")
@@ -238,28 +421,78 @@ class Pipe(PipelineSegment):
         self._debug(f"join done")
 
 
+class ProcessPipe(Pipe):
+    """A Pipe whose work happens in a pool of worker processes, for CPU-bound stages. Implement process_item.
+
+    process_item must be a staticmethod, as it runs in another process and can't see this object. The item goes
+    across by pickling, so if the work needs only part of a large item, override to_worker to send just that part
+    and from_worker to combine the result with the original item back in this process.
+    """
+
+    def __init__(self, process_count=None, queue_maxsize=None):
+        process_count = process_count or os.cpu_count() or 1
+        super().__init__(thread_count=process_count, queue_maxsize=queue_maxsize)
+        self.process_count = process_count
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    @staticmethod
+    @abstractmethod
+    def process_item(item) -> Optional[Any]:
+        """Runs in a worker process. Takes whatever to_worker returns; returns what from_worker receives."""
+        pass
+
+    def to_worker(self, item) -> Any:
+        return item
+
+    def from_worker(self, result, item) -> Optional[Any]:
+        return result
+
+    def handle_item(self, item) -> Optional[Any]:
+        result = self._get_pool().submit(type(self).process_item, self.to_worker(item)).result()
+        return self.from_worker(result, item)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn rather than fork, as forking a process that has other threads running isn't safe.
+                self._pool = ProcessPoolExecutor(self.process_count, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def join(self):
+        super().join()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
 class CachingPipe(Pipe):
     """A Pipe that optionally caches results the given directory. Implement key and handle_uncached_item."""
 
-    def __init__(self, thread_count=1, cache_path=None):
-        super().__init__(thread_count)
+    def __init__(self, thread_count=1, cache_path=None, adaptive_concurrency=False, lanes=None):
+        super().__init__(thread_count, adaptive_concurrency=adaptive_concurrency, lanes=lanes)
 
         if cache_path:
-            self.cache = DiskCache(cache_path)
+            self.cache = TieredCache(DiskCache(cache_path))
         else:
             self.cache = NullCache()
 
     def handle_item(self, item) -> Optional[Any]:
         cache_key = self.key(item)
         self._debug(f"looking for {cache_key} in cache")
-        if cache_key in self.cache:
-            self._debug(f"cache entry found")
-            return self.cache[cache_key]
-        else:
+        computed = False
+
+        def compute():
+            nonlocal computed
             self._debug(f"cache entry not found; processing and saving")
-            result = self.handle_uncached_item(item)
-            self.cache[cache_key] = result
-            return result
+            computed = True
+            return self.handle_uncached_item(item)
+
+        try:
+            return self.cache.get_or_compute(cache_key, compute)
+        finally:
+            self.stats.record_cache(hit=not computed)
 
     @abstractmethod
     def handle_uncached_item(self, item):
@@ -288,21 +521,22 @@ class Sink(PipelineSegment):
         self._debug(f"run starting")
 
         self._work_done.clear()
-        while not self._upstream.done():
-            item = None
-            try:
+        with self.run_context():
+            while True:
                 item = self.upstream_get()
-                self._debug(f"handling {item}")
-                self.handle_item(item)
-                self._debug(f"handled {item}")
-                self.upstream_task_done()
-                self.completed += 1
-            except queue.Empty:
-                # that's cool
-                self._debug(f"get was empty")
-            except Exception as e:
-                self._debug(f"exception {e} handling {item}, skipping")
-                self.upstream_task_done()
+                if item is _END_OF_STREAM:
+                    self.upstream_task_done()
+                    break
+                try:
+                    self._debug(f"handling {item}")
+                    with self.stats.handling():
+                        self.handle_item(item)
+                    self._debug(f"handled {item}")
+                    self.upstream_task_done()
+                    self.completed += 1
+                except Exception as e:
+                    self._debug(f"exception {e} handling {item}, skipping")
+                    self.upstream_task_done()
 
         self._work_done.set()
         self._debug(f"finished run with upstream done")
@@ -311,6 +545,10 @@ class Sink(PipelineSegment):
         self._thread = Thread(target=self.run)
         self._thread.start()
 
+    def run_context(self) -> contextlib.AbstractContextManager:
+        """A context held open while items are handled, e.g. an output file. Override if your sink needs one."""
+        return contextlib.nullcontext()
+
     @abstractmethod
     def handle_item(self, item) -> None:
         """Receives a work item from the previous stage. No need to return anything here."""
@@ -319,7 +557,8 @@ class Sink(PipelineSegment):
     def join(self):
         super().join()
         self._debug(f"joining thread {self._thread}")
-        self._thread.join()
+        if self._thread:
+            self._thread.join()
         self._debug(f"thread join complete")
 
 
@@ -329,10 +568,13 @@ class Pipeline:
         *segments: PipelineSegment,
         debug: bool = False,
         progress_callback: Optional[Callable] = None,
+        total_items: Optional[int] = None,
     ):
         super().__init__()
         self._segments = segments
         self.progress_callback = progress_callback
+        self.total_items = total_items
+        self._progress = ProgressMonitor()
 
         self._debug_enabled = debug
         for s in self._segments:
@@ -343,6 +585,8 @@ class Pipeline:
 
         for a, b in zip(segments[:-1], segments[1:]):
             b.set_upstream(a)
+        for s in self._segments:
+            s.stats.worker_count = s.worker_count
 
     @property
     def source(self):
@@ -360,9 +604,8 @@ class Pipeline:
         for segment in self._segments:
             segment.start()
 
-        while not self.sink.done():
+        while not self.sink.wait_until_done(timeout=1):
             self.report_progress()
-            time.sleep(1)
         for segment in self._segments:
             self._debug(f"joining {segment}")
             segment.join()
@@ -371,9 +614,35 @@ class Pipeline:
         self.report_progress()
 
     def report_progress(self):
+        """Pass the progress_callback an event as built by ProgressMonitor. total_items, if set, gives the ETA."""
         PROMETHEUS.push_metrics()
         if self.progress_callback:
-            self.progress_callback({"completed": self.sink.completed})
+            stages = {name: (segment.stats, self._queued_for(segment)) for name, segment in self._named_segments()}
+            self.progress_callback(self._progress.event(self.sink.completed, stages, self.total_items))
+
+    def stage_summary(self) -> dict:
+        """Timing and load figures for each segment, keyed by segment class name."""
+        return {name: segment.stats.summary() for name, segment in self._named_segments()}
+
+    def _named_segments(self) -> list[tuple[str, PipelineSegment]]:
+        named: dict[str, PipelineSegment] = {}
+        for segment in self._segments:
+            name = segment.stats.stage
+            suffix = 1
+            while name in named:
+                suffix += 1
+                name = f"{segment.stats.stage}-{suffix}"
+            named[name] = segment
+        return list(named.items())
+
+    def _queued_for(self, segment: PipelineSegment) -> int:
+        """How many items are waiting for the segment to take them."""
+        if segment._upstream is None:
+            return 0
+        queued = segment._upstream._queue.qsize()
+        if isinstance(segment, Pipe):
+            queued += sum(lane_queue.qsize() for lane_queue in segment._lane_queues.values())
+        return queued
 
     def _debug(self, message: str):
         if self._debug_enabled:
@@ -381,3 +650,176 @@ class Pipeline:
                 f"{self.__class__.__name__}/{threading.current_thread().name}: {message}",
                 file=sys.stderr,
             )
+
+
+class AsyncPipeline(Pipeline):
+    """Runs the same segments as Pipeline, but on one asyncio event loop instead of a thread per worker.
+
+    Each worker of a segment is a task. Coroutine handle_item methods are awaited directly on the loop; ordinary
+    ones run in a per-segment pool of thread_count threads. A Source is iterated in a background thread unless
+    new_item_iterable returns an async iterable.
+    """
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self._debug(f"async pipeline run starting")
+
+        self.report_progress()
+
+        queues = [_TimedAsyncQueue(segment._queue.maxsize) for segment in self._segments]
+        self._inboxes = {id(segment): queues[i - 1] for i, segment in enumerate(self._segments) if i > 0}
+        executors = []
+        stages = []
+        for i, segment in enumerate(self._segments):
+            segment._work_done.clear()
+            outbox = queues[i] if segment._downstream else None
+            if isinstance(segment, Source):
+                executor = ThreadPoolExecutor(1, thread_name_prefix=segment.thread_name())
+                stages.append(self._run_source(segment, outbox, executor))
+            else:
+                executor = ThreadPoolExecutor(segment.worker_count, thread_name_prefix=segment.thread_name())
+                stages.append(self._run_stage(segment, queues[i - 1], outbox, executor))
+            executors.append(executor)
+
+        progress = asyncio.create_task(self._report_progress_periodically())
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            progress.cancel()
+            for executor in executors:
+                executor.shutdown()
+
+        for segment in self._segments:
+            self._debug(f"joining {segment}")
+            segment.join()
+        self._debug(f"async pipeline run complete")
+
+        self.report_progress()
+
+    def _queued_for(self, segment: PipelineSegment) -> int:
+        inbox = getattr(self, "_inboxes", {}).get(id(segment))
+        return inbox.qsize() if inbox is not None else 0
+
+    async def _report_progress_periodically(self):
+        while True:
+            await asyncio.sleep(1)
+            self.report_progress()
+
+    async def _run_source(self, source: Source, outbox: Optional[asyncio.Queue], executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+
+        def feed(iterable):
+            iterator = iter(iterable)
+            while True:
+                started = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                source.stats.record_service(time.monotonic() - started, active=False)
+                ITEMS_ADDED.inc()
+                if outbox is not None:
+                    asyncio.run_coroutine_threadsafe(outbox.put(item), loop).result()
+
+        try:
+            iterable = source.new_item_iterable()
+            if hasattr(iterable, "__aiter__"):
+                async for item in iterable:
+                    source.stats.record_service(0.0, active=False)
+                    ITEMS_ADDED.inc()
+                    if outbox is not None:
+                        await outbox.put(item)
+            else:
+                await loop.run_in_executor(executor, feed, iterable)
+        except Exception as e:
+            source._debug(f"exception {e} from iterable; ending early")
+        source._work_done.set()
+        await self._end_stream(source, outbox)
+        source._debug(f"finished run")
+
+    async def _run_stage(
+        self,
+        segment: PipelineSegment,
+        inbox: asyncio.Queue,
+        outbox: Optional[asyncio.Queue],
+        executor: ThreadPoolExecutor,
+    ):
+        context = segment.run_context() if isinstance(segment, Sink) else contextlib.nullcontext()
+        with context:
+            if isinstance(segment, Pipe) and segment.lanes is not None:
+                lane_inboxes = {lane: _TimedAsyncQueue(segment.lane_queue_size) for lane in segment.lanes}
+                workers = [self._dispatch(segment, inbox, lane_inboxes)]
+                for lane_inbox in lane_inboxes.values():
+                    workers.extend(
+                        self._run_worker(segment, lane_inbox, outbox, executor) for _ in range(segment.thread_count)
+                    )
+            else:
+                workers = [self._run_worker(segment, inbox, outbox, executor) for _ in range(segment.consumer_count)]
+            await asyncio.gather(*workers)
+        segment._work_done.set()
+        await self._end_stream(segment, outbox)
+        segment._debug(f"run finished")
+
+    async def _run_worker(
+        self,
+        segment: PipelineSegment,
+        inbox: asyncio.Queue,
+        outbox: Optional[asyncio.Queue],
+        executor: ThreadPoolExecutor,
+    ):
+        handler = segment.handle_item  # type: ignore[attr-defined]
+        is_coroutine = inspect.iscoroutinefunction(handler)
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await inbox.get()
+            if item is _END_OF_STREAM:
+                break
+            segment.stats.record_take(inbox.last_wait(), inbox.qsize())  # type: ignore[attr-defined]
+            pending: list = []
+            try:
+                with segment.stats.handling():
+                    if is_coroutine:
+                        _PENDING_OUTPUT.set(pending)
+                        result = await handler(item)
+                    else:
+                        result = await loop.run_in_executor(
+                            executor, contextvars.copy_context().run, _collect_output, pending, handler, item
+                        )
+                if result:
+                    pending.append(result)
+                segment.completed += 1
+                segment._debug(f"success with {item} -> {result}")
+            except Exception as e:
+                segment._debug(f"skipping item; exception {e} while processing {item}\n{traceback.format_exc()}")
+            if outbox is not None:
+                for output in pending:
+                    await outbox.put(output)
+
+    @staticmethod
+    async def _dispatch(segment: Pipe, inbox: asyncio.Queue, lane_inboxes: Mapping[Hashable, asyncio.Queue]):
+        while True:
+            item = await inbox.get()
+            if item is _END_OF_STREAM:
+                break
+            try:
+                lane_inbox = lane_inboxes[segment.lane_for(item)]
+            except Exception as e:
+                segment._debug(f"skipping item; exception {e} finding the lane for {item}")
+                continue
+            await lane_inbox.put(item)
+        for lane_inbox in lane_inboxes.values():
+            for _ in range(segment.thread_count):
+                await lane_inbox.put(_END_OF_STREAM)
+
+    @staticmethod
+    async def _end_stream(segment: PipelineSegment, outbox: Optional[asyncio.Queue]):
+        if outbox is not None and segment._downstream is not None:
+            for _ in range(segment._downstream.consumer_count):
+                await outbox.put(_END_OF_STREAM)
+
+
+def _collect_output(pending: list, handler: Callable, item: Any):
+    _PENDING_OUTPUT.set(pending)
+    return handler(item)
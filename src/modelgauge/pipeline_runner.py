@@ -1,6 +1,10 @@
 import datetime
 import json
+import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import Counter
 from multiprocessing.pool import ThreadPool
 
 from airrlogger.log_config import get_logger
@@ -11,10 +15,23 @@ from modelgauge.model_options import ModelOptions
 from modelgauge.pipeline import Pipeline
 from modelgauge.prompt_pipeline import PromptSink, PromptSource, PromptSutAssigner, PromptSutWorkers
 from modelgauge.ready import Readyable, ReadyResponses
+from modelgauge.response_store import open_response_store
 from modelgauge.sut_capabilities_verification import MissingSUTCapabilities
+from modelgauge.work_queue import (
+    WorkQueue,
+    WorkQueuePipe,
+    WorkQueueResultSink,
+    WorkQueueResultSource,
+    WorkQueueSink,
+    WorkQueueSource,
+    default_worker_id,
+)
 
 logger = get_logger(__name__)
 
+SUT_STAGE = "sut"
+ANNOTATOR_STAGE = "annotate"
+
 
 class PipelineRunner(ABC):
     def __init__(
@@ -24,15 +41,20 @@ class PipelineRunner(ABC):
         output_dir,
         cache_dir=None,
         tag=None,
+        adaptive_workers=False,
+        response_store=None,
     ):
         self.num_workers = num_workers
+        self.adaptive_workers = adaptive_workers
         self.input_dataset = input_dataset
         self.root_dir = output_dir
         self.cache_dir = cache_dir
+        self.response_store = open_response_store(response_store) if response_store else None
         self.tag = tag
         self.pipeline_segments = []
         self.start_time = datetime.datetime.now()
         self.finish_time = None
+        self.stage_summary = {}
 
         self.ensure_ready()
         try:
@@ -68,6 +90,12 @@ class PipelineRunner(ABC):
         """Total number of items to process."""
         pass
 
+    @property
+    @abstractmethod
+    def output_file_name(self) -> str:
+        """Name of the file the output is written to, inside output_dir()."""
+        pass
+
     def metadata(self):
         duration = self.finish_time - self.start_time
         hours, minutes, seconds = str(duration).split(":")
@@ -84,6 +112,7 @@ class PipelineRunner(ABC):
                 "source": self.input_dataset.path.name,
                 "num_items": self.num_input_items,
             },
+            "pipeline": self.stage_summary,
         }
         return metadata
 
@@ -99,12 +128,73 @@ class PipelineRunner(ABC):
             *self.pipeline_segments,
             progress_callback=progress_callback,
             debug=debug,
+            total_items=self.num_total_items,
+        )
+        pipeline.run()
+        self.finish_time = datetime.datetime.now()
+        self.stage_summary = pipeline.stage_summary()
+        logger.info(f"output saved to {self.output_dir() / self.output_file_name}")
+        self._write_metadata()
+
+    @property
+    @abstractmethod
+    def work_stages(self) -> list[str]:
+        """The work queue stages this runner's job goes through, in order."""
+        pass
+
+    def job_description(self):
+        return {"stages": self.work_stages}
+
+    def enqueue_work(self, work_queue: WorkQueue, debug=False):
+        """Instead of running the job here, add its work units to work_queue for QueuedJobWorkers to do."""
+        first_stage, *later_stages = self.work_stages
+        for before, stage in zip(self.work_stages, later_stages):
+            work_queue.chain(stage, after=before)
+        work_queue.set_job(self.job_description())
+        source, assigner = self.pipeline_segments[:2]
+        Pipeline(source, assigner, WorkQueueSink(work_queue, first_stage), debug=debug).run()
+
+    def collect_work(self, work_queue: WorkQueue, progress_callback, debug=False, poll_interval=1.0, workers=None):
+        """Wait for the workers to finish a job queued with enqueue_work, then write the output and metadata.
+
+        workers are the worker processes started for this job, if any. Only workers reclaim expired leases, so if all
+        of them exit before the job is finished, this raises instead of waiting for work nobody will do."""
+        final_stage = self.work_stages[-1]
+        while not work_queue.is_finished(final_stage):
+            if workers and all(worker.poll() is not None for worker in workers):
+                # a worker may have finished the job just before exiting
+                if work_queue.is_finished(final_stage):
+                    break
+                exit_codes = [worker.returncode for worker in workers]
+                raise RuntimeError(
+                    f"All worker processes exited (exit codes {exit_codes}) before the job in {work_queue.path} "
+                    "was finished."
+                )
+            counts = work_queue.counts(final_stage)
+            progress_callback({"completed": counts["done"] + counts["failed"]})
+            time.sleep(poll_interval)
+        self._tally_queued_results(work_queue)
+        pipeline = Pipeline(
+            WorkQueueResultSource(work_queue, final_stage),
+            self.pipeline_segments[-1],
+            progress_callback=progress_callback,
+            debug=debug,
         )
         pipeline.run()
+        self.stage_summary = pipeline.stage_summary()
+        for stage in self.work_stages:
+            failed = work_queue.counts(stage)["failed"]
+            if failed:
+                logger.warning(f"{failed} {stage} work units failed and are missing from the output.")
         self.finish_time = datetime.datetime.now()
         logger.info(f"output saved to {self.output_dir() / self.output_file_name}")
         self._write_metadata()
 
+    @abstractmethod
+    def _tally_queued_results(self, work_queue: WorkQueue):
+        """Fill in the response counts the workers' segments would have kept had the job run here."""
+        pass
+
     @staticmethod
     def format_date(date):
         return date.strftime("%Y%m%d-%H%M%S")
@@ -146,14 +236,34 @@ class PromptRunner(PipelineRunner):
         base_subdir_name = timestamp + "-" + self.tag if self.tag else timestamp
         return f"{base_subdir_name}-{'-'.join(self.suts.keys())}"
 
+    @property
+    def work_stages(self):
+        return [SUT_STAGE]
+
+    def job_description(self):
+        return {
+            **super().job_description(),
+            "suts": list(self.suts),
+            "sut_options": self.sut_options.model_dump(exclude_none=True),
+        }
+
     def metadata(self):
         return {**super().metadata(), **self._sut_metadata()}
 
+    def _tally_queued_results(self, work_queue):
+        counts = Counter(interaction.sut_uid for interaction in work_queue.results(SUT_STAGE))
+        self.sut_worker.sut_response_counts = {uid: counts[uid] for uid in self.suts}
+
     def _add_prompt_segments(self, include_sink=True):
         self.pipeline_segments.append(PromptSource(self.input_dataset))
         self.pipeline_segments.append(PromptSutAssigner(self.suts))
         self.sut_worker = PromptSutWorkers(
-            self.suts, sut_options=self.sut_options, workers=self.num_workers, cache_path=self.cache_dir
+            self.suts,
+            sut_options=self.sut_options,
+            workers=self.num_workers,
+            cache_path=self.cache_dir,
+            adaptive_concurrency=self.adaptive_workers,
+            response_store=self.response_store,
         )
         self.pipeline_segments.append(self.sut_worker)
         if include_sink:
@@ -208,14 +318,31 @@ class AnnotatorRunner(PipelineRunner):
         base_subdir_name = timestamp + "-" + self.tag if self.tag else timestamp
         return f"{base_subdir_name}-{'-'.join(self.annotators.keys())}"
 
+    @property
+    def work_stages(self):
+        return [ANNOTATOR_STAGE]
+
+    def job_description(self):
+        return {**super().job_description(), "annotators": list(self.annotators)}
+
     def metadata(self):
         return {**super().metadata(), **self._annotator_metadata()}
 
+    def _tally_queued_results(self, work_queue):
+        counts = Counter(annotated.annotator_uid for annotated in work_queue.results(ANNOTATOR_STAGE))
+        self.annotator_workers.annotation_counts = {uid: counts[uid] for uid in self.annotators}
+
     def _add_annotator_segments(self, include_source=True, include_sink=True, include_sut_logprobs=False):
         if include_source:
             self.pipeline_segments.append(AnnotatorSource(self.input_dataset))
         self.pipeline_segments.append(AnnotatorAssigner(self.annotators))
-        self.annotator_workers = AnnotatorWorkers(self.annotators, self.num_workers, cache_path=self.cache_dir)
+        self.annotator_workers = AnnotatorWorkers(
+            self.annotators,
+            self.num_workers,
+            cache_path=self.cache_dir,
+            adaptive_concurrency=self.adaptive_workers,
+            response_store=self.response_store,
+        )
         self.pipeline_segments.append(self.annotator_workers)
         if include_sink:
             jailbreak = isinstance(self.input_dataset, PromptDataset) and self.input_dataset.jailbreak
@@ -265,15 +392,139 @@ class PromptPlusAnnotatorRunner(PromptRunner, AnnotatorRunner):
         base_subdir_name = timestamp + "-" + self.tag if self.tag else timestamp
         return f"{base_subdir_name}-{'-'.join(self.suts.keys())}-{'-'.join(self.annotators.keys())}"
 
+    @property
+    def work_stages(self):
+        return [SUT_STAGE, ANNOTATOR_STAGE]
+
     def metadata(self):
         return {**super().metadata(), **self._sut_metadata(), **self._annotator_metadata()}
 
+    def _tally_queued_results(self, work_queue):
+        PromptRunner._tally_queued_results(self, work_queue)
+        AnnotatorRunner._tally_queued_results(self, work_queue)
+
     def _initialize_segments(self):
         # Hybrid pipeline: prompt source + annotator sink
         self._add_prompt_segments(include_sink=False)
         self._add_annotator_segments(include_source=False, include_sut_logprobs=self.sut_logprobs)
 
 
+class QueuedJobWorker:
+    """Does the work units of a job queued with PipelineRunner.enqueue_work until the job is finished.
+
+    Any number of these can drain the same queue at once, from any process that can open the queue file. The SUTs
+    and annotators must be the ones the job was queued with; they are instantiated by the worker so each process uses
+    its own secrets and connections."""
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        suts=None,
+        annotators=None,
+        num_workers=None,
+        cache_dir=None,
+        adaptive_workers=False,
+        worker_id=None,
+        poll_interval=1.0,
+        response_store=None,
+    ):
+        job = work_queue.job()
+        if not job:
+            raise ValueError(f"No job has been queued in {work_queue.path}.")
+        suts = suts or {}
+        annotators = annotators or {}
+        self._check_matches_job("SUTs", job.get("suts", []), suts)
+        self._check_matches_job("annotators", job.get("annotators", []), annotators)
+        stages = job["stages"]
+        store = open_response_store(response_store) if response_store else None
+        # sinks can only record the units their sources claimed under this id
+        worker_id = worker_id or default_worker_id()
+        self.work_queue = work_queue
+        self.worker_id = worker_id
+        self.stage_segments = []
+        if SUT_STAGE in stages:
+            self.sut_worker = PromptSutWorkers(
+                suts,
+                sut_options=ModelOptions(**job["sut_options"]),
+                workers=num_workers,
+                cache_path=cache_dir,
+                adaptive_concurrency=adaptive_workers,
+                response_store=store,
+            )
+            if ANNOTATOR_STAGE in stages:
+                sink = WorkQueueResultSink(
+                    work_queue,
+                    next_stage=ANNOTATOR_STAGE,
+                    fan_out=lambda interaction: [(interaction, uid) for uid in annotators],
+                    worker_id=worker_id,
+                )
+            else:
+                sink = WorkQueueResultSink(work_queue, worker_id=worker_id)
+            self.stage_segments.append(
+                [
+                    WorkQueueSource(work_queue, SUT_STAGE, worker_id=worker_id, poll_interval=poll_interval),
+                    WorkQueuePipe(self.sut_worker),
+                    sink,
+                ]
+            )
+        if ANNOTATOR_STAGE in stages:
+            self.annotator_workers = AnnotatorWorkers(
+                annotators,
+                num_workers,
+                cache_path=cache_dir,
+                adaptive_concurrency=adaptive_workers,
+                response_store=store,
+            )
+            self.stage_segments.append(
+                [
+                    WorkQueueSource(work_queue, ANNOTATOR_STAGE, worker_id=worker_id, poll_interval=poll_interval),
+                    WorkQueuePipe(self.annotator_workers),
+                    WorkQueueResultSink(work_queue, worker_id=worker_id),
+                ]
+            )
+
+    @staticmethod
+    def _check_matches_job(kind, queued_uids, given):
+        if sorted(queued_uids) != sorted(given):
+            raise ValueError(f"The queued job uses {kind} {queued_uids}, but this worker was given {list(given)}.")
+
+    def run(self, progress_callback=None, debug=False):
+        """Run every stage at once, so annotation starts as soon as the first SUT responses are in."""
+        pipelines = []
+
+        def report_progress(_):
+            if progress_callback:
+                progress_callback({"completed": sum(p.sink.completed for p in pipelines)})
+
+        pipelines.extend(
+            Pipeline(*segments, progress_callback=report_progress, debug=debug) for segments in self.stage_segments
+        )
+        threads = [threading.Thread(target=pipeline.run) for pipeline in pipelines]
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_leases, args=(stop_heartbeat,), daemon=True)
+        heartbeat.start()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+
+    def _renew_leases(self, stop: threading.Event):
+        """Keep this worker's leases from expiring while it's alive, however long its units take."""
+        try:
+            while not stop.wait(self.work_queue.lease_seconds / 3):
+                try:
+                    self.work_queue.renew(self.worker_id)
+                except sqlite3.Error as e:
+                    # the next beat tries again; the lease only lapses if every beat in it fails
+                    logger.warning(f"Couldn't renew work queue leases: {e}")
+        finally:
+            self.work_queue.close()
+
+
 def build_runner(
     input_path,
     suts=None,
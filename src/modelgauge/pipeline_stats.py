@@ -0,0 +1,261 @@
+"""Where the time goes in a pipeline: per-stage service time, queue wait, queue depth, busy workers and throughput.
+
+Every PipelineSegment keeps a StageStats. The figures go to Prometheus as they happen and are summarized at the end
+of a run, so you can tell whether a run was bound by the SUT, the annotator or the sink: the bottleneck is the stage
+whose workers are busiest and whose input queue is deepest, while stages after it mostly wait.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+from typing import Optional
+
+from modelgauge.monitoring import PROMETHEUS
+
+SERVICE_SECONDS = PROMETHEUS.histogram(
+    "mm_pipeline_service_seconds", "Time a pipeline stage spends handling one item", ["stage"]
+)
+QUEUE_WAIT_SECONDS = PROMETHEUS.histogram(
+    "mm_pipeline_queue_wait_seconds", "Time an item waits in a queue before a stage takes it", ["stage"]
+)
+QUEUE_DEPTH = PROMETHEUS.gauge("mm_pipeline_queue_depth", "Items waiting for a pipeline stage", ["stage"])
+ACTIVE_WORKERS = PROMETHEUS.gauge("mm_pipeline_active_workers", "Workers busy handling an item", ["stage"])
+ITEMS_HANDLED = PROMETHEUS.counter("mm_pipeline_items_handled", "Items a pipeline stage has finished", ["stage"])
+ITEMS_FAILED = PROMETHEUS.counter("mm_pipeline_items_failed", "Items a pipeline stage dropped on an error", ["stage"])
+CACHE_LOOKUPS = PROMETHEUS.counter(
+    "mm_pipeline_cache_lookups", "Cache lookups by a pipeline stage", ["stage", "result"]
+)
+
+
+class TimedQueue:
+    """Mixin for queue classes that remembers when each item went in, so the consumer can tell how long it waited.
+
+    It hooks the queue's internal _put and _get, which run under the queue's own lock, so the items themselves are
+    untouched."""
+
+    def _init(self, maxsize):
+        super()._init(maxsize)  # type: ignore[misc]
+        self._put_times: collections.deque = collections.deque()
+        self._waits = threading.local()
+
+    def _put(self, item):
+        super()._put(item)  # type: ignore[misc]
+        self._put_times.append(time.monotonic())
+
+    def _get(self):
+        self._waits.last = time.monotonic() - self._put_times.popleft()
+        return super()._get()  # type: ignore[misc]
+
+    def last_wait(self) -> float:
+        """How long the item this thread last took had been in the queue."""
+        return getattr(self._waits, "last", 0.0)
+
+
+class StageStats:
+    """Running totals for one pipeline stage. Safe to update from any number of worker threads."""
+
+    def __init__(self, stage: str, worker_count: int = 1):
+        self.stage = stage
+        self.worker_count = worker_count
+        self._lock = threading.Lock()
+        self.handled = 0
+        self.failed = 0
+        self.service_seconds = 0.0
+        self.max_service_seconds = 0.0
+        self.taken = 0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.queue_depth_total = 0
+        self.max_queue_depth = 0
+        self.active = 0
+        self.peak_active = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.first_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+        self._service = SERVICE_SECONDS.labels(stage)
+        self._queue_wait = QUEUE_WAIT_SECONDS.labels(stage)
+        self._queue_depth = QUEUE_DEPTH.labels(stage)
+        self._active = ACTIVE_WORKERS.labels(stage)
+        self._handled = ITEMS_HANDLED.labels(stage)
+        self._failed = ITEMS_FAILED.labels(stage)
+        self._cache_hits = CACHE_LOOKUPS.labels(stage, "hit")
+        self._cache_misses = CACHE_LOOKUPS.labels(stage, "miss")
+
+    def record_take(self, wait: float, depth: int):
+        """An item was taken from the stage's input queue after waiting there, leaving depth items behind."""
+        with self._lock:
+            self.taken += 1
+            self.queue_wait_seconds += wait
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, wait)
+            self.queue_depth_total += depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+        self._queue_wait.observe(wait)
+        self._queue_depth.set(depth)
+
+    @contextlib.contextmanager
+    def handling(self):
+        """Wrap the handling of one item."""
+        started = time.monotonic()
+        with self._lock:
+            if self.first_started is None:
+                self.first_started = started
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        self._active.inc()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record_service(time.monotonic() - started, failed)
+
+    def record_service(self, seconds: float, failed: bool = False, active: bool = True):
+        now = time.monotonic()
+        with self._lock:
+            if self.first_started is None:
+                self.first_started = now - seconds
+            self.last_finished = now
+            if active:
+                self.active -= 1
+            self.service_seconds += seconds
+            self.max_service_seconds = max(self.max_service_seconds, seconds)
+            if failed:
+                self.failed += 1
+            else:
+                self.handled += 1
+        if active:
+            self._active.dec()
+        self._service.observe(seconds)
+        (self._failed if failed else self._handled).inc()
+
+    def record_cache(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        (self._cache_hits if hit else self._cache_misses).inc()
+
+    @property
+    def cache_hit_rate(self) -> Optional[float]:
+        """The share of cache lookups that hit, or None if the stage hasn't used a cache."""
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else None
+
+    def summary(self) -> dict:
+        with self._lock:
+            items = self.handled + self.failed
+            elapsed = 0.0
+            if self.first_started is not None and self.last_finished is not None:
+                elapsed = self.last_finished - self.first_started
+            return {
+                "items": self.handled,
+                "failed": self.failed,
+                "workers": self.worker_count,
+                "peak_active_workers": self.peak_active,
+                "service_seconds": {
+                    "mean": _ratio(self.service_seconds, items),
+                    "max": self.max_service_seconds,
+                    "total": self.service_seconds,
+                },
+                "queue_wait_seconds": {
+                    "mean": _ratio(self.queue_wait_seconds, self.taken),
+                    "max": self.max_queue_wait_seconds,
+                },
+                "queue_depth": {"mean": _ratio(self.queue_depth_total, self.taken), "max": self.max_queue_depth},
+                "elapsed_seconds": elapsed,
+                "items_per_second": _ratio(self.handled, elapsed),
+                # Share of the stage's worker time spent handling items. Near 1 for the stage that bounds the run.
+                "utilization": _ratio(self.service_seconds, elapsed * self.worker_count),
+                "cache_hit_rate": self.cache_hit_rate,
+            }
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator else 0.0
+
+
+class ThroughputWindow:
+    """Items per second over the last window_seconds, so a mid-run slowdown shows up instead of being averaged away."""
+
+    def __init__(self, window_seconds: float = 30.0, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._samples: collections.deque = collections.deque()
+
+    def add(self, completed: int):
+        now = self._clock()
+        self._samples.append((now, completed))
+        # Keep one sample from before the window so the rate always spans the whole window.
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self.window_seconds:
+            self._samples.popleft()
+
+    def rate(self) -> Optional[float]:
+        if len(self._samples) < 2:
+            return None
+        (start, start_count), (end, end_count) = self._samples[0], self._samples[-1]
+        if end <= start:
+            return None
+        return (end_count - start_count) / (end - start)
+
+
+class ProgressMonitor:
+    """Builds the progress events a Pipeline passes to its progress_callback.
+
+    An event looks like:
+
+        {
+            "completed": 120,              # items through the sink
+            "total": 400,                  # None if unknown
+            "failed": 2,                   # items dropped by any stage
+            "items_per_second": 3.5,       # over the sliding window; None until there are two samples
+            "eta_seconds": 80.0,           # None without a total and a rate
+            "cache_hit_rate": 0.25,        # None if no stage used a cache
+            "stages": {"PromptSutWorkers": {"completed": 121, "in_flight": 8, "failed": 0, "queued": 30}, ...},
+        }
+    """
+
+    def __init__(self, window_seconds: float = 30.0, clock=time.monotonic):
+        self.window = ThroughputWindow(window_seconds, clock)
+
+    def event(self, completed: int, stages: dict[str, tuple[StageStats, int]], total: Optional[int] = None) -> dict:
+        """stages maps each stage name to its stats and the number of items currently queued for it."""
+        self.window.add(completed)
+        rate = self.window.rate()
+        eta = None
+        if total is not None and rate:
+            eta = max(total - completed, 0) / rate
+        hits = sum(stats.cache_hits for stats, _ in stages.values())
+        lookups = hits + sum(stats.cache_misses for stats, _ in stages.values())
+        return {
+            "completed": completed,
+            "total": total,
+            "failed": sum(stats.failed for stats, _ in stages.values()),
+            "items_per_second": rate,
+            "eta_seconds": eta,
+            "cache_hit_rate": hits / lookups if lookups else None,
+            "stages": {
+                name: {"completed": stats.handled, "in_flight": stats.active, "failed": stats.failed, "queued": queued}
+                for name, (stats, queued) in stages.items()
+            },
+        }
+
+
+def describe_progress(event: dict) -> str:
+    """A short human-readable line for a progress event, for progress bars."""
+    parts = []
+    if event.get("items_per_second") is not None:
+        parts.append(f"{event['items_per_second']:.1f} items/s")
+    if event.get("eta_seconds") is not None:
+        minutes, seconds = divmod(int(event["eta_seconds"]), 60)
+        parts.append(f"ETA {minutes // 60}:{minutes % 60:02d}:{seconds:02d}")
+    if event.get("cache_hit_rate") is not None:
+        parts.append(f"cache {event['cache_hit_rate']:.0%}")
+    if event.get("failed"):
+        parts.append(f"{event['failed']} failed")
+    busy = [f"{name} {stage['in_flight']}" for name, stage in event.get("stages", {}).items() if stage["in_flight"]]
+    if busy:
+        parts.append("in flight: " + ", ".join(busy))
+    return ", ".join(parts)
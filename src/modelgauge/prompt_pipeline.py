@@ -3,9 +3,13 @@ from typing import Optional
 
 from airrlogger.log_config import get_logger
 
+from modelbench.cache import MBCache, NullCache
+
 from modelgauge.dataset import PromptDataset, PromptResponseDataset
 from modelgauge.pipeline import CachingPipe, Pipe, Sink, Source
 from modelgauge.prompt import TextPrompt
+from modelgauge.rate_limits import RATE_LIMITS, estimate_tokens
+from modelgauge.response_store import sut_response_key
 from modelgauge.single_turn_prompt_response import SUTInteraction, TestItem
 from modelgauge.sut import PromptResponseSUT, SUT, SUTResponse
 from modelgauge.sut_capabilities import AcceptsTextPrompt, ProducesPerTokenLogProbabilities
@@ -35,13 +39,28 @@ class PromptSutAssigner(Pipe):
 
 
 class PromptSutWorkers(CachingPipe):
-    def __init__(self, suts: dict[str, SUT], sut_options: Optional[ModelOptions] = None, workers=None, cache_path=None):
+    """Calls the SUTs. Each SUT has its own lane of workers, so a slow SUT doesn't hold up the fast ones.
+
+    Native SUT responses are looked up in the response_store first, if one is given, and saved there when fetched."""
+
+    def __init__(
+        self,
+        suts: dict[str, SUT],
+        sut_options: Optional[ModelOptions] = None,
+        workers=None,
+        cache_path=None,
+        adaptive_concurrency=False,
+        response_store: Optional[MBCache] = None,
+    ):
         self.sleep_time = 10
         if workers is None:
             workers = 8
-        super().__init__(thread_count=workers, cache_path=cache_path)
+        super().__init__(
+            thread_count=workers, cache_path=cache_path, adaptive_concurrency=adaptive_concurrency, lanes=suts
+        )
         self.suts = suts
         self.sut_options = sut_options
+        self.response_store = response_store if response_store is not None else NullCache()
         self.sut_response_counts = {uid: 0 for uid in suts}
         self._assert_capabilities()
 
@@ -51,6 +70,10 @@ class PromptSutWorkers(CachingPipe):
             required_capabilities.append(ProducesPerTokenLogProbabilities)
         assert_multiple_suts_capabilities(list(self.suts.values()), required_capabilities)
 
+    def lane_for(self, item):
+        _, sut_uid = item
+        return sut_uid
+
     def key(self, item):
         prompt_item: TestItem
         prompt_item, sut_uid = item
@@ -64,18 +87,37 @@ class PromptSutWorkers(CachingPipe):
 
     def call_sut(self, prompt_text: TextPrompt, sut: PromptResponseSUT) -> SUTResponse:
         request = sut.translate_text_prompt(prompt_text, self.sut_options)
+        fetched = False
+
+        def fetch_response():
+            nonlocal fetched
+            fetched = True
+            return self._evaluate(sut, request)
+
+        response = self.response_store.get_or_compute(sut_response_key(sut.uid, request), fetch_response)
+        result = sut.translate_response(request, response)
+        # stored responses didn't use any of the SUT's rate limit
+        if fetched:
+            RATE_LIMITS.charge_tokens(sut.uid, estimate_tokens(result.text))
+        self.sut_response_counts[sut.uid] += 1
+        return result
+
+    def _evaluate(self, sut: PromptResponseSUT, request):
+        request_tokens = estimate_tokens(request)
         tries = 0
         while True:
             tries += 1
             try:
-                response = sut.evaluate(request)
-                break
+                RATE_LIMITS.acquire(sut.uid, tokens=request_tokens)
+                with self.concurrency_slot(sut.uid):
+                    return sut.evaluate(request)
             except Exception as e:
                 logger.warning(f"Exception calling SUT {sut.uid} on attempt {tries}: {e}\nRetrying.....", exc_info=True)
                 time.sleep(self.sleep_time)
-        result = sut.translate_response(request, response)
-        self.sut_response_counts[sut.uid] += 1
-        return result
+
+    def join(self):
+        super().join()
+        self.response_store.__exit__(None, None, None)
 
 
 class PromptSink(Sink):
@@ -83,9 +125,8 @@ class PromptSink(Sink):
         super().__init__()
         self.writer = writer
 
-    def run(self):
-        with self.writer:
-            super().run()
+    def run_context(self):
+        return self.writer
 
     def handle_item(self, item: SUTInteraction):
         self.writer.write(item)
@@ -0,0 +1,192 @@
+"""Client-side rate limits for SUTs and annotators, shared by every pipeline stage in the process.
+
+Limits are configured in the secrets file under a [rate_limits] scope. Each key is a SUT or annotator uid, a dynamic
+SUT uid without its options, a provider, or a driver; the value lists the quota:
+
+    [rate_limits]
+    "google/gemma-3-27b-it:nebius:hfrelay" = "rpm=600, tpm=200000"
+    together-serverless = "rpm=3000"
+    llama_guard_2 = "rpm=120, burst=5"
+
+rpm is requests per minute, tpm is tokens per minute and burst is how many seconds' worth of quota may be used at
+once (default 1). The most specific matching key wins. Everything that matches the same key shares one set of
+buckets, so a provider-wide quota is enforced across all of that provider's models.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Mapping, Optional
+
+from pydantic import BaseModel
+
+from modelgauge.dynamic_sut_metadata import DynamicSUTMetadata, RICH_UID_FIELD_SEPARATOR
+from modelgauge.monitoring import PROMETHEUS
+from modelgauge.secret_values import RawSecrets
+
+RATE_LIMIT_SCOPE = "rate_limits"
+
+_SPEC_LABELS = {"rpm": "requests_per_minute", "tpm": "tokens_per_minute", "burst": "burst_seconds"}
+
+RATE_LIMIT_WAIT_SECONDS = PROMETHEUS.counter(
+    "mm_rate_limit_wait_seconds", "Seconds spent waiting on rate limits", ["key"]
+)
+
+
+class RateLimitSpec(BaseModel):
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    burst_seconds: float = 1.0
+
+    @staticmethod
+    def parse(text: str) -> "RateLimitSpec":
+        """Parse a spec like "rpm=600, tpm=200000"."""
+        values = {}
+        for chunk in text.replace(",", " ").split():
+            label, _, value = chunk.partition("=")
+            if label not in _SPEC_LABELS or not value:
+                raise ValueError(f"Can't parse rate limit {chunk!r} in {text!r}; expected rpm=N, tpm=N or burst=N.")
+            values[_SPEC_LABELS[label]] = float(value)
+        return RateLimitSpec(**values)
+
+
+class TokenBucket:
+    """A thread-safe token bucket. Callers reserve tokens up front and then sleep off any deficit outside the lock,
+    so concurrent callers are spaced out evenly instead of all waking at once."""
+
+    def __init__(
+        self,
+        rate_per_second: float,
+        capacity: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if rate_per_second <= 0:
+            raise ValueError(f"rate_per_second must be positive, got {rate_per_second}")
+        self.rate_per_second = rate_per_second
+        self.capacity = max(capacity, 1.0)
+        self._clock = clock
+        self._level = self.capacity
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Take amount from the bucket and return how many seconds the caller must wait before using it.
+
+        Requests bigger than the bucket are allowed once it is full; the excess is paid back by later callers."""
+        with self._lock:
+            now = self._clock()
+            self._level = min(self.capacity, self._level + (now - self._last_refill) * self.rate_per_second)
+            self._last_refill = now
+            wait = max(0.0, (min(amount, self.capacity) - self._level) / self.rate_per_second)
+            self._level -= amount
+            return wait
+
+    def charge(self, amount: float):
+        """Take amount from the bucket without waiting, e.g. for usage only known after the call."""
+        self.reserve(amount)
+
+
+class RateLimiter:
+    """The request and token buckets for one configured key."""
+
+    def __init__(self, key: str, spec: RateLimitSpec, sleep: Callable[[float], Any] = time.sleep):
+        self.key = key
+        self.spec = spec
+        self._sleep = sleep
+        self._requests = self._bucket(spec.requests_per_minute, spec.burst_seconds)
+        self._tokens = self._bucket(spec.tokens_per_minute, spec.burst_seconds)
+
+    @staticmethod
+    def _bucket(per_minute: Optional[float], burst_seconds: float) -> Optional[TokenBucket]:
+        if not per_minute:
+            return None
+        rate = per_minute / 60
+        return TokenBucket(rate, capacity=rate * burst_seconds)
+
+    def acquire(self, tokens: int = 0):
+        """Wait until one request using about this many tokens fits within the quota."""
+        wait = 0.0
+        if self._requests:
+            wait = max(wait, self._requests.reserve(1))
+        if self._tokens and tokens:
+            wait = max(wait, self._tokens.reserve(tokens))
+        if wait > 0:
+            RATE_LIMIT_WAIT_SECONDS.labels(self.key).inc(wait)
+            self._sleep(wait)
+
+    def charge_tokens(self, tokens: int):
+        if self._tokens and tokens:
+            self._tokens.charge(tokens)
+
+
+class RateLimitRegistry:
+    """Maps SUT and annotator uids to shared RateLimiters. Uids with no configured limit are never held up."""
+
+    def __init__(self, specs: Optional[Mapping[str, RateLimitSpec]] = None):
+        self._lock = threading.Lock()
+        self._specs: dict[str, RateLimitSpec] = {}
+        self._limiters: dict[str, RateLimiter] = {}
+        self._by_uid: dict[str, Optional[RateLimiter]] = {}
+        if specs:
+            self.configure(specs)
+
+    def configure(self, specs: Mapping[str, RateLimitSpec]):
+        """Replace all configured limits."""
+        with self._lock:
+            self._specs = dict(specs)
+            self._limiters = {}
+            self._by_uid = {}
+
+    def configure_from_secrets(self, secrets: RawSecrets):
+        raw = secrets.get(RATE_LIMIT_SCOPE, {})
+        self.configure({key: RateLimitSpec.parse(value) for key, value in raw.items()})
+
+    def limiter_for(self, uid: str) -> Optional[RateLimiter]:
+        with self._lock:
+            if uid not in self._by_uid:
+                self._by_uid[uid] = self._find_limiter(uid)
+            return self._by_uid[uid]
+
+    def acquire(self, uid: str, tokens: int = 0):
+        limiter = self.limiter_for(uid)
+        if limiter:
+            limiter.acquire(tokens)
+
+    def charge_tokens(self, uid: str, tokens: int):
+        limiter = self.limiter_for(uid)
+        if limiter:
+            limiter.charge_tokens(tokens)
+
+    def _find_limiter(self, uid: str) -> Optional[RateLimiter]:
+        for key in self._candidate_keys(uid):
+            if key in self._specs:
+                if key not in self._limiters:
+                    self._limiters[key] = RateLimiter(key, self._specs[key])
+                return self._limiters[key]
+        return None
+
+    @staticmethod
+    def _candidate_keys(uid: str) -> list[str]:
+        keys = [uid]
+        dynamic_uid = uid.split(RICH_UID_FIELD_SEPARATOR)[0]
+        if dynamic_uid != uid:
+            keys.append(dynamic_uid)
+        try:
+            metadata = DynamicSUTMetadata.parse_sut_uid(uid)
+        except Exception:
+            return keys
+        keys.extend(k for k in (metadata.provider, metadata.driver) if k)
+        return keys
+
+
+def estimate_tokens(value: Any) -> int:
+    """A rough token count for quota purposes: about four characters per token."""
+    if isinstance(value, BaseModel):
+        text = value.model_dump_json(exclude_none=True)
+    elif value is None:
+        return 0
+    else:
+        text = str(value)
+    return len(text) // 4 + 1
+
+
+RATE_LIMITS = RateLimitRegistry()
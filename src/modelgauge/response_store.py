@@ -0,0 +1,79 @@
+"""One content-addressed store of native SUT and annotator responses, shared by every way of running them.
+
+`modelgauge run-test`, `modelgauge run-job` and `modelbench benchmark` all key responses the same way, by the uid of
+the SUT or annotator and a digest of its native request. Point them at the same directory with --response-store (or
+the AIRR_RESPONSE_STORE environment variable) and a response paid for by one of them is reused by the others.
+
+The store can also be the URL of a `modelbench cache serve` server, to share it between hosts. Set AIRR_CACHE_TOKEN to
+the token the server was started with.
+"""
+
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+from modelbench.cache import CacheKey, DiskCache, HttpCache, MBCache, TieredCache
+from modelgauge.caching import Cache
+
+RESPONSE_STORE_ENV = "AIRR_RESPONSE_STORE"
+REMOTE_STORE_NAME = "responses"
+
+
+def sut_response_key(sut_uid: str, sut_request) -> CacheKey:
+    # Add SUT UID to key to avoid collisions.
+    return CacheKey({"sut": sut_uid, "sut_request": sut_request.model_dump(exclude_none=True)}, owner=sut_uid)
+
+
+def annotator_response_key(annotator_uid: str, annotator_request) -> CacheKey:
+    # Add annotator UID to key to avoid collisions.
+    error_msg = f"Don't know how to make a key out of {annotator_request.__class__}: {annotator_request}"
+    json_key: dict[str, Any] = {"annotator": annotator_uid}
+    if isinstance(annotator_request, BaseModel):
+        json_key["annotator_request"] = annotator_request.model_dump(exclude_none=True)
+    elif isinstance(annotator_request, str):
+        json_key["annotator_request"] = annotator_request
+    elif isinstance(annotator_request, dict):
+        if not all(isinstance(v, (str, BaseModel)) for v in annotator_request.values()):
+            raise ValueError(error_msg)
+        json_key["annotator_request"] = {
+            k: v.model_dump(exclude_none=True) if isinstance(v, BaseModel) else v for k, v in annotator_request.items()
+        }
+    else:
+        raise ValueError(error_msg)
+    return CacheKey(json_key, owner=annotator_uid)
+
+
+def is_remote_store(location) -> bool:
+    return str(location).startswith(("http://", "https://"))
+
+
+def open_response_store(location, keep_key_text: bool = False) -> MBCache:
+    """The store in a local directory or on a cache server, with the most recently used responses kept in memory."""
+    if is_remote_store(location):
+        return TieredCache(HttpCache(str(location), REMOTE_STORE_NAME, keep_key_text=keep_key_text))
+    return TieredCache(DiskCache(location, keep_key_text=keep_key_text))
+
+
+class ResponseStoreCache(Cache):
+    """Lets code written against modelgauge.caching.Cache, like the simple test runner, use a response store.
+
+    Several of these can share one store, so they leave opening and closing it to whoever opened it."""
+
+    def __init__(self, store: MBCache, make_key: Callable[[Any], CacheKey]):
+        self.store = store
+        self.make_key = make_key
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def get_or_call(self, request, callable):
+        return self.store.get_or_compute(self.make_key(request), lambda: callable(request))
+
+    def get_cached_response(self, request):
+        return self.store.get(self.make_key(request))
+
+    def update_cache(self, request, response):
+        self.store[self.make_key(request)] = response
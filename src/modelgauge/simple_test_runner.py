@@ -1,5 +1,6 @@
 import os
 import random
+from contextlib import ExitStack
 from typing import Dict, List, Optional
 
 from tqdm import tqdm
@@ -11,6 +12,12 @@ from modelgauge.dependency_helper import FromSourceDependencyHelper
 from modelgauge.general import TestItemError
 from modelgauge.prompt import TextPrompt
 from modelgauge.records import TestItemExceptionRecord, TestItemRecord, TestRecord
+from modelgauge.response_store import (
+    ResponseStoreCache,
+    annotator_response_key,
+    open_response_store,
+    sut_response_key,
+)
 from modelgauge.single_turn_prompt_response import (
     MeasuredTestItem,
     SUTResponseAnnotations,
@@ -30,8 +37,11 @@ def run_prompt_response_test(
     max_test_items: Optional[int] = None,
     use_caching: bool = True,
     disable_progress_bar: bool = False,
+    response_store: Optional[str] = None,
 ) -> TestRecord:
-    """Demonstration for how to run a single Test on a single SUT, all calls serial."""
+    """Demonstration for how to run a single Test on a single SUT, all calls serial.
+
+    With a response_store directory, responses are cached there instead of in data_dir, shared with other runs."""
 
     assert_is_test(test)
     assert_is_sut(sut)
@@ -44,14 +54,19 @@ def run_prompt_response_test(
     test_data_path = os.path.join(data_dir, "tests", test.__class__.__name__)
 
     sut_cache: Cache
-    if use_caching:
+    store = open_response_store(response_store) if use_caching and response_store else None
+    if store is not None:
+        sut_cache = ResponseStoreCache(store, lambda request: sut_response_key(sut.uid, request))
+    elif use_caching:
         sut_cache = SqlDictCache(os.path.join(data_dir, "suts"), sut.uid)
     else:
         sut_cache = NoCache()
     annotator_caches: dict[str, Cache] = {}
     for annotator in annotators:
         annotator_cache: Cache
-        if use_caching:
+        if store is not None:
+            annotator_cache = ResponseStoreCache(store, _annotator_key_maker(annotator.uid))
+        elif use_caching:
             annotator_cache = SqlDictCache(os.path.join(test_data_path, "annotators"), annotator.uid)
         else:
             annotator_cache = NoCache()
@@ -76,20 +91,27 @@ def run_prompt_response_test(
     test_item_exceptions = []
     measured_test_items = []
     desc = f"Processing TestItems for test={test.uid} sut={sut.uid}"
-    for test_item in tqdm(test_items, desc=desc, disable=disable_progress_bar):
-        try:
-            test_item_record = _process_test_item(test_item, test, sut, sut_cache, annotators, annotator_caches)
-            test_item_records.append(test_item_record)
-            measured_test_items.append(
-                MeasuredTestItem(
-                    test_item=test_item_record.test_item,
-                    measurements=test_item_record.measurements,
+    # Keep the caches open for the whole run, so their writes can be committed in batches.
+    with ExitStack() as stack:
+        if store is not None:
+            # The store's ResponseStoreCaches share it, so it's closed here rather than by them.
+            stack.enter_context(store)
+        sut_cache = stack.enter_context(sut_cache)
+        annotator_caches = {uid: stack.enter_context(cache) for uid, cache in annotator_caches.items()}
+        for test_item in tqdm(test_items, desc=desc, disable=disable_progress_bar):
+            try:
+                test_item_record = _process_test_item(test_item, test, sut, sut_cache, annotators, annotator_caches)
+                test_item_records.append(test_item_record)
+                measured_test_items.append(
+                    MeasuredTestItem(
+                        test_item=test_item_record.test_item,
+                        measurements=test_item_record.measurements,
+                    )
+                )
+            except TestItemError as e:
+                test_item_exceptions.append(
+                    TestItemExceptionRecord(test_item=test_item, error_message=str(e), cause=str(e.__cause__))
                 )
-            )
-        except TestItemError as e:
-            test_item_exceptions.append(
-                TestItemExceptionRecord(test_item=test_item, error_message=str(e), cause=str(e.__cause__))
-            )
     # TODO: Consider different threshold for num. items required to aggregate.
     if len(measured_test_items) > 0:
         test_result = TestResult.from_instance(test.aggregate_measurements(measured_test_items))
@@ -108,6 +130,10 @@ def run_prompt_response_test(
     )
 
 
+def _annotator_key_maker(annotator_uid: str):
+    return lambda request: annotator_response_key(annotator_uid, request)
+
+
 def _process_test_item(
     item: TestItem,
     test: PromptResponseTest,
@@ -121,8 +147,7 @@ def _process_test_item(
             sut_request = sut.translate_text_prompt(item.prompt, test.sut_options())
         else:
             sut_request = sut.translate_chat_prompt(item.prompt, test.sut_options())
-        with sut_cache as cache:
-            sut_response = cache.get_or_call(sut_request, sut.evaluate)
+        sut_response = sut_cache.get_or_call(sut_request, sut.evaluate)
         response = sut.translate_response(sut_request, sut_response)
     except Exception as e:
         raise TestItemError(f"Exception while handling SUT {sut.uid} for prompt `{item.prompt}`") from e
@@ -130,13 +155,13 @@ def _process_test_item(
     annotations = {}
     for annotator in annotators:
         try:
-            with annotator_caches[annotator.uid] as cache:
-                annotator_request = annotator.translate_request(item, response)
-                annotator_response = cache.get_cached_response(annotator_request)
-                if not annotator_response:
-                    annotator_response = annotator.annotate(annotator_request)
-                annotation = annotator.translate_response(annotator_request, annotator_response)
-                cache.update_cache(annotator_request, annotator_response)
+            cache = annotator_caches[annotator.uid]
+            annotator_request = annotator.translate_request(item, response)
+            annotator_response = cache.get_cached_response(annotator_request)
+            if not annotator_response:
+                annotator_response = annotator.annotate(annotator_request)
+            annotation = annotator.translate_response(annotator_request, annotator_response)
+            cache.update_cache(annotator_request, annotator_response)
         except Exception as e:
             raise TestItemError(f"Exception while handling annotation for {annotator.uid} on `{response}`") from e
 
@@ -0,0 +1,338 @@
+"""A SQLite-backed queue of pipeline work units, so one job can be spread over several worker processes.
+
+A coordinator fills the queue with units for the first stage of a job (e.g. (TestItem, sut_uid) pairs). Any number of
+workers, in this process, in other processes, or on other hosts that see the same file on a shared filesystem with
+working locks, claim units, do the work and mark them done. Completing a unit can add units to a later stage, which is
+how a SUT response becomes (SUTInteraction, annotator_uid) units for annotation. Once every stage is finished the
+coordinator reads the results back in the order the units were added and writes the usual output files.
+
+Claims are leases: if a worker dies, its units go back to pending once the lease expires and another worker picks them
+up. A live worker renews the leases it holds while it works, so a unit that takes longer than one lease, e.g. a SUT call
+that keeps retrying, isn't claimed and done a second time. Only the worker holding a unit's lease can complete or fail
+it, so a worker that outlives its lease can't add the unit's next-stage units a second time. A unit whose lease has
+expired max_attempts times is marked failed rather than claimed again. Items and results are pickled, so all parties
+need to run the same version of the code.
+"""
+
+import json
+import os
+import pathlib
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from modelgauge.pipeline import Pipe, Sink, Source
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    result BLOB,
+    error TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS units_by_stage_status ON units (stage, status, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+class WorkQueue:
+    """Units of work for one job, stored in a SQLite file. Safe to share between threads and processes."""
+
+    def __init__(self, path, lease_seconds: float = 600.0, max_attempts: int = 3):
+        self.path = pathlib.Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self, immediate=True):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        """Close this thread's connection."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def set_job(self, description: dict):
+        """Record what the job is (SUTs, annotators, options) so workers can check they match."""
+        self._set_meta("job", json.dumps(description))
+
+    def job(self) -> dict:
+        value = self._get_meta("job")
+        return json.loads(value) if value else {}
+
+    def enqueue(self, stage: str, items: Iterable[Any]):
+        with self._transaction() as db:
+            self._insert(db, stage, items)
+
+    def seal(self, stage: str):
+        """No more units will be added to the stage directly. It is finished once its existing units are."""
+        self._set_meta(f"sealed:{stage}", "1")
+
+    def chain(self, stage: str, after: str):
+        """Units for stage come from completing units of the after stage; it is finished when that stage is."""
+        self._set_meta(f"after:{stage}", after)
+
+    def claim(self, stage: str, worker_id: str, limit: int = 1) -> list[tuple[int, Any]]:
+        """Lease up to limit pending units of the stage, returning (unit_id, item) pairs."""
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE units SET status = ?, worker = NULL, lease_expires = NULL, error = ?"
+                " WHERE stage = ? AND status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, f"lease expired {self.max_attempts} times", stage, CLAIMED, now, self.max_attempts),
+            )
+            db.execute(
+                "UPDATE units SET status = ?, worker = NULL WHERE stage = ? AND status = ? AND lease_expires < ?",
+                (PENDING, stage, CLAIMED, now),
+            )
+            rows = db.execute(
+                "SELECT id, payload FROM units WHERE stage = ? AND status = ? ORDER BY id LIMIT ?",
+                (stage, PENDING, limit),
+            ).fetchall()
+            db.executemany(
+                "UPDATE units SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(CLAIMED, worker_id, now + self.lease_seconds, unit_id) for unit_id, _ in rows],
+            )
+        return [(unit_id, pickle.loads(payload)) for unit_id, payload in rows]
+
+    def renew(self, worker_id: str) -> int:
+        """Extend the leases of all the units worker_id holds by lease_seconds, returning how many it holds."""
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE units SET lease_expires = ? WHERE status = ? AND worker = ?",
+                (time.time() + self.lease_seconds, CLAIMED, worker_id),
+            ).rowcount
+
+    def complete(
+        self,
+        unit_id: int,
+        worker_id: str,
+        result: Any,
+        next_stage: Optional[str] = None,
+        next_items: Iterable[Any] = (),
+    ) -> bool:
+        """Store the unit's result and, in the same transaction, add any units it leads to.
+
+        Does nothing and returns False if worker_id no longer holds the unit's lease."""
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE units SET status = ?, result = ?, lease_expires = NULL WHERE id = ? AND status = ? AND worker = ?",
+                (DONE, pickle.dumps(result), unit_id, CLAIMED, worker_id),
+            ).rowcount
+            if updated and next_stage:
+                self._insert(db, next_stage, next_items)
+        return bool(updated)
+
+    def fail(self, unit_id: int, worker_id: str, error: str) -> bool:
+        """Mark the unit failed. Does nothing and returns False if worker_id no longer holds its lease."""
+        with self._transaction() as db:
+            updated = db.execute(
+                "UPDATE units SET status = ?, error = ?, lease_expires = NULL WHERE id = ? AND status = ? AND worker = ?",
+                (FAILED, error, unit_id, CLAIMED, worker_id),
+            ).rowcount
+        return bool(updated)
+
+    def counts(self, stage: str) -> dict[str, int]:
+        rows = self._connection().execute(
+            "SELECT status, COUNT(*) FROM units WHERE stage = ? GROUP BY status", (stage,)
+        )
+        counts = {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows.fetchall()))
+        return counts
+
+    def is_finished(self, stage: str) -> bool:
+        with self._transaction(immediate=False) as db:
+            return self._is_finished(db, stage)
+
+    def results(self, stage: str) -> Iterator[Any]:
+        """The results of the stage's completed units, in the order the units were added."""
+        rows = self._connection().execute(
+            "SELECT result FROM units WHERE stage = ? AND status = ? ORDER BY id", (stage, DONE)
+        )
+        for (result,) in rows:
+            yield pickle.loads(result)
+
+    def _is_finished(self, db, stage: str) -> bool:
+        after = self._get_meta(f"after:{stage}", db)
+        if after is not None:
+            if not self._is_finished(db, after):
+                return False
+        elif self._get_meta(f"sealed:{stage}", db) is None:
+            return False
+        (unfinished,) = db.execute(
+            "SELECT COUNT(*) FROM units WHERE stage = ? AND status IN (?, ?)", (stage, PENDING, CLAIMED)
+        ).fetchone()
+        return unfinished == 0
+
+    @staticmethod
+    def _insert(db, stage: str, items: Iterable[Any]):
+        db.executemany(
+            "INSERT INTO units (stage, status, payload) VALUES (?, ?, ?)",
+            [(stage, PENDING, pickle.dumps(item)) for item in items],
+        )
+
+    def _set_meta(self, key: str, value: str):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _get_meta(self, key: str, db=None) -> Optional[str]:
+        row = (db or self._connection()).execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+class WorkQueueSink(Sink):
+    """Adds every item it receives to the work queue as a unit of the given stage, then seals the stage."""
+
+    def __init__(self, work_queue: WorkQueue, stage: str, batch_size: int = 100):
+        super().__init__()
+        self.work_queue = work_queue
+        self.stage = stage
+        self.batch_size = batch_size
+        self._batch: list[Any] = []
+
+    @contextmanager
+    def run_context(self):
+        yield
+        self._flush()
+        self.work_queue.seal(self.stage)
+
+    def handle_item(self, item):
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self.work_queue.enqueue(self.stage, self._batch)
+            self._batch = []
+
+
+class WorkQueueSource(Source):
+    """Claims units of a stage until the stage is finished, producing (unit_id, item) pairs."""
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        stage: str,
+        worker_id: Optional[str] = None,
+        batch_size: int = 10,
+        poll_interval: float = 1.0,
+    ):
+        super().__init__()
+        self.work_queue = work_queue
+        self.stage = stage
+        self.worker_id = worker_id or default_worker_id()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    def new_item_iterable(self):
+        while True:
+            units = self.work_queue.claim(self.stage, self.worker_id, self.batch_size)
+            if units:
+                yield from units
+            elif self.work_queue.is_finished(self.stage):
+                return
+            else:
+                time.sleep(self.poll_interval)
+
+
+class WorkQueuePipe(Pipe):
+    """Runs an existing Pipe's handle_item on claimed units, producing (unit_id, result, error) triples."""
+
+    def __init__(self, inner: Pipe):
+        super().__init__(thread_count=inner.thread_count, lanes=inner.lanes)
+        self.inner = inner
+
+    def lane_for(self, item):
+        _, payload = item
+        return self.inner.lane_for(payload)
+
+    def handle_item(self, item):
+        unit_id, payload = item
+        try:
+            return unit_id, self.inner.handle_item(payload), None
+        except Exception as e:
+            return unit_id, None, e
+
+    def join(self):
+        super().join()
+        self.inner.join()
+
+
+class WorkQueueResultSink(Sink):
+    """Records each unit's outcome, adding the units it fans out to in the next stage, if any.
+
+    worker_id must be the one the units were claimed with."""
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        next_stage: Optional[str] = None,
+        fan_out: Optional[Callable[[Any], Iterable[Any]]] = None,
+        worker_id: Optional[str] = None,
+    ):
+        super().__init__()
+        self.work_queue = work_queue
+        self.worker_id = worker_id or default_worker_id()
+        self.next_stage = next_stage
+        self.fan_out = fan_out
+
+    def handle_item(self, item):
+        unit_id, result, error = item
+        if error is not None:
+            self.work_queue.fail(unit_id, self.worker_id, repr(error))
+            return
+        next_items = list(self.fan_out(result)) if self.fan_out else []
+        self.work_queue.complete(unit_id, self.worker_id, result, self.next_stage, next_items)
+
+
+class WorkQueueResultSource(Source):
+    """Produces the results of a finished stage in the order its units were added."""
+
+    def __init__(self, work_queue: WorkQueue, stage: str):
+        super().__init__()
+        self.work_queue = work_queue
+        self.stage = stage
+
+    def new_item_iterable(self):
+        return self.work_queue.results(self.stage)
@@ -6,7 +6,8 @@ import pytest
 
 from modelbench.benchmark_runner import *
 from modelbench.benchmarks import SecurityScore
-from modelbench.cache import InMemoryCache
+from modelbench.cache import DiskCache, InMemoryCache
+from modelbench.error_cache import ErrorCache
 from modelbench.hazards import HazardDefinition
 from modelbench.standards import NoStandardsFileError, OverwriteStandardsFileError, Standards
 from modelbench_tests.test_run_journal import FakeJournal, reader_for
@@ -29,6 +30,11 @@ from modelgauge_tests.fake_annotator import (
 from modelgauge_tests.fake_sut import FakeSUT
 from tests.modelgauge_tests.fake_classes import AFakeSafetyTest, AFakeTest, AHazard
 
+
+class RefusedError(Exception):
+    status_code = 400
+
+
 # fix pytest autodiscovery issue; see https://github.com/pytest-dev/pytest/issues/12749
 for a_class in [i[1] for i in (globals().items()) if inspect.isclass(i[1])]:
     if a_class.__name__.startswith("Test"):
@@ -98,7 +104,13 @@ class RunnerTestBase:
             def annotate(self, annotation_request):
                 raise ValueError("annotator done broke")
 
+        class FakeRefusingAnnotator(FakeSafetyAnnotator):
+            def annotate(self, annotation_request):
+                self.annotate_calls += 1
+                raise RefusedError("request refused")
+
         ANNOTATORS.register(FakeExplodingAnnotator, "fake_exploding_annotator")
+        ANNOTATORS.register(FakeRefusingAnnotator, "fake_refusing_annotator")
         ANNOTATORS.register(FakeSafetyAnnotator, "fake_annotator_1")
         ANNOTATORS.register(FakeSafetyAnnotator, "fake_annotator_2")
         ANNOTATORS.register(FakeSafetyAnnotator, "fake_safety_annotator")
@@ -554,6 +566,12 @@ class TestRunners(RunnerTestBase):
         baw.handle_item(TestRunItem(wrapped_test, item_from_test, a_sut, sut_response))
         assert len(raw_cache) == 2
 
+    def test_response_store_is_opened_once(self, tmp_path):
+        run = self.a_run(tmp_path, response_store_path=tmp_path / "store")
+
+        assert run.cache_for("sut_cache") is run.cache_for("annotator_cache")
+        assert list(run.caches) == ["response_store"]
+
 
 class TestRunJournaling(RunnerTestBase):
 
@@ -621,6 +639,39 @@ class TestRunJournaling(RunnerTestBase):
 
         capsys.readouterr()  # supress the exception output; can remove when we add proper logging
 
+    def test_benchmark_sut_worker_remembers_refused_requests(self, item_from_test, a_wrapped_test, tmp_path, capsys):
+        sut = FakeSUT("refusing_sut")
+        sut.evaluate = MagicMock(side_effect=RefusedError("content filter"))
+        run = self.a_run(tmp_path, suts=[sut])
+        bsw = TestRunSutWorker(run, InMemoryCache(), error_cache=ErrorCache(InMemoryCache()))
+
+        bsw.handle_item(TestRunItem(a_wrapped_test, item_from_test, sut))
+        calls = sut.evaluate.call_count
+        item = bsw.handle_item(TestRunItem(a_wrapped_test, item_from_test, sut))
+
+        assert sut.evaluate.call_count == calls
+        assert item.failed
+        entry = run.journal.last_entry()
+        assert entry["message"] == "sut exception"
+        assert entry["exception"]["class"] == "CachedFailureError"
+        assert entry["exception"]["message"] == "RefusedError: content filter"
+        capsys.readouterr()
+
+    def test_benchmark_sut_worker_retries_other_failures(
+        self, item_from_test, a_wrapped_test, tmp_path, exploding_sut, capsys
+    ):
+        run = self.a_run(tmp_path, suts=[exploding_sut])
+        error_cache = ErrorCache(InMemoryCache())
+        bsw = TestRunSutWorker(run, InMemoryCache(), error_cache=error_cache)
+
+        bsw.handle_item(TestRunItem(a_wrapped_test, item_from_test, exploding_sut))
+        calls = exploding_sut.evaluate.call_count
+        bsw.handle_item(TestRunItem(a_wrapped_test, item_from_test, exploding_sut))
+
+        assert exploding_sut.evaluate.call_count == 2 * calls
+        assert len(error_cache) == 0
+        capsys.readouterr()
+
     def test_benchmark_annotation_worker(
         self, a_wrapped_test, tmp_path, item_from_test, sut_response, a_sut, benchmark
     ):
@@ -659,6 +710,20 @@ class TestRunJournaling(RunnerTestBase):
         measurement_entry = run.journal.entry(-1)
         assert measurement_entry["message"] == "measured item quality"
 
+    def test_benchmark_annotation_worker_counts_a_failed_fetch_as_a_miss(
+        self, a_wrapped_test, tmp_path, item_from_test, sut_response, a_sut, benchmark, monkeypatch
+    ):
+        def fail_to_acquire(*args, **kwargs):
+            raise RuntimeError("rate limiter unavailable")
+
+        monkeypatch.setattr(RATE_LIMITS, "acquire", fail_to_acquire)
+        run = self.a_run(tmp_path, suts=[a_sut], benchmarks=[benchmark])
+        baw = TestRunAnnotationWorker(run, InMemoryCache())
+
+        baw.handle_item(TestRunItem(a_wrapped_test, item_from_test, a_sut, sut_response))
+
+        assert (baw.stats.cache_hits, baw.stats.cache_misses) == (0, 1)
+
     def test_benchmark_annotation_worker_ensemble_cached(self, tmp_path, item_from_test, sut_response, a_sut):
         test = AFakeSafetyTest("test_1", [item_from_test], annotators=["fake_ensemble_annotator"])
         benchmark = ABenchmark([test], tmp_path / "standards.json")
@@ -718,6 +783,26 @@ class TestRunJournaling(RunnerTestBase):
         assert measurement_entry["measurements"] == {}
         capsys.readouterr()  # supress the exception output; can remove when we add proper logging
 
+    def test_benchmark_annotation_worker_remembers_refused_requests(
+        self, tmp_path, item_from_test, sut_response, a_sut, capsys
+    ):
+        test = AFakeTest("a_test", [item_from_test], annotators=["fake_refusing_annotator"])
+        run = self.a_run(tmp_path, suts=[a_sut])
+        run.add_test(test)
+        annotator = run.annotators_for_test(test)[0]
+        baw = TestRunAnnotationWorker(run, InMemoryCache(), error_cache=ErrorCache(InMemoryCache()))
+        wrapped_test = ModelgaugeTestWrapper(test, tmp_path)
+
+        baw.handle_item(TestRunItem(wrapped_test, item_from_test, a_sut, sut_response))
+        item = baw.handle_item(TestRunItem(wrapped_test, item_from_test, a_sut, sut_response))
+
+        assert annotator.annotate_calls == 1
+        assert item.failed
+        exception_entry = run.journal.entry(-2)
+        assert exception_entry["message"] == "annotator exception"
+        assert exception_entry["exception"]["class"] == "CachedFailureError"
+        capsys.readouterr()
+
     def test_benchmark_annotation_worker_fix_empty_response_no_op(
         self, a_wrapped_test_with_goodyannotator, tmp_path, item_from_test: TestItem, sut_response, a_sut, benchmark
     ):
@@ -896,3 +981,26 @@ class TestRunTrackers:
         assert len(error_lines) == 3
         assert error_lines[0] == '{"progress": 0.0}'
         assert error_lines[-1] == '{"progress": 1.0}'
+
+    def test_json_with_pipeline_progress(self, capsys):
+        t = JsonRunTracker()
+
+        t.start(10)
+        t.progress({"completed": 5, "total": 10, "failed": 1, "items_per_second": 2.5, "stages": {}})
+        t.done()
+
+        error_lines = capsys.readouterr().err.strip().split("\n")
+        last = json.loads(error_lines[-1])
+        assert last["progress"] == 1.0
+        assert last["failed"] == 1
+        assert last["items_per_second"] == 2.5
+        assert "total" not in last
+
+    def test_tqdm_with_pipeline_progress(self, capsys):
+        t = TqdmRunTracker()
+
+        t.start(10)
+        t.progress({"completed": 5, "items_per_second": 2.5, "cache_hit_rate": 0.5, "stages": {}})
+        t.done()
+
+        assert "2.5 items/s, cache 50%" in capsys.readouterr().err
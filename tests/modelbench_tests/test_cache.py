@@ -1,4 +1,26 @@
-from modelbench.cache import MBCache, NullCache, InMemoryCache, DiskCache
+import json
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+from modelbench.cache import (
+    CacheKey,
+    MBCache,
+    NullCache,
+    InMemoryCache,
+    DiskCache,
+    TieredCache,
+    cache_stats,
+    convert_disk_cache,
+    export_caches,
+    import_caches,
+    migrate_cache_keys,
+    prune_cache,
+    vacuum_cache,
+)
+from modelbench.cli import cli
+from modelgauge.cache_codecs import TypedJsonCodec, is_encoded
 from pydantic import BaseModel
 
 
@@ -15,6 +37,11 @@ class TestNullCache:
             assert "a" not in cache
         assert "a" not in c
 
+    def test_get_or_compute_always_computes(self):
+        c = NullCache()
+        assert c.get_or_compute("a", lambda: 1) == 1
+        assert c.get_or_compute("a", lambda: 2) == 2
+
 
 class TestInMemoryCache:
     def test_basics(self):
@@ -31,6 +58,52 @@ class TestInMemoryCache:
             assert cache["a"] == 1
         assert c["a"] == 1
 
+    def test_get_or_compute(self):
+        c = InMemoryCache()
+        assert c.get_or_compute("a", lambda: 1) == 1
+        assert c.get_or_compute("a", lambda: 2) == 1
+        assert c["a"] == 1
+
+    def test_get_or_compute_keeps_falsy_values(self):
+        c = InMemoryCache()
+        c["a"] = None
+        assert c.get_or_compute("a", lambda: 1) is None
+
+    def test_get_or_compute_computes_once_for_concurrent_misses(self):
+        c = InMemoryCache()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(c.get_or_compute("a", compute))) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        assert results == ["value"] * 5
+        assert len(calls) == 1
+
+    def test_get_or_compute_failure_is_not_cached(self):
+        c = InMemoryCache()
+
+        def explode():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            c.get_or_compute("a", explode)
+        assert "a" not in c
+        assert c.get_or_compute("a", lambda: 1) == 1
+
 
 class Thing(BaseModel):
     x: int
@@ -63,6 +136,247 @@ class TestDiskCache:
             assert cache["a"] == 1
         assert c["a"] == 1
 
+    def test_get_or_compute_with_unhashable_key(self, tmp_path):
+        c = DiskCache(tmp_path)
+        key = ("a", Thing(x=1, y="b"))
+        assert c.get_or_compute(key, lambda: 1) == 1
+        assert c.get_or_compute(key, lambda: 2) == 1
+
     def test_as_string(self, tmp_path):
         c = DiskCache(tmp_path)
         assert str(c) == f"DiskCache({tmp_path})"
+
+    def test_stores_encoded_values(self, tmp_path):
+        c = DiskCache(tmp_path)
+        c["thing"] = Thing(x=42, y="hello")
+        assert is_encoded(c.raw_cache["thing"])
+        assert c["thing"] == Thing(x=42, y="hello")
+
+    def test_reads_values_stored_before_codecs(self, tmp_path):
+        c = DiskCache(tmp_path)
+        c.raw_cache["thing"] = Thing(x=42, y="hello")
+        assert c["thing"] == Thing(x=42, y="hello")
+
+    def test_convert(self, tmp_path):
+        c = DiskCache(tmp_path, keep_key_text=True)
+        key = CacheKey({"sut": "a_sut"})
+        c.raw_cache.set(str(key), Thing(x=1, y="old"), tag=key.text)
+        c["new"] = Thing(x=2, y="new")
+
+        converted = DiskCache(tmp_path, codec=TypedJsonCodec())
+        assert convert_disk_cache(converted) == 2
+        assert converted[key] == Thing(x=1, y="old")
+        assert converted["new"] == Thing(x=2, y="new")
+        assert converted.key_text(key) == key.text
+        assert converted.raw_cache[str(key)][len(b"MGC") + 1] == TypedJsonCodec.codec_id
+
+
+class TestTieredCache:
+    def test_basics(self, tmp_path):
+        c: MBCache = TieredCache(DiskCache(tmp_path))
+        c["a"] = 1
+        assert "a" in c
+        assert c["a"] == 1
+        assert len(c) == 1
+        assert list(c) == ["a"]
+        assert DiskCache(tmp_path)["a"] == 1
+
+    def test_hits_are_served_from_memory(self):
+        backing = InMemoryCache()
+        backing["a"] = Thing(x=1, y="b")
+        c = TieredCache(backing)
+        first = c["a"]
+        del backing.contents["a"]
+        assert c["a"] is first
+
+    def test_evicts_least_recently_used(self):
+        backing = InMemoryCache()
+        c = TieredCache(backing, max_items=2)
+        c["a"] = 1
+        c["b"] = 2
+        c["a"]
+        c["c"] = 3
+        assert list(c._memory) == ["a", "c"]
+        assert c["b"] == 2  # still in the backing cache
+
+    def test_evicts_by_size(self):
+        c = TieredCache(InMemoryCache(), max_bytes=10, sizeof=len)
+        c["a"] = "aaaa"
+        c["b"] = "bbbb"
+        c["c"] = "cccc"
+        assert list(c._memory) == ["b", "c"]
+        c["d"] = "d" * 11
+        assert list(c._memory) == ["b", "c"]
+        assert c["d"] == "d" * 11
+
+    def test_default_sizes_count_the_text(self):
+        c = TieredCache(InMemoryCache(), max_bytes=10_000)
+        c["small"] = Thing(x=1, y="b")
+        c["big"] = Thing(x=2, y="b" * 20_000)
+        assert list(c._memory) == ["small"]
+
+    def test_missing_key(self):
+        c = TieredCache(NullCache())
+        c["a"] = 1
+        assert c["a"] == 1
+        with pytest.raises(KeyError):
+            c["b"]
+
+    def test_get_or_compute_with_unhashable_key(self, tmp_path):
+        c = TieredCache(DiskCache(tmp_path))
+        key = ("a", Thing(x=1, y="b"))
+        assert c.get_or_compute(key, lambda: 1) == 1
+        assert c.get_or_compute(key, lambda: 2) == 1
+
+    def test_context(self, tmp_path):
+        c = TieredCache(DiskCache(tmp_path))
+        with c as cache:
+            cache["a"] = 1
+            assert cache["a"] == 1
+        assert c["a"] == 1
+
+    def test_as_string(self, tmp_path):
+        c = TieredCache(DiskCache(tmp_path))
+        assert str(c) == f"TieredCache(DiskCache({tmp_path}))"
+
+
+class TestCacheKey:
+    def test_is_compact_and_versioned(self):
+        key = CacheKey({"sut": "a_sut", "sut_request": {"text": "x" * 10_000}})
+        assert key.startswith("v2:")
+        assert len(key) == len("v2:") + 40
+        assert json.loads(key.text) == {"sut": "a_sut", "sut_request": {"text": "x" * 10_000}}
+
+    def test_ignores_field_order(self):
+        assert CacheKey({"a": 1, "b": {"c": 2, "d": 3}}) == CacheKey({"b": {"d": 3, "c": 2}, "a": 1})
+
+    def test_differs_by_content(self):
+        assert CacheKey({"sut": "a"}) != CacheKey({"sut": "b"})
+
+    def test_disk_cache_stores_plain_string_keys(self, tmp_path):
+        c = DiskCache(tmp_path)
+        key = CacheKey({"sut": "a"})
+        c[key] = 1
+        assert c[str(key)] == 1
+        assert type(list(c)[0]) is str
+        assert c.key_text(key) is None
+
+    def test_disk_cache_can_keep_key_text(self, tmp_path):
+        c = DiskCache(tmp_path, keep_key_text=True)
+        key = CacheKey({"sut": "a"})
+        c[key] = 1
+        assert c.key_text(key) == key.text
+
+
+class TestMigrateCacheKeys:
+    def old_cache(self, path):
+        c = DiskCache(path)
+        c[json.dumps({"sut": "a_sut", "sut_request": {"text": "hi", "max_tokens": 10}})] = "response"
+        c["not json"] = "other"
+        return c
+
+    def test_migrate(self, tmp_path):
+        c = self.old_cache(tmp_path)
+        assert migrate_cache_keys(c) == (1, 1)
+        assert c[CacheKey({"sut_request": {"max_tokens": 10, "text": "hi"}, "sut": "a_sut"})] == "response"
+        assert c["not json"] == "other"
+        assert len(c) == 2
+        assert migrate_cache_keys(c) == (0, 2)
+
+    def test_cli(self, tmp_path):
+        self.old_cache(tmp_path / "sut_cache")
+        result = CliRunner().invoke(cli, ["--run-path", str(tmp_path), "cache", "migrate-keys"], catch_exceptions=False)
+        assert result.exit_code == 0
+        assert "moved 1 entries, left 1 alone" in result.output
+
+
+class TestCacheAdmin:
+    def filled_cache(self, path, keep_key_text=False):
+        c = DiskCache(path, keep_key_text=keep_key_text)
+        for i in range(3):
+            c[CacheKey({"sut": "sut_a", "i": i}, owner="sut_a")] = "a" * 100
+        c[CacheKey({"annotator": "annotator_b"}, owner="annotator_b")] = "b" * 1000
+        c["old style"] = "c"
+        return c
+
+    def test_new_cache_gets_default_size_limit(self, tmp_path):
+        assert DiskCache(tmp_path).raw_cache.size_limit == 20 * 2**30
+
+    def test_existing_cache_keeps_its_size_limit(self, tmp_path):
+        DiskCache(tmp_path, size_limit=2**20)
+        assert DiskCache(tmp_path).raw_cache.size_limit == 2**20
+
+    @pytest.mark.parametrize("keep_key_text", [False, True])
+    def test_stats(self, tmp_path, keep_key_text):
+        report = cache_stats(self.filled_cache(tmp_path, keep_key_text))
+        assert report.total.entries == 5
+        assert report.by_owner["sut_a"].entries == 3
+        assert report.by_owner["annotator_b"].entries == 1
+        assert report.by_owner[None].entries == 1
+        assert report.by_owner["annotator_b"].bytes > report.by_owner["sut_a"].bytes / 3
+        assert report.total.oldest <= report.total.newest
+
+    def test_prune_by_owner(self, tmp_path):
+        c = self.filled_cache(tmp_path)
+        assert prune_cache(c, owners=["sut_a"]) == 3
+        assert set(cache_stats(c).by_owner) == {"annotator_b", None}
+
+    def test_prune_by_age(self, tmp_path):
+        c = self.filled_cache(tmp_path)
+        assert prune_cache(c, older_than=60) == 0
+        time.sleep(0.01)
+        assert prune_cache(c, owners=["annotator_b"], older_than=0) == 1
+        assert len(c) == 4
+
+    def test_prune_to_size(self, tmp_path):
+        c = self.filled_cache(tmp_path)
+        prune_cache(c, max_size=0)
+        assert len(c) == 0
+        assert DiskCache(tmp_path).raw_cache.size_limit == 0
+
+    def test_vacuum(self, tmp_path):
+        c = self.filled_cache(tmp_path)
+        before, after = vacuum_cache(c)
+        assert after <= before
+        assert len(c) == 5
+
+    def test_export_and_import(self, tmp_path):
+        sut_cache = self.filled_cache(tmp_path / "run" / "sut_cache", keep_key_text=True)
+        export_path = tmp_path / "export.jsonl.zst"
+        assert export_caches([sut_cache], export_path, owners=["sut_a"]) == 3
+
+        opened = {}
+
+        def open_cache(name):
+            opened[name] = DiskCache(tmp_path / "other" / name)
+            return opened[name]
+
+        assert import_caches(export_path, open_cache) == (3, 0)
+        imported = opened["sut_cache"]
+        key = CacheKey({"sut": "sut_a", "i": 1})
+        assert imported[key] == "a" * 100
+        assert imported.key_text(key) == key.text
+        assert import_caches(export_path, open_cache) == (0, 3)
+
+    def test_cli(self, tmp_path):
+        self.filled_cache(tmp_path / "sut_cache")
+        runner = CliRunner()
+
+        result = runner.invoke(cli, ["--run-path", str(tmp_path), "cache", "stats"], catch_exceptions=False)
+        assert result.exit_code == 0
+        assert "sut_a" in result.output
+
+        result = runner.invoke(
+            cli, ["--run-path", str(tmp_path), "cache", "prune", "--uid", "sut_a"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        assert "removed 3 entries" in result.output
+
+        result = runner.invoke(cli, ["--run-path", str(tmp_path), "cache", "prune"])
+        assert result.exit_code != 0
+
+        result = runner.invoke(
+            cli, ["--run-path", str(tmp_path), "cache", "prune", "--max-size", "lots"], catch_exceptions=False
+        )
+        assert result.exit_code != 0
+        assert "isn't a size" in result.output
@@ -0,0 +1,154 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+from modelbench.cache import CACHE_TOKEN_ENV, CacheKey, HttpCache, TieredCache
+from modelbench.cache_server import CacheServer
+from modelgauge.cache_codecs import PickleCodec, TypedJsonCodec
+from modelgauge.response_store import open_response_store
+
+TOKEN = "a-secret"
+
+
+class Thing(BaseModel):
+    x: int
+    y: str
+
+
+@pytest.fixture
+def server(tmp_path):
+    return CacheServer(tmp_path, TOKEN)
+
+
+@pytest.fixture
+def client(server):
+    return TestClient(server.app, headers={"Authorization": f"Bearer {TOKEN}"})
+
+
+@pytest.fixture
+def cache(server):
+    return HttpCache("http://testserver", "sut_cache", session=TestClient(server.app), token=TOKEN)
+
+
+class TestCacheServer:
+    def test_put_and_get(self, client):
+        response = client.post("/caches/a_cache/put", json={"entries": {"k": "aGk="}, "tags": {"k": "a_sut"}})
+        assert response.status_code == 200
+        assert response.json() == {"name": "a_cache", "written": 1}
+
+        response = client.post("/caches/a_cache/get", json={"keys": ["k", "missing"]})
+        assert response.json()["entries"] == {"k": "aGk="}
+
+    def test_caches_are_separate(self, client):
+        client.post("/caches/one/put", json={"entries": {"k": "aGk="}})
+        assert client.get("/caches/one").json()["entries"] == 1
+        assert client.get("/caches/two").json()["entries"] == 0
+
+    def test_put_reports_the_keys_written(self, client):
+        client.post("/caches/a_cache/put", json={"entries": {"k1": "aGk=", "k2": "aGk="}})
+        response = client.post("/caches/a_cache/put", json={"entries": {"k3": "aGk="}})
+        assert response.json()["written"] == 1
+        assert client.get("/caches/a_cache").json()["entries"] == 3
+
+    def test_keys(self, client):
+        client.post("/caches/a_cache/put", json={"entries": {"k1": "aGk=", "k2": "aGk="}})
+        assert sorted(client.get("/caches/a_cache/keys").json()["keys"]) == ["k1", "k2"]
+
+    def test_rejects_bad_cache_names(self, client):
+        assert client.get("/caches/..").status_code in (400, 404)
+        assert client.get("/caches/a%20b").status_code == 400
+
+    def test_requires_the_token(self, server):
+        client = TestClient(server.app)
+        assert client.get("/caches/a_cache").status_code == 401
+        assert client.get("/caches/a_cache", headers={"Authorization": "Bearer wrong"}).status_code == 401
+        assert client.post("/caches/a_cache/put", json={"entries": {"k": "aGk="}}).status_code == 401
+        assert client.get("/caches/a_cache", headers={"Authorization": f"Bearer {TOKEN}"}).status_code == 200
+
+    def test_needs_a_token(self, tmp_path):
+        with pytest.raises(ValueError):
+            CacheServer(tmp_path, "")
+
+    def test_listens_on_localhost_by_default(self, server):
+        assert server.host == "127.0.0.1"
+
+    def test_tags_are_kept(self, client, server):
+        client.post("/caches/a_cache/put", json={"entries": {"k": "aGk="}, "tags": {"k": "a_sut"}})
+        _, tag = server.cache("a_cache").raw_cache.get("k", tag=True)
+        assert tag == "a_sut"
+
+
+class TestHttpCache:
+    def test_basics(self, cache):
+        cache["a"] = Thing(x=1, y="one")
+        assert cache["a"] == Thing(x=1, y="one")
+        assert "a" in cache
+        assert "b" not in cache
+        assert len(cache) == 1
+        assert list(cache) == ["a"]
+
+    def test_many(self, cache):
+        cache.set_many({"a": Thing(x=1, y="one"), "b": Thing(x=2, y="two")})
+        assert cache.get_many(["a", "b", "c"]) == {"a": Thing(x=1, y="one"), "b": Thing(x=2, y="two")}
+
+    def test_sends_json_by_default(self, cache):
+        assert isinstance(cache.codec, TypedJsonCodec)
+        cache["a"] = "not json-typeable"
+        assert "a" not in cache
+
+    def test_refuses_values_from_other_codecs(self, server, cache):
+        pickling = HttpCache("http://testserver", "sut_cache", codec=PickleCodec(), session=cache.session, token=TOKEN)
+        pickling["a"] = Thing(x=1, y="one")
+        assert pickling["a"] == Thing(x=1, y="one")
+        assert "a" not in cache
+        server.cache("sut_cache").raw_cache.set("b", b"not encoded")
+        assert "b" not in cache
+
+    def test_reads_the_token_from_the_environment(self, server, monkeypatch):
+        monkeypatch.setenv(CACHE_TOKEN_ENV, TOKEN)
+        cache = HttpCache("http://testserver", "sut_cache", session=TestClient(server.app))
+        cache["a"] = Thing(x=1, y="one")
+        assert cache["a"] == Thing(x=1, y="one")
+
+    def test_sends_the_token(self, monkeypatch):
+        monkeypatch.delenv(CACHE_TOKEN_ENV, raising=False)
+        assert HttpCache("http://cache-host", "sut_cache", token=TOKEN).headers == {"Authorization": f"Bearer {TOKEN}"}
+        assert HttpCache("http://cache-host", "sut_cache").headers == {}
+
+    def test_cache_keys_carry_their_owner(self, cache, server):
+        key = CacheKey({"sut": "a_sut"}, owner="a_sut")
+        cache[key] = Thing(x=1, y="response")
+        assert cache[key] == Thing(x=1, y="response")
+        _, tag = server.cache("sut_cache").raw_cache.get(str(key), tag=True)
+        assert tag == "a_sut"
+
+    def test_shared_between_clients(self, client):
+        HttpCache("http://testserver", "shared", session=client, token=TOKEN)["a"] = Thing(x=1, y="one")
+        assert HttpCache("http://testserver", "shared", session=client, token=TOKEN)["a"] == Thing(x=1, y="one")
+
+    def test_get_or_compute(self, cache):
+        assert cache.get_or_compute("a", lambda: Thing(x=1, y="one")) == Thing(x=1, y="one")
+        assert cache.get_or_compute("a", lambda: Thing(x=2, y="two")) == Thing(x=1, y="one")
+
+    def test_unreachable_server_misses(self):
+        cache = HttpCache("http://127.0.0.1:9", "sut_cache", timeout=1)
+        cache["a"] = Thing(x=1, y="one")
+        assert "a" not in cache
+        assert len(cache) == 0
+        assert cache.get_or_compute("a", lambda: 2) == 2
+
+    def test_tiered(self, cache):
+        tiered = TieredCache(cache)
+        tiered["a"] = Thing(x=1, y="one")
+        assert tiered["a"] == Thing(x=1, y="one")
+        assert cache["a"] == Thing(x=1, y="one")
+
+    def test_as_string(self, cache):
+        assert str(cache) == "HttpCache(http://testserver/caches/sut_cache)"
+
+
+def test_response_store_can_be_remote():
+    store = open_response_store("http://cache-host:8765")
+    assert isinstance(store, TieredCache)
+    assert isinstance(store.backing, HttpCache)
+    assert store.backing.base_url == "http://cache-host:8765"
@@ -0,0 +1,143 @@
+import pytest
+from click.testing import CliRunner
+
+from modelbench.benchmark_runner import TestRunAnnotationWorker, TestRunSutWorker
+from modelbench.cache import DiskCache, InMemoryCache
+from modelbench.cache_warmup import JournalCacheWarmer, native_types
+from modelbench.cli import cli
+from modelbench.run_journal import RunJournal, find_journals
+from modelgauge.sut import SUTResponse
+from modelgauge.suts.demo_01_yes_no_sut import DemoYesNoRequest, DemoYesNoResponse
+from modelgauge_tests.fake_annotator import FakeAnnotatorRequest, FakeAnnotatorResponse, FakeSafetyAnnotator
+from modelgauge_tests.fake_sut import FakeSUT, FakeSUTRequest, FakeSUTResponse
+
+TestRunSutWorker.__test__ = False
+TestRunAnnotationWorker.__test__ = False
+
+
+class TypedFakeAnnotator(FakeSafetyAnnotator):
+    def annotate(self, annotation_request: FakeAnnotatorRequest) -> FakeAnnotatorResponse:
+        return super().annotate(annotation_request)
+
+
+class TextSUT(FakeSUT):
+    def evaluate(self, request: FakeSUTRequest) -> SUTResponse:
+        return SUTResponse(text=request.text)
+
+
+def write_journal(path, *entries):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with RunJournal(path) as journal:
+        for message, kwargs in entries:
+            journal.raw_entry(message, test="a_test", prompt_id="p1", **kwargs)
+    return path
+
+
+def sut_entry(sut_uid="fake-sut", text="hello", message="fetched sut response"):
+    return message, dict(sut=sut_uid, request=FakeSUTRequest(text=text), response=FakeSUTResponse(text=text))
+
+
+def annotator_entry(annotator_uid="typed_annotator", text="hello", message="fetched annotator response"):
+    request_field = "request" if message == "fetched annotator response" else "annotator_request"
+    return message, {
+        "sut": "fake-sut",
+        "annotator": annotator_uid,
+        request_field: FakeAnnotatorRequest(text=text),
+        "response": FakeAnnotatorResponse(sut_text=text),
+    }
+
+
+SUTS_BY_UID = {"fake-sut": FakeSUT(), "text-sut": TextSUT("text-sut")}
+ANNOTATORS_BY_UID = {
+    "typed_annotator": TypedFakeAnnotator("typed_annotator"),
+    "untyped_annotator": FakeSafetyAnnotator("untyped_annotator"),
+}
+
+
+@pytest.fixture
+def sut_cache():
+    return InMemoryCache()
+
+
+@pytest.fixture
+def annotator_cache():
+    return InMemoryCache()
+
+
+@pytest.fixture
+def warmer(sut_cache, annotator_cache):
+    return JournalCacheWarmer(sut_cache, annotator_cache, SUTS_BY_UID.get, ANNOTATORS_BY_UID.get)
+
+
+def test_native_types():
+    types = native_types(FakeSUT().evaluate)
+    assert types.request is FakeSUTRequest
+    assert types.response is FakeSUTResponse
+
+    types = native_types(FakeSafetyAnnotator("a").annotate)
+    assert types.request is FakeAnnotatorRequest
+    assert types.response is None
+
+
+def test_sut_responses_use_the_runner_keys(tmp_path, warmer, sut_cache):
+    journal = write_journal(
+        tmp_path / "journal-1.jsonl.zst", sut_entry(), sut_entry(message="using cached sut response")
+    )
+    counts = warmer.warm([journal])
+    assert (counts.added, counts.present, counts.skipped) == (1, 1, 0)
+    key = TestRunSutWorker.make_cache_key(FakeSUTRequest(text="hello"), "fake-sut")
+    assert sut_cache[key] == FakeSUTResponse(text="hello")
+
+
+def test_sut_responses_that_are_sut_responses(tmp_path, warmer, sut_cache):
+    entry = (
+        "fetched sut response",
+        dict(sut="text-sut", request=FakeSUTRequest(text="hi"), response=SUTResponse(text="hi")),
+    )
+    warmer.warm([write_journal(tmp_path / "journal-1.jsonl.zst", entry)])
+    assert sut_cache[TestRunSutWorker.make_cache_key(FakeSUTRequest(text="hi"), "text-sut")] == SUTResponse(text="hi")
+
+
+@pytest.mark.parametrize("message", ["fetched annotator response", "using cached annotator response"])
+def test_annotator_responses_use_the_runner_keys(tmp_path, warmer, annotator_cache, message):
+    warmer.warm([write_journal(tmp_path / "journal-1.jsonl.zst", annotator_entry(message=message))])
+    key = TestRunAnnotationWorker.make_cache_key(FakeAnnotatorRequest(text="hello"), "typed_annotator")
+    assert annotator_cache[key] == FakeAnnotatorResponse(sut_text="hello")
+
+
+def test_skips_what_cant_be_rebuilt(tmp_path, warmer, sut_cache, annotator_cache):
+    journal = write_journal(
+        tmp_path / "journal-1.jsonl.zst",
+        sut_entry(sut_uid="unknown-sut"),
+        annotator_entry(annotator_uid="untyped_annotator"),
+        ("fetched sut response", dict(sut="fake-sut", request={"no": "text"}, response=FakeSUTResponse(text="x"))),
+    )
+    counts = warmer.warm([journal])
+    assert (counts.added, counts.present, counts.skipped) == (0, 0, 3)
+    assert len(sut_cache) == 0
+    assert len(annotator_cache) == 0
+
+
+def test_find_journals(tmp_path):
+    write_journal(tmp_path / "a" / "journal-1.jsonl.zst")
+    write_journal(tmp_path / "b" / "journal-2.jsonl.zst")
+    other = write_journal(tmp_path / "other.jsonl")
+    found = find_journals([tmp_path, other])
+    assert [p.name for p in found] == ["journal-1.jsonl.zst", "journal-2.jsonl.zst", "other.jsonl"]
+
+
+def test_cli(tmp_path):
+    request = DemoYesNoRequest(text="one two")
+    response = DemoYesNoResponse(number_of_words=2, text="Yes")
+    write_journal(
+        tmp_path / "old_run" / "journals" / "journal-1.jsonl.zst",
+        ("fetched sut response", dict(sut="demo_yes_no", request=request, response=response)),
+    )
+    run_path = tmp_path / "new_run"
+    result = CliRunner().invoke(
+        cli, ["--run-path", str(run_path), "cache", "warm", str(tmp_path / "old_run")], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    assert "added 1 entries" in result.output
+    cache = DiskCache(run_path / "sut_cache")
+    assert cache[TestRunSutWorker.make_cache_key(request, "demo_yes_no")] == response
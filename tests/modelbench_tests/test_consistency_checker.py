@@ -20,6 +20,7 @@ from modelbench.consistency_checker import (
     NumItemsFinishedEqualsMeasuredItems,
     summarize_consistency_check_results,
 )
+from modelbench.run_journal import RunJournal
 from modelbench.scoring import score_to_ordinal_grade
 
 DEFAULT_SUT = "sut1"
@@ -227,6 +228,52 @@ def test_calibration_run(tmp_path, calibration_run):
         assert subchecker.warnings == []
 
 
+def test_search_queries_match_a_scan(tmp_path, basic_benchmark_run):
+    checker = init_checker_for_journal(tmp_path, basic_benchmark_run)
+    search = checker.search_engine
+
+    def scan(message, **kwargs):
+        return [e for e in basic_benchmark_run if e["message"] == message and all(e[k] == v for k, v in kwargs.items())]
+
+    for kwargs in [{}, {"sut": "sut2"}, {"sut": "sut1", "test": "test1"}, {"test": "test1", "annotator": "annotator2"}]:
+        found = search.query("translated annotation", **kwargs)
+        expected = scan("translated annotation", **kwargs)
+        assert len(found) == len(expected) > 0
+        assert [e["prompt_id"] for e in found] == [e["prompt_id"] for e in expected]
+    assert search.query("translated annotation", sut="sut1", prompt_id="prompt2") == search.query(
+        "translated annotation", sut="sut1", test="test1", prompt_id="prompt2"
+    )
+    assert search.query("hazard info", benchmark="general") == search.query("hazard info", hazard="hazard1")
+    assert search.query("translated annotation", sut="no such sut") == []
+    assert search.query("no such message") == []
+
+
+def test_search_keeps_only_checked_fields(tmp_path, basic_benchmark_run):
+    for entry in basic_benchmark_run.find_all("translated annotation"):
+        entry["annotation"] = {"is_safe": True, "is_valid": True, "metadata": {"joined_responses": [1, 2]}, "raw": "x"}
+        entry["extra"] = "not checked"
+    checker = init_checker_for_journal(tmp_path, basic_benchmark_run)
+
+    entry = checker.search_engine.query("translated annotation", sut="sut1", annotator="annotator1")[0]
+    assert "extra" not in entry
+    assert entry["annotation"] == {"is_safe": True, "is_valid": True, "joined_response_count": 2}
+    assert checker.search_engine.query("translated sut response", sut="sut1")[0]["blank_response"] is False
+
+
+def test_checks_entries_collected_while_the_journal_is_written(tmp_path, basic_benchmark_run):
+    search = JournalSearch()
+    with RunJournal(tmp_path / "journal-run-1.jsonl.zst", subscribers=[search.add]) as journal:
+        for entry in basic_benchmark_run:
+            journal.raw_entry(**entry)
+    # the live search is all the checker reads
+    (tmp_path / "journal-run-1.jsonl.zst").unlink()
+
+    checker = ConsistencyChecker(tmp_path / "journal-run-1.jsonl.zst", search_engine=search)
+    checker.run()
+    assert checker.checks_are_complete()
+    assert checker.checks_all_passed()
+
+
 def test_entities_collected(tmp_path, basic_benchmark_run):
     checker = init_checker_for_journal(tmp_path, basic_benchmark_run)
 
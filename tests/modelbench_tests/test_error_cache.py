@@ -0,0 +1,93 @@
+import pytest
+
+from modelbench.cache import CacheKey, DiskCache, InMemoryCache
+from modelbench.error_cache import CachedFailureError, ErrorCache, is_deterministic_failure, status_code_of
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ResponseError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.response = FakeResponse(status_code)
+
+
+class CodeError(Exception):
+    code = 404
+
+
+@pytest.fixture
+def key():
+    return CacheKey({"sut": "a_sut", "sut_request": {"text": "hi"}}, owner="a_sut")
+
+
+def test_status_code_of():
+    assert status_code_of(StatusError(400)) == 400
+    assert status_code_of(ResponseError(422)) == 422
+    assert status_code_of(CodeError()) == 404
+    assert status_code_of(ValueError("no status")) is None
+
+
+@pytest.mark.parametrize("status, deterministic", [(400, True), (413, True), (429, False), (500, False), (503, False)])
+def test_is_deterministic_failure(status, deterministic):
+    assert is_deterministic_failure(StatusError(status)) == deterministic
+    assert is_deterministic_failure(ResponseError(status)) == deterministic
+
+
+def test_records_and_replays(key):
+    errors = ErrorCache(InMemoryCache())
+    errors.check(key)
+    assert errors.record(key, StatusError(400))
+    with pytest.raises(CachedFailureError, match="StatusError: status 400") as e:
+        errors.check(key)
+    assert e.value.failure.exception_class == "StatusError"
+
+
+def test_ignores_other_failures(key):
+    errors = ErrorCache(InMemoryCache())
+    assert not errors.record(key, StatusError(500))
+    assert not errors.record(key, ValueError("oops"))
+    errors.check(key)
+    assert len(errors) == 0
+
+
+def test_doesnt_record_replayed_failures(key):
+    errors = ErrorCache(InMemoryCache())
+    errors.record(key, StatusError(400))
+    with pytest.raises(CachedFailureError) as e:
+        errors.check(key)
+    assert not ErrorCache(InMemoryCache()).record(key, e.value)
+
+
+def test_failures_expire(key):
+    errors = ErrorCache(InMemoryCache(), ttl=0)
+    errors.record(key, StatusError(400))
+    errors.check(key)
+
+
+def test_custom_policy(key):
+    errors = ErrorCache(InMemoryCache(), is_deterministic=lambda e: isinstance(e, ValueError))
+    assert errors.record(key, ValueError("content filter"))
+    assert not errors.record(key, StatusError(400))
+
+
+def test_default_remembers_nothing(key):
+    errors = ErrorCache()
+    errors.record(key, StatusError(400))
+    errors.check(key)
+
+
+def test_on_disk(tmp_path, key):
+    with ErrorCache(DiskCache(tmp_path)) as errors:
+        errors.record(key, StatusError(400))
+    with pytest.raises(CachedFailureError):
+        ErrorCache(DiskCache(tmp_path)).check(key)
@@ -0,0 +1,94 @@
+import json
+
+import pyarrow.parquet as pq
+from click.testing import CliRunner
+
+from modelbench.cli import cli
+from modelbench.journal_columns import journal_columns_path, read_journal_columns, write_journal_columns
+from modelbench.run_journal import RunJournal
+
+
+def write_journal(path):
+    with RunJournal(path) as journal:
+        journal.raw_entry("queuing item", test="a_test", sut="a_sut", prompt_id="p1", prompt_text="Hello?")
+        journal.raw_entry(
+            "translated annotation",
+            test="a_test",
+            sut="a_sut",
+            prompt_id="p1",
+            annotator="an_annotator",
+            annotation={"is_safe": False, "is_valid": True},
+        )
+        journal.raw_entry(
+            "measured item quality",
+            test="a_test",
+            sut="a_sut",
+            prompt_id="p1",
+            run_time=0.25,
+            measurements={"is_safe": 1.0},
+        )
+    return path
+
+
+def test_sidecar_path(tmp_path):
+    assert journal_columns_path(tmp_path / "journal-run-1.jsonl.zst") == tmp_path / "journal-run-1.parquet"
+    assert journal_columns_path(tmp_path / "journal-run-1.jsonl") == tmp_path / "journal-run-1.parquet"
+
+
+def test_one_file_per_message(tmp_path):
+    sidecar = write_journal_columns(write_journal(tmp_path / "journal-run-1.jsonl.zst"))
+    assert sorted(p.name for p in sidecar.iterdir()) == [
+        "measured_item_quality.parquet",
+        "queuing_item.parquet",
+        "starting_journal.parquet",
+        "translated_annotation.parquet",
+    ]
+    assert len(read_journal_columns(sidecar)) == 4
+
+
+def test_typed_columns(tmp_path):
+    sidecar = write_journal_columns(write_journal(tmp_path / "journal-run-1.jsonl.zst"))
+
+    annotations = read_journal_columns(sidecar, "translated annotation").to_pylist()
+    assert len(annotations) == 1
+    assert annotations[0]["annotator"] == "an_annotator"
+    assert annotations[0]["is_safe"] == 0.0
+    assert annotations[0]["timestamp"].year >= 2024
+
+    measured = read_journal_columns(sidecar, "measured item quality", columns=["prompt_id", "run_time", "is_safe"])
+    assert measured.to_pylist() == [{"prompt_id": "p1", "run_time": 0.25, "is_safe": 1.0}]
+
+
+def test_other_fields_are_kept_as_json(tmp_path):
+    sidecar = write_journal_columns(write_journal(tmp_path / "journal-run-1.jsonl.zst"))
+    queued = read_journal_columns(sidecar, "queuing item").to_pylist()[0]
+    fields = json.loads(queued["fields"])
+    assert fields["prompt_text"] == "Hello?"
+    assert "sut" not in fields
+
+
+def test_missing_messages_are_empty(tmp_path):
+    sidecar = write_journal_columns(write_journal(tmp_path / "journal-run-1.jsonl.zst"))
+    assert len(read_journal_columns(sidecar, "no such message", columns=["sut"])) == 0
+
+
+def test_the_sidecar_is_one_dataset(tmp_path):
+    sidecar = write_journal_columns(write_journal(tmp_path / "journal-run-1.jsonl.zst"))
+    assert pq.read_table(sidecar).num_rows == 4
+
+
+def test_rewriting_replaces(tmp_path):
+    journal = write_journal(tmp_path / "journal-run-1.jsonl.zst")
+    write_journal_columns(journal)
+    sidecar = write_journal_columns(journal)
+    assert len(read_journal_columns(sidecar)) == 4
+
+
+def test_cli(tmp_path):
+    (tmp_path / "journals").mkdir()
+    write_journal(tmp_path / "journals" / "journal-run-1.jsonl.zst")
+    result = CliRunner().invoke(
+        cli, ["--run-path", str(tmp_path), "journal-columns", str(tmp_path / "journals")], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    assert (tmp_path / "journals" / "journal-run-1.parquet" / "queuing_item.parquet").exists()
@@ -1,4 +1,9 @@
 import json
+import os
+import signal
+import subprocess
+import sys
+import threading
 import time
 from datetime import datetime
 from inspect import getframeinfo, currentframe
@@ -12,7 +17,8 @@ import zstandard
 from pydantic import BaseModel
 
 from modelbench.benchmark_runner_items import Timer
-from modelbench.run_journal import RunJournal, for_journal
+from modelbench import run_journal
+from modelbench.run_journal import RunJournal, flush_journals_on_signals, for_journal
 from modelgauge.locales import EN_US
 from modelgauge.sut import SUTResponse
 from modelgauge.model_options import TokenProbability, TopTokens
@@ -115,7 +121,19 @@ class TestForJournal:
             assert j["lineno"] == f.lineno + 2
             assert j["function"] == "test_exception"
             assert j["arguments"] == {"self": repr(self)}
-            assert j["variables"] == {"f": repr(f), "e": repr(e)}
+            assert "variables" not in j
+
+    def test_exception_arguments_are_shortened(self):
+        def fail(text):
+            try:
+                raise ValueError("no")
+            except ValueError as e:
+                return for_journal(e)
+
+        j = fail("x" * 10_000)
+        assert j["function"] == "fail"
+        assert j["arguments"]["text"].startswith("'xxx")
+        assert len(j["arguments"]["text"]) < 300
 
     def test_timer(self):
         with Timer() as t:
@@ -134,6 +152,26 @@ def reader_for(path):
         return open(path, "r")
 
 
+def write_scratch_entry(journal):
+    journal.raw_entry("scratch")
+
+
+def write_nested_scratch_entry(journal):
+    def nested():
+        journal.raw_entry("scratch")
+
+    nested()
+
+
+class Logger:
+    def log(self, journal):
+        journal.raw_entry("scratch")
+
+
+class Subclass(Logger):
+    pass
+
+
 class TestRunJournal:
     def test_file_output(self, tmp_path, capsys):
         journal_file = tmp_path / "journal.jsonl.zst"
@@ -181,6 +219,44 @@ class TestRunJournal:
         assert e["class"] == self.__class__.__name__
         assert e["method"] == "test_class_and_method_normal"
 
+    def test_class_and_method_from_a_closure(self, journal):
+        def log():
+            journal.raw_entry("scratch", me=repr(self))
+
+        log()
+
+        e = journal.last_entry()
+        assert e["class"] == self.__class__.__name__
+        assert e["method"] == "log"
+
+    def test_function(self, journal):
+        write_scratch_entry(journal)
+
+        e = journal.last_entry()
+        assert e["function"] == "write_scratch_entry"
+        assert "class" not in e
+
+    def test_class_is_the_callers_class(self, journal):
+        Subclass().log(journal)
+
+        e = journal.last_entry()
+        assert e["class"] == "Subclass"
+        assert e["method"] == "log"
+
+    def test_function_defined_in_a_function(self, journal):
+        write_nested_scratch_entry(journal)
+
+        e = journal.last_entry()
+        assert e["function"] == "nested"
+        assert "class" not in e
+
+    def test_item_entry_reports_its_caller(self, journal):
+        journal.item_entry("an item", self.make_test_run_item("id1", "a_test", "Hello?"))
+
+        e = journal.last_entry()
+        assert e["class"] == self.__class__.__name__
+        assert e["method"] == "test_item_entry_reports_its_caller"
+
     def test_exception_output(self, journal):
         journal.raw_entry("exception", exception=ValueError("your values are suspicious"))
 
@@ -259,3 +335,167 @@ class TestRunJournal:
             assert j["message"] == "thread_entry"
             items_seen.add(j["entry"])
         assert len(items_seen) == 16 * 16
+
+
+class SlowOutput(FakeOutput):
+    def write(self, text):
+        time.sleep(0.01)
+        return super().write(text)
+
+
+class FlushTrackingOutput(FakeOutput):
+    def __init__(self):
+        super().__init__()
+        self.flushed = threading.Event()
+
+    def flush(self):
+        super().flush()
+        self.flushed.set()
+
+
+class BrokenOutput(FakeOutput):
+    def write(self, text):
+        raise OSError("disk full")
+
+
+class TestBackgroundRunJournal:
+    def test_file_output_keeps_order(self, tmp_path):
+        journal_file = tmp_path / "journal.jsonl.zst"
+        with RunJournal(journal_file, buffer_size=10) as journal:
+            assert journal._writer is not None
+            for n in range(1000):
+                journal.raw_entry("entry", n=n)
+
+        lines = reader_for(journal_file).readlines()
+        assert [json.loads(line).get("n") for line in lines[1:]] == list(range(1000))
+
+    def test_streams_are_synchronous_by_default(self):
+        o = FakeOutput()
+        with RunJournal(o) as journal:
+            assert journal._writer is None
+            journal.raw_entry("entry")
+            assert len(o.lines()) == 2
+
+    def test_flush(self):
+        o = SlowOutput()
+        journal = RunJournal(o, background=True)
+        for n in range(10):
+            journal.raw_entry("entry", n=n)
+        journal.flush()
+        assert len(o.lines()) == 11
+        journal.close()
+
+    def test_thread_safety_with_small_buffer(self):
+        o = FakeOutput()
+        with RunJournal(o, background=True, buffer_size=2) as journal:
+
+            def f(n):
+                journal.raw_entry("thread_entry", entry=n)
+
+            with ThreadPool(16) as pool:
+                pool.map(f, range(16 * 16))
+
+        entries = [json.loads(line) for line in o.lines()[1:]]
+        assert {e["entry"] for e in entries} == set(range(16 * 16))
+
+    def test_write_errors_are_raised_on_close(self):
+        journal = RunJournal(BrokenOutput(), background=True)
+        journal.raw_entry("entry")
+        with pytest.raises(OSError, match="disk full"):
+            journal.close()
+
+    def test_signals_flush_open_journals(self, monkeypatch):
+        monkeypatch.setattr(run_journal, "_flushing_on_signals", False)
+        received = []
+        original = signal.signal(signal.SIGUSR2, lambda sig, frame: received.append(sig))
+        o = FlushTrackingOutput()
+        journal = RunJournal(o, background=True)
+        try:
+            flush_journals_on_signals([signal.SIGUSR2])
+            for n in range(10):
+                journal.raw_entry("entry", n=n)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            assert received == [signal.SIGUSR2]
+            assert o.flushed.wait(timeout=5)
+            assert len(o.lines()) == 11
+        finally:
+            signal.signal(signal.SIGUSR2, original)
+            journal.close()
+
+    def test_signal_handler_does_not_wait_for_the_journal(self, monkeypatch):
+        monkeypatch.setattr(run_journal, "_flushing_on_signals", False)
+        original = signal.signal(signal.SIGUSR2, lambda sig, frame: None)
+        o = FlushTrackingOutput()
+        journal = RunJournal(o, background=True)
+        try:
+            flush_journals_on_signals([signal.SIGUSR2])
+            with journal.output_lock:
+                os.kill(os.getpid(), signal.SIGUSR2)
+                assert not o.flushed.is_set()
+            assert o.flushed.wait(timeout=5)
+        finally:
+            signal.signal(signal.SIGUSR2, original)
+            journal.close()
+
+    def test_terminating_signal_closes_journals_first(self, tmp_path):
+        journal_file = tmp_path / "journal.jsonl.zst"
+        script = f"""
+import os, signal, time
+from modelbench.run_journal import RunJournal, flush_journals_on_signals
+flush_journals_on_signals([signal.SIGTERM])
+journal = RunJournal({str(journal_file)!r})
+for n in range(1000):
+    journal.raw_entry("entry", n=n)
+os.kill(os.getpid(), signal.SIGTERM)
+time.sleep(30)
+"""
+        result = subprocess.run([sys.executable, "-c", script], timeout=30)
+        assert result.returncode == -signal.SIGTERM
+        lines = reader_for(journal_file).readlines()
+        assert [json.loads(line).get("n") for line in lines[1:]] == list(range(1000))
+
+    def test_entries_after_close_are_dropped(self):
+        o = FakeOutput()
+        journal = RunJournal(o, background=True)
+        journal.close()
+        journal.raw_entry("too late")
+        journal.flush()
+        assert len(o.lines()) == 1
+
+
+class TestRunJournalSubscribers:
+    def test_subscribers_see_every_entry(self, tmp_path):
+        journal_file = tmp_path / "journal.jsonl.zst"
+        seen = []
+        with RunJournal(journal_file, subscribers=[seen.append]) as journal:
+            for n in range(100):
+                journal.raw_entry("entry", n=n)
+
+        assert seen == [json.loads(line) for line in reader_for(journal_file).readlines()]
+
+    def test_subscribe_later(self):
+        seen = []
+        with RunJournal(FakeOutput()) as journal:
+            journal.subscribe(seen.append)
+            journal.raw_entry("entry")
+        assert [e["message"] for e in seen] == ["entry"]
+
+    def test_subscribers_without_output(self):
+        seen = []
+        with RunJournal(subscribers=[seen.append]) as journal:
+            journal.raw_entry("entry", n=1)
+        assert [(e["message"], e.get("n")) for e in seen] == [("starting journal", None), ("entry", 1)]
+
+    def test_failing_subscribers_are_dropped(self):
+        def broken(entry):
+            raise ValueError("oops")
+
+        seen = []
+        o = FakeOutput()
+        with RunJournal(o, background=True, subscribers=[broken, seen.append]) as journal:
+            journal.raw_entry("entry")
+
+        assert len(o.lines()) == 2
+        assert len(seen) == 2
+        assert journal.subscribers == [seen.append]
+        assert [str(e) for e in journal.subscriber_errors] == ["oops"]
@@ -18,6 +18,7 @@ from modelgauge_tests.annotator_tests.composer_tests.mocks import (
     UpperCaser,
 )
 
+from modelbench.cache import TieredCache
 from modelgauge.annotators.composed_annotator import Safety
 from modelgauge.annotators.composer.context import EvalContext
 from modelgauge.annotators.composer.dag import Composer, ComposerColumnNames, FailedDAGOutput
@@ -83,6 +84,16 @@ def test_dag_run_with_cache(cached_minimal_dag, sample_ctx):
     assert output_cached.verdict.name == "SAFE"
 
 
+def test_dag_node_caches_keep_results_in_memory(cached_minimal_dag, sample_ctx):
+    node_cache = cached_minimal_dag._node_caches["always_true"]
+    assert isinstance(node_cache, TieredCache)
+    AlwaysTrueCacheable.run_count = 0
+    assert cached_minimal_dag.run(sample_ctx).verdict.name == "SAFE"
+    node_cache.backing.raw_cache.clear()
+    assert cached_minimal_dag.run(sample_ctx).verdict.name == "SAFE"
+    assert AlwaysTrueCacheable.run_count == 1
+
+
 def test_dag_uses_per_node_disk_cache(tmp_path, sample_ctx):
     """Each cacheable node must use cache_path / node.name, not a shared store."""
     gate_a = AlwaysTrueCacheable(
@@ -95,14 +106,17 @@ def test_dag_uses_per_node_disk_cache(tmp_path, sample_ctx):
     )
     dag = Composer("per_node_cache", verdict_type=Safety, cache_path=tmp_path).add_node(gate_a).add_node(gate_b)
 
-    assert dag._node_caches["gate_a"].cache_path == tmp_path / "gate_a"
-    assert dag._node_caches["gate_b"].cache_path == tmp_path / "gate_b"
+    assert dag._node_caches["gate_a"].backing.cache_path == tmp_path / "gate_a"
+    assert dag._node_caches["gate_b"].backing.cache_path == tmp_path / "gate_b"
 
     AlwaysTrueCacheable.run_count = 0
     dag.run(sample_ctx)
     assert AlwaysTrueCacheable.run_count == 2
 
-    dag._node_caches["gate_b"].raw_cache.clear()
+    # a fresh memory tier over the cleared disk cache
+    gate_b_disk_cache = dag._node_caches["gate_b"].backing
+    gate_b_disk_cache.raw_cache.clear()
+    dag._node_caches["gate_b"] = TieredCache(gate_b_disk_cache)
     gate_a.run = lambda ctx: (_ for _ in ()).throw(ValueError("gate_a cache miss"))
 
     AlwaysTrueCacheable.run_count = 0
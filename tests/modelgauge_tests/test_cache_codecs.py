@@ -0,0 +1,59 @@
+import pytest
+from pydantic import BaseModel
+
+from modelgauge.cache_codecs import (
+    CODECS,
+    COMPRESS_ABOVE,
+    HEADER_SIZE,
+    PickleCodec,
+    TypedJsonCodec,
+    decode_value,
+    encode_value,
+    is_encoded,
+)
+
+
+class Response(BaseModel):
+    text: str
+    logprobs: list[float] = []
+
+
+@pytest.mark.parametrize("codec", CODECS.values(), ids=list(CODECS))
+def test_round_trip(codec):
+    response = Response(text="hello", logprobs=[-0.5, -1.25])
+    encoded = encode_value(response, codec)
+    assert is_encoded(encoded)
+    assert decode_value(encoded) == response
+
+
+@pytest.mark.parametrize("codec", CODECS.values(), ids=list(CODECS))
+def test_large_values_are_compressed(codec):
+    response = Response(text="hello " * 1000, logprobs=[-0.5] * 1000)
+    encoded = encode_value(response, codec)
+    assert len(encoded) < len(codec.encode(response))
+    assert decode_value(encoded) == response
+
+
+def test_small_values_are_not_compressed():
+    encoded = encode_value(Response(text="hi"), PickleCodec())
+    assert encoded[HEADER_SIZE:] == PickleCodec().encode(Response(text="hi"))
+    assert len(encoded) <= COMPRESS_ABOVE + HEADER_SIZE
+
+
+def test_json_codec_only_encodes_typeables():
+    assert TypedJsonCodec().can_encode(Response(text="hi"))
+    assert TypedJsonCodec().can_encode({"a": 1})
+    assert not TypedJsonCodec().can_encode("a string")
+    assert PickleCodec().can_encode("a string")
+
+
+@pytest.mark.parametrize("value", [1, "text", b"some bytes", Response(text="hi")])
+def test_values_from_before_codecs_pass_through(value):
+    assert decode_value(value) == value
+
+
+def test_rejects_unknown_format_version():
+    encoded = bytearray(encode_value("hi", PickleCodec()))
+    encoded[HEADER_SIZE - 3] = 99
+    with pytest.raises(ValueError, match="format version 99"):
+        decode_value(bytes(encoded))
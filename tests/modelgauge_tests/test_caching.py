@@ -1,10 +1,13 @@
 import os
+import shutil
+from unittest.mock import MagicMock
 
 import pytest
 from pydantic import BaseModel
 from sqlitedict import SqliteDict  # type: ignore
 
-from modelgauge.caching import SqlDictCache
+from modelgauge.cache_codecs import PickleCodec, is_encoded
+from modelgauge.caching import SqlDictCache, convert_sql_dict_cache
 from modelgauge_tests.utilities import parent_directory
 
 
@@ -158,14 +161,15 @@ def test_fails_on_unexpected_table(tmpdir):
     SqliteDict(cache_location, tablename="some_table")
     with pytest.raises(AssertionError) as err_info:
         SqlDictCache(tmpdir, "sample")
-    assert "Expected only table to be v1, but found ['some_table', 'v1']" in str(err_info.value)
+    assert "Expected only table to be v2, but found ['some_table', 'v2']" in str(err_info.value)
     assert "sample_cache.sqlite" in str(err_info.value)
 
 
 def test_format_stability(parent_directory):
     """Reads from existing sample_cache.sqlite and checks deserialization."""
     cache_dir = str(parent_directory.joinpath("data"))
-    with SqlDictCache(cache_dir, "sample") as cache:
+    # Keep the checked-in file's journal mode, so reading it doesn't change it.
+    with SqlDictCache(cache_dir, "sample", journal_mode="DELETE") as cache:
         assert len(cache.cached_responses) == 2
         response_1 = cache.get_cached_response(SimpleClass(value="request 1"))
         assert isinstance(response_1, ParentClass)
@@ -225,12 +229,79 @@ def test_unencodable_response(tmpdir):
         assert mock_evaluate.counter == 2
 
 
+def test_writes_are_committed_in_batches(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name", commit_every=3, commit_interval=60) as cache:
+        cache.cached_responses.commit = MagicMock(wraps=cache.cached_responses.commit)
+        for i in range(5):
+            cache.update_cache(SimpleClass(value=f"request {i}"), SimpleClass(value=f"response {i}"))
+        assert cache.cached_responses.commit.call_count == 1
+        # Pending writes are still visible to this cache.
+        assert cache.get_cached_response(SimpleClass(value="request 4")) == SimpleClass(value="response 4")
+
+    # Exiting commits the rest.
+    with SqlDictCache(tmpdir, "sut_name") as cache:
+        assert len(cache.cached_responses) == 5
+
+
+def test_writes_are_committed_after_interval(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name", commit_every=1000, commit_interval=0) as cache:
+        cache.cached_responses.commit = MagicMock(wraps=cache.cached_responses.commit)
+        cache.update_cache(SimpleClass(value="request"), SimpleClass(value="response"))
+        assert cache.cached_responses.commit.call_count == 1
+
+
+def test_uses_write_ahead_log(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name") as cache:
+        assert cache.cached_responses.conn.select_one("PRAGMA journal_mode")[0].lower() == "wal"
+
+
+def test_stores_encoded_bytes(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name") as cache:
+        cache.update_cache(SimpleClass(value="request"), SimpleClass(value="response"))
+        (stored,) = cache.cached_responses.values()
+        assert is_encoded(stored)
+
+
+def test_pickle_codec_caches_anything(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name", codec=PickleCodec()) as cache:
+        cache.update_cache(SimpleClass(value="request"), "a plain string")
+        assert cache.get_cached_response(SimpleClass(value="request")) == "a plain string"
+
+
+def test_legacy_file_is_still_written_in_legacy_format(parent_directory, tmpdir):
+    shutil.copy(parent_directory.joinpath("data", "sample_cache.sqlite"), tmpdir)
+    with SqlDictCache(tmpdir, "sample") as cache:
+        assert cache.legacy
+        cache.update_cache(SimpleClass(value="request 3"), SimpleClass(value="response 3"))
+    with SqlDictCache(tmpdir, "sample") as cache:
+        assert cache.get_cached_response(SimpleClass(value="request 3")) == SimpleClass(value="response 3")
+
+
+def test_convert_legacy_file(parent_directory, tmpdir):
+    shutil.copy(parent_directory.joinpath("data", "sample_cache.sqlite"), tmpdir)
+    assert convert_sql_dict_cache(os.path.join(tmpdir, "sample_cache.sqlite")) == 2
+    with SqlDictCache(tmpdir, "sample") as cache:
+        assert not cache.legacy
+        response_2 = cache.get_cached_response(SimpleClass(value="request 2"))
+        assert response_2 == ChildClass1(parent_value="response 2", child_value="child val")
+
+
+def test_convert_to_another_codec(tmpdir):
+    with SqlDictCache(tmpdir, "sut_name") as cache:
+        cache.update_cache(SimpleClass(value="request"), SimpleClass(value="response"))
+    assert convert_sql_dict_cache(os.path.join(tmpdir, "sut_name_cache.sqlite"), PickleCodec()) == 1
+    with SqlDictCache(tmpdir, "sut_name") as cache:
+        (stored,) = cache.cached_responses.values()
+        assert stored[len(b"MGC") + 1] == PickleCodec.codec_id
+        assert cache.get_cached_response(SimpleClass(value="request")) == SimpleClass(value="response")
+
+
 def rewrite_sample_cache():
     import pathlib
 
     cache_dir = pathlib.Path(__file__).parent / "data"
     (cache_dir / "sample_cache.sqlite").unlink(missing_ok=True)
-    with SqlDictCache(cache_dir, "sample") as cache:
+    with SqlDictCache(cache_dir, "sample", journal_mode="DELETE") as cache:
         cache.update_cache(SimpleClass(value="request 1"), ParentClass(parent_value="response 1"))
         cache.update_cache(
             SimpleClass(value="request 2"),
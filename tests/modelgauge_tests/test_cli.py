@@ -7,8 +7,10 @@ from unittest.mock import patch
 import pytest
 from click.testing import CliRunner, Result
 
+from modelbench.cache import DiskCache
 from modelgauge import cli
 from modelgauge.annotator_registry import ANNOTATORS
+from modelgauge.caching import SqlDictCache
 from modelgauge.command_line import validate_uid
 from modelgauge.config import MissingSecretsFromConfig
 from modelgauge.data_schema import PromptResponseSchema, PromptSchema
@@ -23,7 +25,7 @@ from modelgauge.test_registry import TESTS
 from tests.modelgauge_tests.fake_annotator import FakeSafetyAnnotator
 from tests.modelgauge_tests.fake_params import FakeParams
 from tests.modelgauge_tests.fake_secrets import FakeRequiredSecret
-from tests.modelgauge_tests.fake_sut import FakeSUT
+from tests.modelgauge_tests.fake_sut import FakeSUT, FakeSUTRequest, FakeSUTResponse
 from tests.modelgauge_tests.fake_test import FakeTest
 
 
@@ -308,6 +310,38 @@ def test_run_job_annotators_only_output_name(caplog, tmp_path, prompt_responses_
     assert metadata_path.exists()
 
 
+def test_run_job_local_workers_get_cache_dir_and_debug(tmp_path, prompts_file):
+    cache_dir = tmp_path / "cache"
+    with (
+        patch("modelgauge.cli.subprocess.Popen") as popen,
+        patch("modelgauge.pipeline_runner.PipelineRunner.collect_work") as collect_work,
+    ):
+        result = CliRunner().invoke(
+            cli.cli,
+            [
+                "run-job",
+                "--sut",
+                "demo_yes_no",
+                "--output-dir",
+                tmp_path,
+                "--work-queue",
+                tmp_path / "queue.sqlite",
+                "--local-workers",
+                "2",
+                "--cache-dir",
+                cache_dir,
+                "--debug",
+                str(prompts_file),
+            ],
+            catch_exceptions=False,
+        )
+    assert result.exit_code == 0
+    worker_command = popen.call_args.args[0]
+    assert worker_command[worker_command.index("--cache-dir") + 1] == str(cache_dir)
+    assert "--debug" in worker_command
+    assert collect_work.call_args.kwargs["workers"] == [popen.return_value] * 2
+
+
 def test_run_ensemble(isolated_annotators, caplog, tmp_path, prompt_responses_file):
     caplog.set_level(logging.INFO)
 
@@ -498,3 +532,16 @@ def test_run_sut_handles_all_sut_uids(patched, sut_def_file):
         catch_exceptions=False,
     )
     assert True
+
+
+def test_cache_convert(tmp_path):
+    with SqlDictCache(tmp_path / "suts", "fake-sut") as cache:
+        cache.update_cache(FakeSUTRequest(text="hi"), FakeSUTResponse(text="hello"))
+    DiskCache(tmp_path / "sut_cache")["key"] = "value"
+
+    result = run_cli("cache", "convert", "--codec", "pickle", str(tmp_path))
+
+    assert result.exit_code == 0
+    assert "Converted 1 entries in" in result.output
+    assert str(tmp_path / "suts" / "fake-sut_cache.sqlite") in result.output
+    assert str(tmp_path / "sut_cache") in result.output
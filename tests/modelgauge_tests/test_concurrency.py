@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from modelgauge.concurrency import AdaptiveConcurrency, AIMDLimit
+
+
+def test_aimd_limit_starts_at_max():
+    assert AIMDLimit(8).limit == 8
+
+
+def test_aimd_limit_rejects_bad_bounds():
+    with pytest.raises(ValueError):
+        AIMDLimit(2, min_limit=3)
+    with pytest.raises(ValueError):
+        AIMDLimit(2, decrease_factor=1.5)
+
+
+def test_aimd_limit_halves_on_failure():
+    limit = AIMDLimit(8)
+    token = limit.acquire()
+    limit.release(token, latency=0.1, failed=True)
+    assert limit.limit == 4
+
+
+def test_aimd_limit_cuts_once_per_round():
+    limit = AIMDLimit(8)
+    tokens = [limit.acquire() for _ in range(4)]
+    for token in tokens:
+        limit.release(token, latency=0.1, failed=True)
+    assert limit.limit == 4
+
+
+def test_aimd_limit_never_drops_below_min():
+    limit = AIMDLimit(8, min_limit=2)
+    for _ in range(10):
+        limit.release(limit.acquire(), latency=0.1, failed=True)
+    assert limit.limit == 2
+
+
+def test_aimd_limit_grows_additively_up_to_max():
+    limit = AIMDLimit(8, initial_limit=2)
+    for _ in range(5):
+        limit.release(limit.acquire(), latency=0.1, failed=False)
+    assert 3 <= limit.limit < 8
+    for _ in range(100):
+        limit.release(limit.acquire(), latency=0.1, failed=False)
+    assert limit.limit == 8
+
+
+def test_aimd_limit_shrinks_on_latency_spike():
+    limit = AIMDLimit(8, latency_smoothing=1.0)
+    limit.release(limit.acquire(), latency=0.1, failed=False)
+    limit.release(limit.acquire(), latency=1.0, failed=False)
+    assert limit.limit == 4
+
+
+def test_aimd_limit_ignores_latency_when_disabled():
+    limit = AIMDLimit(8, latency_tolerance=None, latency_smoothing=1.0)
+    limit.release(limit.acquire(), latency=0.1, failed=False)
+    limit.release(limit.acquire(), latency=1.0, failed=False)
+    assert limit.limit == 8
+
+
+def test_aimd_limit_blocks_at_limit():
+    limit = AIMDLimit(1)
+    token = limit.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limit.release(limit.acquire(), latency=0.1, failed=False)
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limit.release(token, latency=0.1, failed=False)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_adaptive_concurrency_keeps_separate_limits():
+    concurrency = AdaptiveConcurrency("stage", max_limit=4)
+    with pytest.raises(RuntimeError):
+        with concurrency.slot("slow"):
+            raise RuntimeError("429")
+    with concurrency.slot("fast"):
+        pass
+    assert concurrency.limits() == {"slow": 2, "fast": 4}
+    assert concurrency.limit_for("slow").in_flight == 0
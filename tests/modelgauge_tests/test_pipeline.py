@@ -1,4 +1,11 @@
-from modelgauge.pipeline import Pipeline, Source, Pipe, Sink
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from modelgauge.pipeline import QUEUE_SIZE_PER_CONSUMER, AsyncPipeline, Pipeline, ProcessPipe, Source, Pipe, Sink
 
 
 class MySource(Source):
@@ -33,6 +40,42 @@ class MyExpandingPipe(Pipe):
         self.downstream_put(item * 3)
 
 
+def test_pipeline_stage_summary():
+    class RepeatedPipe(MyPipe):
+        pass
+
+    p = Pipeline(MySource(), MyPipe(), RepeatedPipe(), MySink())
+    p.run()
+    summary = p.stage_summary()
+    assert list(summary) == ["MySource", "MyPipe", "RepeatedPipe", "MySink"]
+    for stage in summary.values():
+        assert stage["items"] == 3
+        assert stage["failed"] == 0
+    assert summary["MyPipe"]["workers"] == 1
+
+
+def test_pipeline_progress_events():
+    events = []
+    p = Pipeline(MySource(), MyPipe(), MySink(), progress_callback=events.append, total_items=3)
+    p.run()
+    assert events[0]["completed"] == 0
+    assert events[-1]["completed"] == 3
+    assert events[-1]["total"] == 3
+    assert set(events[-1]["stages"]) == {"MySource", "MyPipe", "MySink"}
+    assert events[-1]["stages"]["MyPipe"] == {"completed": 3, "in_flight": 0, "failed": 0, "queued": 0}
+
+
+def test_pipeline_stage_summary_counts_failures():
+    class ExplodingPipe(Pipe):
+        def handle_item(self, item):
+            raise ValueError("this should get caught")
+
+    for engine in (Pipeline, AsyncPipeline):
+        p = engine(MySource(), ExplodingPipe(), MySink())
+        p.run()
+        assert p.stage_summary()["ExplodingPipe"]["failed"] == 3
+
+
 def test_pipeline_with_stage_that_adds_elements():
     p = Pipeline(
         MySource(),
@@ -69,4 +112,250 @@ def test_pipe_exception_handling():
     assert p.sink.results == [2, 6]
 
 
+def test_pipeline_finishes_without_polling():
+    p = Pipeline(MySource(), MyPipe(), MySink())
+    start = time.monotonic()
+    p.run()
+    assert time.monotonic() - start < 0.5
+    assert p.sink.results == [2, 4, 6]
+
+
+def test_multithreaded_pipe_drains_all_end_markers():
+    class ThreadedPipe(MyPipe):
+        def __init__(self):
+            super().__init__(thread_count=4)
+
+    p = Pipeline(MySource(), ThreadedPipe(), MyExpandingPipe(), MySink())
+    p.run()
+    assert sorted(p.sink.results) == [4, 6, 8, 12, 12, 18]
+    for segment in p._segments:
+        assert segment._queue.unfinished_tasks == 0
+
+
+def test_async_pipeline_with_sync_segments():
+    p = AsyncPipeline(MySource(), MyPipe(), MySink(), debug=True)
+    p.run()
+    assert p.sink.results == [2, 4, 6]
+
+
+def test_async_pipeline_with_stage_that_adds_elements():
+    p = AsyncPipeline(MySource(), MyExpandingPipe(), MySink())
+    p.run()
+    assert p.sink.results == [2, 3, 4, 6, 6, 9]
+
+
+class MyAsyncPipe(Pipe):
+    def __init__(self, thread_count=1):
+        super().__init__(thread_count=thread_count)
+
+    async def handle_item(self, item):
+        await asyncio.sleep(0.1)
+        self.downstream_put(item)
+        return item * 10
+
+
+def test_async_pipeline_with_coroutine_handler():
+    p = AsyncPipeline(MySource(), MyAsyncPipe(), MySink())
+    p.run()
+    assert p.sink.results == [1, 10, 2, 20, 3, 30]
+
+
+def test_async_pipeline_runs_many_coroutines_concurrently():
+    class ManySource(Source):
+        def new_item_iterable(self):
+            return range(1, 2001)
+
+    p = AsyncPipeline(ManySource(), MyAsyncPipe(thread_count=2000), MySink())
+    start = time.monotonic()
+    p.run()
+    assert time.monotonic() - start < 5
+    assert len(p.sink.results) == 4000
+
+
+def test_async_pipeline_with_async_source_and_sink():
+    class MyAsyncSource(Source):
+        async def new_item_iterable(self):
+            for i in [1, 2, 3]:
+                yield i
+
+    class MyAsyncSink(MySink):
+        async def handle_item(self, item):
+            self.results.append(item)
+
+    p = AsyncPipeline(MyAsyncSource(), MyPipe(), MyAsyncSink())
+    p.run()
+    assert p.sink.results == [2, 4, 6]
+
+
+def test_async_pipeline_exception_handling():
+    class ExplodingPipe(Pipe):
+        async def handle_item(self, item):
+            if item % 2 == 1:
+                return item * 2
+            raise ValueError("this should get caught")
+
+    p = AsyncPipeline(MySource(), ExplodingPipe(), MySink())
+    p.run()
+    assert p.sink.results == [2, 6]
+
+
+def test_queues_are_sized_from_downstream_consumers():
+    class ThreadedPipe(MyPipe):
+        def __init__(self):
+            super().__init__(thread_count=5)
+
+    source, pipe, sink = MySource(), ThreadedPipe(), MySink()
+    Pipeline(source, pipe, sink)
+    assert source._queue.maxsize == 5 * QUEUE_SIZE_PER_CONSUMER
+    assert pipe._queue.maxsize == QUEUE_SIZE_PER_CONSUMER
+
+
+def test_source_does_not_run_ahead_of_slow_consumers():
+    produced = 0
+
+    class CountingSource(Source):
+        def new_item_iterable(self):
+            nonlocal produced
+            for i in range(1, 201):
+                produced += 1
+                yield i
+
+    class SlowSink(MySink):
+        def __init__(self):
+            super().__init__()
+            self.max_lead = 0
+
+        def handle_item(self, item):
+            time.sleep(0.001)
+            super().handle_item(item)
+            self.max_lead = max(self.max_lead, produced - len(self.results))
+
+    p = Pipeline(CountingSource(), MyPipe(), SlowSink())
+    p.run()
+    assert len(p.sink.results) == 200
+    # Each of the two queues holds at most QUEUE_SIZE_PER_CONSUMER items, plus one item in hand per stage.
+    assert p.sink.max_lead <= 2 * QUEUE_SIZE_PER_CONSUMER + 3
+
+
+class MyLanePipe(Pipe):
+    def __init__(self):
+        super().__init__(thread_count=2, lanes=["odd", "even"])
+        self.lanes_seen = []
+
+    def lane_for(self, item):
+        if item == 3:
+            raise ValueError("this should get caught")
+        return "odd" if item % 2 else "even"
+
+    def handle_item(self, item):
+        self.lanes_seen.append(threading.current_thread().name)
+        return item * 2
+
+
+def test_pipe_with_lanes():
+    pipe = MyLanePipe()
+    p = Pipeline(MySource(), pipe, MySink())
+    p.run()
+    assert sorted(p.sink.results) == [2, 4]
+    assert pipe.consumer_count == 1
+    assert pipe.worker_count == 4
+    assert all("lane" in name for name in pipe.lanes_seen)
+
+
+def test_pipe_with_lanes_must_implement_lane_for():
+    class NoLaneForPipe(Pipe):
+        def handle_item(self, item):
+            return item
+
+    with pytest.raises(ValueError, match="lane_for"):
+        NoLaneForPipe(lanes=["a", "b"])
+
+
+def test_pipe_with_lanes_in_async_pipeline():
+    p = AsyncPipeline(MySource(), MyLanePipe(), MySink())
+    p.run()
+    assert sorted(p.sink.results) == [2, 4]
+
+
+class StalledLanePipe(Pipe):
+    def __init__(self):
+        super().__init__(thread_count=2, lanes=["stalled", "other"])
+        self.unstall = threading.Event()
+
+    def lane_for(self, item):
+        return "stalled"
+
+    def handle_item(self, item):
+        self.unstall.wait()
+        return item
+
+
+class TallyingSource(Source):
+    def __init__(self, count):
+        super().__init__()
+        self.count = count
+        self.produced = 0
+
+    def new_item_iterable(self):
+        for i in range(1, self.count + 1):
+            self.produced += 1
+            yield i
+
+
+@pytest.mark.parametrize("pipeline_class", [Pipeline, AsyncPipeline])
+def test_stalled_lane_holds_a_bounded_number_of_items(pipeline_class):
+    source = TallyingSource(200)
+    pipe = StalledLanePipe()
+    p = pipeline_class(source, pipe, MySink())
+    runner = threading.Thread(target=p.run)
+    runner.start()
+
+    def settled_count():
+        before = -1
+        while source.produced != before:
+            before = source.produced
+            deadline = time.time() + 0.2
+            while time.time() < deadline:
+                time.sleep(0.01)
+        return before
+
+    try:
+        # the lane's queue, its workers' items in hand, the upstream queue, and one item each in the dispatcher
+        # and the source
+        bound = pipe.lane_queue_size + pipe.thread_count + QUEUE_SIZE_PER_CONSUMER + 2
+        assert settled_count() <= bound
+    finally:
+        pipe.unstall.set()
+        runner.join(timeout=30)
+    assert len(p.sink.results) == 200
+
+
+class MyProcessPipe(ProcessPipe):
+    def __init__(self):
+        super().__init__(process_count=2)
+
+    @staticmethod
+    def process_item(item):
+        if item == 2:
+            raise ValueError("this should get caught")
+        return item * 2, os.getpid()
+
+    def from_worker(self, result, item):
+        doubled, pid = result
+        assert pid != os.getpid()
+        return doubled
+
+
+def test_process_pipe():
+    p = Pipeline(MySource(), MyProcessPipe(), MySink())
+    p.run()
+    assert sorted(p.sink.results) == [2, 6]
+
+
+def test_process_pipe_in_async_pipeline():
+    p = AsyncPipeline(MySource(), MyProcessPipe(), MySink())
+    p.run()
+    assert sorted(p.sink.results) == [2, 6]
+
+
 # more rich tests are in test_prompt_pipeline
@@ -1,5 +1,8 @@
 import csv
 import re
+import subprocess
+import sys
+import threading
 
 import pytest
 
@@ -11,9 +14,17 @@ from modelgauge.data_schema import PromptResponseSchema, PromptSchema
 from modelgauge.dataset import AnnotationDataset, PromptDataset, PromptResponseDataset
 from modelgauge.ensemble_annotator import EnsembleAnnotator
 from modelgauge.model_options import ModelOptions
-from modelgauge.pipeline_runner import AnnotatorRunner, PromptPlusAnnotatorRunner, PromptRunner, build_runner
+from modelgauge.pipeline_runner import (
+    AnnotatorRunner,
+    PromptPlusAnnotatorRunner,
+    PromptRunner,
+    QueuedJobWorker,
+    SUT_STAGE,
+    build_runner,
+)
 from modelgauge.prompt_pipeline import PromptSink, PromptSource, PromptSutAssigner, PromptSutWorkers
 from modelgauge.sut_capabilities_verification import MissingMultipleSUTsCapabilities
+from modelgauge.work_queue import WorkQueue
 
 NUM_PROMPTS = 3  # Number of prompts in the prompts file
 
@@ -262,6 +273,7 @@ class TestPromptRunner:
         assert_common_metadata_is_correct(metadata, runner_basic)
         assert metadata["input"] == {"source": prompts_file.name, "num_items": NUM_PROMPTS}
         assert_basic_sut_metadata(metadata)
+        assert metadata["pipeline"]["PromptSutWorkers"]["items"] == 2 * NUM_PROMPTS
 
 
 class TestPromptPlusAnnotatorRunner:
@@ -440,6 +452,58 @@ class TestPromptPlusAnnotatorRunner:
             },
         }
 
+    def test_run_with_work_queue(self, tmp_path, runner_basic, suts, annotators):
+        work_queue = WorkQueue(tmp_path / "queue.sqlite")
+        runner_basic.enqueue_work(work_queue)
+        workers = [
+            QueuedJobWorker(
+                WorkQueue(work_queue.path), suts=suts, annotators=annotators, num_workers=4, poll_interval=0.01
+            )
+            for _ in range(3)
+        ]
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.start()
+        runner_basic.collect_work(work_queue, progress_callback=lambda _: _, poll_interval=0.01)
+        for thread in threads:
+            thread.join()
+
+        with open(runner_basic.output_dir() / runner_basic.output_file_name) as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == NUM_PROMPTS * len(suts) * len(annotators)
+        metadata = runner_basic.metadata()
+        assert_basic_sut_metadata(metadata)
+        assert metadata["annotations"]["count"] == NUM_PROMPTS * len(suts) * len(annotators)
+
+    def test_collect_work_reports_failures_in_every_stage(self, tmp_path, caplog, runner_basic, suts, annotators):
+        work_queue = WorkQueue(tmp_path / "queue.sqlite")
+        runner_basic.enqueue_work(work_queue)
+        [(unit_id, _)] = work_queue.claim(SUT_STAGE, "failing worker")
+        work_queue.fail(unit_id, "failing worker", "SUT call failed")
+        worker = QueuedJobWorker(
+            WorkQueue(work_queue.path), suts=suts, annotators=annotators, num_workers=4, poll_interval=0.01
+        )
+        worker.run()
+        runner_basic.collect_work(work_queue, progress_callback=lambda _: _, poll_interval=0.01)
+
+        assert "1 sut work units failed" in caplog.text
+
+    def test_collect_work_fails_when_every_worker_exits(self, tmp_path, runner_basic):
+        work_queue = WorkQueue(tmp_path / "queue.sqlite")
+        runner_basic.enqueue_work(work_queue)
+        dead_worker = subprocess.Popen([sys.executable, "-c", "raise SystemExit(1)"])
+        dead_worker.wait()
+        with pytest.raises(RuntimeError, match=r"exit codes \[1\]"):
+            runner_basic.collect_work(
+                work_queue, progress_callback=lambda _: _, poll_interval=0.01, workers=[dead_worker]
+            )
+
+    def test_work_queue_worker_must_match_job(self, tmp_path, runner_basic, suts):
+        work_queue = WorkQueue(tmp_path / "queue.sqlite")
+        runner_basic.enqueue_work(work_queue)
+        with pytest.raises(ValueError, match="annotators"):
+            QueuedJobWorker(work_queue, suts=suts, annotators={})
+
 
 class TestAnnotatorRunner:
     NUM_SUTS = 2  # Number of SUTs included in the input prompts_response_file
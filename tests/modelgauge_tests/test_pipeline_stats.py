@@ -0,0 +1,93 @@
+from queue import Queue
+
+import pytest
+
+from modelgauge.pipeline_stats import ProgressMonitor, StageStats, ThroughputWindow, TimedQueue, describe_progress
+
+
+class MyTimedQueue(TimedQueue, Queue):
+    pass
+
+
+def test_timed_queue_reports_wait(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("modelgauge.pipeline_stats.time.monotonic", lambda: now[0])
+    q = MyTimedQueue()
+    q.put("a")
+    now[0] = 101.5
+    q.put("b")
+    now[0] = 103.0
+    assert q.get() == "a"
+    assert q.last_wait() == 3.0
+    assert q.get() == "b"
+    assert q.last_wait() == 1.5
+
+
+def test_stage_stats_summary(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("modelgauge.pipeline_stats.time.monotonic", lambda: now[0])
+    stats = StageStats("stage", worker_count=2)
+
+    stats.record_take(wait=1.0, depth=4)
+    with stats.handling():
+        now[0] = 2.0
+    stats.record_take(wait=3.0, depth=0)
+    with pytest.raises(ValueError):
+        with stats.handling():
+            now[0] = 4.0
+            raise ValueError()
+
+    summary = stats.summary()
+    assert summary["items"] == 1
+    assert summary["failed"] == 1
+    assert summary["peak_active_workers"] == 1
+    assert summary["service_seconds"] == {"mean": 2.0, "max": 2.0, "total": 4.0}
+    assert summary["queue_wait_seconds"] == {"mean": 2.0, "max": 3.0}
+    assert summary["queue_depth"] == {"mean": 2.0, "max": 4}
+    assert summary["elapsed_seconds"] == 4.0
+    assert summary["items_per_second"] == 0.25
+    assert summary["utilization"] == 0.5
+    assert stats.active == 0
+
+
+def test_empty_stage_summary():
+    summary = StageStats("stage").summary()
+    assert summary["items"] == 0
+    assert summary["items_per_second"] == 0.0
+    assert summary["utilization"] == 0.0
+
+
+def test_throughput_window_uses_recent_samples():
+    now = [0.0]
+    window = ThroughputWindow(window_seconds=10, clock=lambda: now[0])
+    window.add(0)
+    assert window.rate() is None
+    for t, completed in [(5, 50), (10, 100), (15, 110), (20, 120)]:
+        now[0] = t
+        window.add(completed)
+    # The fast start has dropped out of the window.
+    assert window.rate() == pytest.approx(20 / 10)
+
+
+def test_progress_event():
+    now = [0.0]
+    monitor = ProgressMonitor(window_seconds=60, clock=lambda: now[0])
+    workers = StageStats("Workers")
+    workers.record_cache(hit=True)
+    workers.record_cache(hit=False)
+    with pytest.raises(ValueError):
+        with workers.handling():
+            raise ValueError()
+
+    assert monitor.event(0, {"Workers": (workers, 3)}, total=100)["eta_seconds"] is None
+    now[0] = 10.0
+    event = monitor.event(20, {"Workers": (workers, 3)}, total=100)
+
+    assert event["completed"] == 20
+    assert event["total"] == 100
+    assert event["failed"] == 1
+    assert event["items_per_second"] == 2.0
+    assert event["eta_seconds"] == 40.0
+    assert event["cache_hit_rate"] == 0.5
+    assert event["stages"] == {"Workers": {"completed": 0, "in_flight": 0, "failed": 1, "queued": 3}}
+    assert describe_progress(event) == "2.0 items/s, ETA 0:00:40, cache 50%, 1 failed"
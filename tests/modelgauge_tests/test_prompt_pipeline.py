@@ -1,5 +1,6 @@
 import itertools
 import signal
+import threading
 import time
 from csv import DictReader
 from typing import List
@@ -9,7 +10,7 @@ import pytest
 
 from modelgauge.dataset import PromptDataset, PromptResponseDataset
 from modelgauge.data_schema import PromptResponseSchema, PromptSchema, SchemaValidationError
-from modelgauge.pipeline import Pipeline, PipelineSegment
+from modelgauge.pipeline import Pipeline
 from modelgauge.prompt import TextPrompt
 from modelgauge.prompt_pipeline import (
     PromptSink,
@@ -178,6 +179,19 @@ def test_prompt_sut_worker_retries_until_success(suts):
     assert mock.call_count == num_exceptions + 1
 
 
+def test_prompt_sut_worker_adaptive_concurrency_backs_off_per_sut(suts):
+    mock = MagicMock()
+    mock.side_effect = [Exception(), FakeSUTResponse(text="a response")]
+    suts["fake1"].evaluate = mock
+    prompt_with_context = TestItem(source_id="1", prompt=TextPrompt(text="a prompt"))
+
+    w = PromptSutWorkers(suts, workers=8, adaptive_concurrency=True)
+    w.sleep_time = 0.01
+    w.handle_item((prompt_with_context, "fake1"))
+    w.handle_item((prompt_with_context, "fake2"))
+    assert w.concurrency.limits() == {"fake1": 4, "fake2": 8}
+
+
 def test_full_run(suts, tmp_path):
     input = FakePromptInput(
         [
@@ -203,10 +217,41 @@ def test_full_run(suts, tmp_path):
     assert set(row.prompt.source_id for row in output.output) == {"1", "2"}
 
 
+def test_slow_sut_does_not_hold_up_fast_sut(tmp_path):
+    fast_done = threading.Event()
+
+    class BlockedSUT(FakeSUT):
+        def evaluate(self, request: FakeSUTRequest) -> FakeSUTResponse:
+            # Real waiting: time.sleep is sped up in tests.
+            fast_done.wait(timeout=5)
+            return super().evaluate(request)
+
+    class FastSUTWatchingOutput(FakePromptOutput):
+        def write(self, item):
+            super().write(item)
+            if sum(1 for row in self.output if row.sut_uid == "fast") == prompt_count:
+                fast_done.set()
+
+    prompt_count = 5
+    suts = {"slow": BlockedSUT("slow"), "fast": FakeSUT("fast")}
+    input = FakePromptInput(
+        [{PROMPT_SCHEMA.prompt_uid: str(i), PROMPT_SCHEMA.prompt_text: "text" + str(i)} for i in range(prompt_count)]
+    )
+    output = FastSUTWatchingOutput(tmp_path / "output.csv")
+
+    p = Pipeline(
+        PromptSource(input),
+        PromptSutAssigner(suts),
+        PromptSutWorkers(suts, workers=1),
+        PromptSink(output),
+    )
+    p.run()
+
+    assert [row.sut_uid for row in output.output] == ["fast"] * prompt_count + ["slow"] * prompt_count
+
+
 @pytest.mark.parametrize("worker_count", [1, 2, 4, 8])
 def test_concurrency_with_delays(suts, worker_count, tmp_path):
-    PipelineSegment.default_timeout = 0.001  # burn some CPU to make the tests run faster
-
     prompt_count = worker_count * 4
     prompt_delays = [0, 0.01, 0.02]
     sut_delays = [0, 0.01, 0.02, 0.03]
@@ -0,0 +1,83 @@
+import pytest
+
+from modelgauge.rate_limits import RateLimiter, RateLimitRegistry, RateLimitSpec, TokenBucket, estimate_tokens
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_spec():
+    spec = RateLimitSpec.parse("rpm=600, tpm=100000 burst=2")
+    assert spec == RateLimitSpec(requests_per_minute=600, tokens_per_minute=100000, burst_seconds=2)
+
+
+@pytest.mark.parametrize("text", ["rpm", "rps=3", "rpm=fast"])
+def test_parse_bad_spec(text):
+    with pytest.raises(ValueError):
+        RateLimitSpec.parse(text)
+
+
+def test_token_bucket_spaces_out_callers():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_per_second=2, capacity=1, clock=clock)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0.5
+    assert bucket.reserve() == 1.0
+    clock.now = 10
+    assert bucket.reserve() == 0
+
+
+def test_token_bucket_allows_oversized_requests_when_full():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_per_second=10, capacity=10, clock=clock)
+    assert bucket.reserve(50) == 0
+    assert bucket.reserve(1) == pytest.approx(4.1)
+
+
+def test_rate_limiter_waits_for_slowest_bucket():
+    waits = []
+    limiter = RateLimiter("k", RateLimitSpec(requests_per_minute=60, tokens_per_minute=600), sleep=waits.append)
+    limiter.acquire(tokens=10)
+    limiter.acquire(tokens=10)
+    assert len(waits) == 1
+    assert waits[0] == pytest.approx(1.0, abs=0.01)
+
+
+def test_registry_matches_most_specific_key():
+    registry = RateLimitRegistry(
+        {
+            "google/gemma:nebius:hfrelay": RateLimitSpec(requests_per_minute=10),
+            "nebius": RateLimitSpec(requests_per_minute=20),
+            "hfrelay": RateLimitSpec(requests_per_minute=30),
+        }
+    )
+    assert registry.limiter_for("google/gemma:nebius:hfrelay;mt=500").key == "google/gemma:nebius:hfrelay"
+    assert registry.limiter_for("google/other:nebius:hfrelay").key == "nebius"
+    assert registry.limiter_for("meta/llama:hfrelay").key == "hfrelay"
+    assert registry.limiter_for("llama_guard_2") is None
+
+
+def test_registry_shares_limiter_between_uids():
+    registry = RateLimitRegistry({"together-serverless": RateLimitSpec(requests_per_minute=10)})
+    assert registry.limiter_for("a/b:together-serverless") is registry.limiter_for("c/d:together-serverless")
+
+
+def test_registry_from_secrets():
+    registry = RateLimitRegistry()
+    registry.configure_from_secrets({"demo": {"api_key": "12345"}, "rate_limits": {"demo_yes_no": "rpm=60"}})
+    assert registry.limiter_for("demo_yes_no").spec.requests_per_minute == 60
+
+
+def test_unlimited_uid_never_waits():
+    registry = RateLimitRegistry()
+    registry.acquire("anything", tokens=10**9)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens(None) == 0
+    assert estimate_tokens("a" * 40) == 11
@@ -0,0 +1,89 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from modelbench.benchmark_runner import TestRunAnnotationWorker, TestRunSutWorker
+from modelgauge.prompt import TextPrompt
+from modelgauge.prompt_pipeline import PromptSutWorkers
+from modelgauge.response_store import (
+    ResponseStoreCache,
+    annotator_response_key,
+    open_response_store,
+    sut_response_key,
+)
+from modelgauge.simple_test_runner import run_prompt_response_test
+from modelgauge.single_turn_prompt_response import TestItem
+from modelgauge_tests.fake_annotator import FakeSafetyAnnotator
+from modelgauge_tests.fake_sut import FakeSUT, FakeSUTRequest, FakeSUTResponse
+from modelgauge_tests.fake_test import FakeTest, fake_test_item
+
+
+def test_keys_match_benchmark_runner():
+    request = FakeSUTRequest(text="hello")
+    assert sut_response_key("a-sut", request) == TestRunSutWorker.make_cache_key(request, "a-sut")
+    assert annotator_response_key("an-annotator", request) == TestRunAnnotationWorker.make_cache_key(
+        request, "an-annotator"
+    )
+
+
+def test_keys_separate_uids():
+    request = FakeSUTRequest(text="hello")
+    assert sut_response_key("a-sut", request) != sut_response_key("another-sut", request)
+    assert sut_response_key("a-sut", request) != annotator_response_key("a-sut", request)
+
+
+def test_annotator_key_rejects_unknown_requests():
+    with pytest.raises(ValueError):
+        annotator_response_key("an-annotator", 3)
+
+
+def test_response_store_cache_round_trip(tmp_path):
+    cache = ResponseStoreCache(open_response_store(tmp_path), lambda request: sut_response_key("a-sut", request))
+    request = FakeSUTRequest(text="hello")
+    assert cache.get_cached_response(request) is None
+
+    cache.update_cache(request, FakeSUTResponse(text="hi"))
+    assert cache.get_cached_response(request) == FakeSUTResponse(text="hi")
+
+    callable = MagicMock()
+    assert cache.get_or_call(request, callable) == FakeSUTResponse(text="hi")
+    callable.assert_not_called()
+
+
+def test_run_test_responses_reused_across_data_dirs(tmp_path):
+    store = tmp_path / "store"
+
+    def run(data_dir):
+        sut = FakeSUT()
+        annotator = FakeSafetyAnnotator("some-annotator")
+        test = FakeTest(test_items=[fake_test_item("1")], annotators=["some-annotator"], measurement={})
+        run_prompt_response_test(test, sut, [annotator], str(data_dir), response_store=str(store))
+        return sut, annotator
+
+    sut_1, annotator_1 = run(tmp_path / "first")
+    assert sut_1.evaluate_calls == 1
+    assert annotator_1.annotate_calls == 1
+
+    sut_2, annotator_2 = run(tmp_path / "second")
+    assert sut_2.evaluate_calls == 0
+    assert annotator_2.annotate_calls == 0
+
+
+def test_run_job_reuses_run_test_responses(tmp_path):
+    store = tmp_path / "store"
+    run_prompt_response_test(
+        FakeTest(test_items=[fake_test_item("a prompt")], annotators=[], measurement={}),
+        FakeSUT("fake1"),
+        [],
+        str(tmp_path / "data"),
+        response_store=str(store),
+    )
+
+    sut = FakeSUT("fake1")
+    w = PromptSutWorkers({"fake1": sut}, response_store=open_response_store(store))
+    with patch("modelgauge.prompt_pipeline.RATE_LIMITS") as rate_limits:
+        result = w.handle_item((TestItem(source_id="1", prompt=TextPrompt(text="a prompt")), "fake1"))
+
+    assert result.response.text == "a prompt"
+    assert sut.evaluate_calls == 0
+    rate_limits.charge_tokens.assert_not_called()
@@ -0,0 +1,153 @@
+import multiprocessing
+import time
+
+from modelgauge.pipeline import Pipeline, Source
+from modelgauge.work_queue import (
+    CLAIMED,
+    DONE,
+    FAILED,
+    PENDING,
+    WorkQueue,
+    WorkQueuePipe,
+    WorkQueueResultSink,
+    WorkQueueResultSource,
+    WorkQueueSink,
+    WorkQueueSource,
+)
+from modelgauge_tests.test_pipeline import MyPipe, MySink
+
+
+def test_claim_and_complete(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    queue.enqueue("a", ["x", "y", "z"])
+    queue.seal("a")
+
+    claimed = queue.claim("a", "worker", limit=2)
+    assert [item for _, item in claimed] == ["x", "y"]
+    assert queue.counts("a") == {PENDING: 1, CLAIMED: 2, DONE: 0, FAILED: 0}
+
+    for unit_id, item in claimed:
+        queue.complete(unit_id, "worker", item.upper())
+    assert not queue.is_finished("a")
+    [(unit_id, _)] = queue.claim("a", "worker", limit=2)
+    queue.fail(unit_id, "worker", "boom")
+
+    assert queue.is_finished("a")
+    assert list(queue.results("a")) == ["X", "Y"]
+    assert queue.counts("a") == {PENDING: 0, CLAIMED: 0, DONE: 2, FAILED: 1}
+
+
+def test_unsealed_stage_is_not_finished(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    assert not queue.is_finished("a")
+    queue.seal("a")
+    assert queue.is_finished("a")
+
+
+def test_completing_a_unit_feeds_the_chained_stage(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    queue.chain("b", after="a")
+    queue.enqueue("a", [1])
+    queue.seal("a")
+
+    [(unit_id, item)] = queue.claim("a", "worker")
+    assert not queue.is_finished("b")
+    queue.complete(unit_id, "worker", item, next_stage="b", next_items=[item * 10, item * 20])
+    assert not queue.is_finished("b")
+
+    for unit_id, item in queue.claim("b", "worker", limit=5):
+        queue.complete(unit_id, "worker", item)
+    assert queue.is_finished("b")
+    assert list(queue.results("b")) == [10, 20]
+
+
+def test_expired_claims_are_reclaimed(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.01)
+    queue.enqueue("a", ["x"])
+    assert queue.claim("a", "crashed worker") == [(1, "x")]
+    assert queue.claim("a", "other worker") == []
+    deadline = time.time() + 0.05
+    while time.time() < deadline:  # time.sleep is sped up in tests.
+        time.sleep(0.01)
+    assert queue.claim("a", "other worker") == [(1, "x")]
+
+
+def wait_for_leases_to_expire():
+    deadline = time.time() + 0.05
+    while time.time() < deadline:  # time.sleep is sped up in tests.
+        time.sleep(0.01)
+
+
+def test_only_the_lease_holder_can_complete(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.01)
+    queue.enqueue("a", [1])
+    queue.seal("a")
+    [(unit_id, item)] = queue.claim("a", "slow worker")
+    wait_for_leases_to_expire()
+    assert queue.claim("a", "other worker") == [(unit_id, item)]
+
+    assert queue.complete(unit_id, "other worker", item, next_stage="b", next_items=[10])
+    assert not queue.complete(unit_id, "slow worker", item, next_stage="b", next_items=[10])
+    assert not queue.fail(unit_id, "slow worker", "late")
+    assert queue.counts("a") == {PENDING: 0, CLAIMED: 0, DONE: 1, FAILED: 0}
+    assert queue.counts("b")[PENDING] == 1
+
+
+def test_renewed_leases_are_not_reclaimed(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.01)
+    queue.enqueue("a", ["x"])
+    assert queue.claim("a", "slow worker") == [(1, "x")]
+    assert WorkQueue(queue.path, lease_seconds=60).renew("slow worker") == 1
+    wait_for_leases_to_expire()
+    assert queue.claim("a", "other worker") == []
+    assert queue.counts("a")[CLAIMED] == 1
+
+
+def test_units_fail_after_max_attempts(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.01, max_attempts=2)
+    queue.enqueue("a", ["x"])
+    queue.seal("a")
+    for worker in ["first", "second"]:
+        assert queue.claim("a", worker) == [(1, "x")]
+        wait_for_leases_to_expire()
+
+    assert queue.claim("a", "third") == []
+    assert queue.counts("a") == {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 1}
+    assert queue.is_finished("a")
+
+
+def test_job_description(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    assert queue.job() == {}
+    queue.set_job({"stages": ["a"]})
+    assert WorkQueue(queue.path).job() == {"stages": ["a"]}
+
+
+class NumberSource(Source):
+    def new_item_iterable(self):
+        return range(1, 251)
+
+
+def _drain(path, stage):
+    queue = WorkQueue(path)
+    Pipeline(
+        WorkQueueSource(queue, stage, poll_interval=0.01), WorkQueuePipe(MyPipe()), WorkQueueResultSink(queue)
+    ).run()
+
+
+def test_pipelines_share_a_queue_across_processes(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    queue = WorkQueue(path)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_drain, args=(path, "double")) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    Pipeline(NumberSource(), WorkQueueSink(queue, "double", batch_size=7)).run()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    assert queue.counts("double")[DONE] == 250
+    sink = MySink()
+    Pipeline(WorkQueueResultSource(queue, "double"), sink).run()
+    assert sink.results == [i * 2 for i in range(1, 251)]